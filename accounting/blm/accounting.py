@@ -23,8 +23,8 @@ else:
 
 import copy
 import ssl, tempfile
-import bson, dateutil.relativedelta, datetime, decimal, functools, \
-    logging, os, re, time, uuid
+import bson, calendar, dateutil.relativedelta, datetime, decimal, \
+    functools, logging, os, re, time, uuid
 from bson.objectid import ObjectId, InvalidId
 from email.utils import formataddr, getaddresses
 from accounting import config, luhn, mail, templating
@@ -33,6 +33,8 @@ import pytransact.runtime as ri
 from pytransact import exceptions, spickle
 from pytransact.iterate import uniq
 from pytransact.object.model import *
+from pytransact import mongo
+from pytransact.contextbroker import ContextBroker
 from blm import fundamental
 import OpenSSL.crypto
 import itertools
@@ -107,6 +109,34 @@ def requireRoles(*roles):
     return _
 
 
+
+def next_ocr_counter(org, year):
+    """
+    Allocate the next OCR counter of org for year (e.g. '2019').
+
+    The counters are kept in the ocrcounters collection, as documents
+    {'_id': '<org id>-<year>', 'next': <next counter>}, and incremented
+    atomically, so that concurrent purchases don't conflict on the Org
+    TOI. Commits that are rerun allocate a new counter, which leaves
+    gaps in the sequence. bin/upgrade.py seeds the current year from
+    Org.ocrCounter, which is no longer updated.
+    """
+    database = ContextBroker().context.database
+    key = '%s-%s' % (org.id[0], year)
+    counter = mongo.find_and_modify(database.ocrcounters, {'_id': key},
+                                    {'$inc': {'next': 1}})
+    if counter is None:
+        # First OCR this year. Until upgrade.py has seeded the counter,
+        # continue from Org.ocrCounter like it does.
+        start = 1
+        if org.ocrYearReset == [int(year[-1])]:
+            start = org.ocrCounter[0]
+        mongo.update(database.ocrcounters, {'_id': key},
+                     {'$setOnInsert': {'next': start}}, upsert=True)
+        counter = mongo.find_and_modify(database.ocrcounters, {'_id': key},
+                                        {'$inc': {'next': 1}})
+    return counter['next']
+
 class SubscriptionLevel(Enum()):
     values = 'subscriber', 'pg'
 
@@ -759,6 +789,7 @@ class Org(TO):
             return value
 
     class ocrCounter(Int()):
+        "Next OCR counter before they moved to next_ocr_counter()"
         default = [1]
 
     class ocrYearReset(Int(Range(0, 9))):
@@ -816,16 +847,25 @@ class Org(TO):
 
     @method(String())
     def get_ocr(self):
-        year = int(time.strftime('%Y')[-1])
-        if [year] != self.ocrYearReset:
-            self.ocrCounter = [1]
-            self.ocrYearReset = [year]
+        if not self.canWrite(ri.getClientUser(), 'ocrCounter'):
+            raise exceptions.cPermissionError('Permission denied: %s, %s' %
+                                              (self, 'get_ocr'))
+        year = time.strftime('%Y')
+        counter = next_ocr_counter(self, year)
+        number = str(counter + 9) + year[-1]
+        return [luhn.add_control_digits(number)]
 
-        counter = self.ocrCounter[0]
-        self.ocrCounter = self.ocrCounter[0] + 1
+    @method(None)
+    def rebuildTransactionIndex(self):
+        if ri.getClientUser():
+            raise cBlmError('No permission')
+        TransactionText.rebuild(self)
 
-        number = str(counter + 9) + str(year)
-        return [luhn.add_control_digits(number)]
+    @method(None)
+    def updateTransactionIndex(self, before=Timestamp(Quantity(1))):
+        if ri.getClientUser():
+            raise cBlmError('No permission')
+        TransactionText.update(self, before[0])
 
     @method(None)
     def disable(self):
@@ -1231,8 +1271,15 @@ class Accounting(TO):
         Dimension(number=['10'], name=[u'Faktura'],
                   accounting=[self])
 
+    class ledger_revision(Int(QuantityMax(1))):
+        "Changed with everything that the cached reports are made from"
+
+    def ledgerChanged(self):
+        self.ledger_revision = [(self.ledger_revision.value or [0])[0] + 1]
+
     def on_update(self, newattrvalues):
         self._update(newattrvalues)
+        self.ledgerChanged()
         if 'start' in newattrvalues or 'end' in newattrvalues:
             years = self.years.value
             years['0'] = [self.start[0], self.end[0]]
@@ -1245,6 +1292,7 @@ class Accounting(TO):
             self.end = [end]
 
     def on_delete(self):
+        self.ledgerChanged = lambda: None
         # prefetch data
         q = VerificationSeries._query(accounting=[self])
         q.attrList = ['allowRead']
@@ -1258,6 +1306,7 @@ class Accounting(TO):
         for account in accounts:
             # no need to recalc balance of accounts that are being deleted
             account.updateBalance = lambda: None
+            account.adjustBalance = lambda *args: None
 
         q = AccountBalance._query(account=accounts)
         q.attrList = ['allowRead', 'balance_budgets', 'object_balance_budgets']
@@ -1267,9 +1316,13 @@ class Accounting(TO):
         q.attrList = ['allowRead']
         dimensions = q.run()
 
-        for toi in series:
-            toi._allowDelete = True
-            toi._delete()
+        delay = {TransactionText.DELAY: set()}
+        with ri.cache.set(delay) as cache:
+            for toi in series:
+                toi._allowDelete = True
+                toi._delete()
+            texts = cache[TransactionText.DELAY]
+        TransactionText.mark(texts)
 
         for toi in accounts:
             toi._delete()
@@ -1440,10 +1493,16 @@ class Dimension(TO):
         self.allowRead = self.accounting[0].allowRead
         if self.subdim_of and self.subdim_of[0].project[0]:
             self.project[0] = [True]
+        self.accounting[0].ledgerChanged()
+
+    def on_update(self, newattrvalues):
+        self._update(newattrvalues)
+        self.accounting[0].ledgerChanged()
 
     def on_delete(self):
         for toi in AccountingObject._query(dimension=self).run():
             toi._delete()
+        self.accounting[0].ledgerChanged()
 
 
 class AccountingObject(TO):
@@ -1467,6 +1526,16 @@ class AccountingObject(TO):
 
     def updateBalance(self, transaction):
         account = transaction.account[0]
+        try:
+            ri.cache[self.updateBalance.DELAY].add((self, account))
+            return
+        except KeyError:
+            pass
+        self.updateAccountBalance(account)
+
+    updateBalance.DELAY = 'delay-object-balance-calculation'
+
+    def updateAccountBalance(self, account):
         try:
             obb, = ObjectBalanceBudget._query(account_balance=account,
                                               accounting_object=self).run()
@@ -1482,6 +1551,11 @@ class AccountingObject(TO):
     @requireRoles('accountants')
     def on_create(self):
         self.allowRead = self.dimension[0].allowRead
+        self.dimension[0].accounting[0].ledgerChanged()
+
+    def on_update(self, newattrvalues):
+        self._update(newattrvalues)
+        self.dimension[0].accounting[0].ledgerChanged()
 
 
 class Balance(TO):
@@ -1571,12 +1645,18 @@ class AccountBalance(Balance):
         abals = account.account_balances.value
         abals[str(self.year[0])] = self
         account.account_balances = abals
+        account.accounting[0].ledgerChanged()
+
+    def on_update(self, newattrvalues):
+        self._update(newattrvalues)
+        self.account[0].accounting[0].ledgerChanged()
 
     def on_delete(self):
         for toi in self.balance_budgets:
             toi._delete()
         for toi in self.object_balance_budgets:
             toi._delete()
+        self.account[0].accounting[0].ledgerChanged()
 
 
 class BaseAccount(TO):
@@ -1705,6 +1785,12 @@ class Account(AccountBalance):
     class account_balances(ToiRefMap(ToiType('AccountBalance'))):
         pass
 
+    class period_turnover(DecimalMap()):
+        "Sum of transaction amounts per month, keyed on YYYYMM"
+
+    class period_turnover_quantity(DecimalMap()):
+        "Sum of transaction quantities per month, keyed on YYYYMM"
+
     def on_create(self):
         self.allowRead = self.accounting[0].allowRead
         # This hack is used by Transaction.sum() to figure out if it
@@ -1728,6 +1814,7 @@ class Account(AccountBalance):
             self.updateVatPercentage()
         if {'opening_balance', 'opening_quantity'} & set(newattrvalues):
             self.updateBalance()
+        self.accounting[0].ledgerChanged()
 
     def on_delete(self):
         super(Account, self).on_delete()
@@ -1752,12 +1839,98 @@ class Account(AccountBalance):
             return
         except KeyError:
             pass
-        amount, quantity = Transaction.sum(account=self)
-        self.balance = [self.opening_balance[0] + amount]
-        self.balance_quantity = [self.opening_quantity[0] + quantity]
+        amounts, quantities = Transaction.period_sums(account=self)
+        self.period_turnover = amounts
+        self.period_turnover_quantity = quantities
+        self.balance = [self.opening_balance[0] + sum(amounts.values(), 0)]
+        self.balance_quantity = [self.opening_quantity[0] +
+                                 sum(quantities.values(), 0)]
 
     updateBalance.DELAY = 'delay-balance-calculation'
 
+    def adjustBalance(self, amount, quantity, transaction_date):
+        """Apply a signed change in transaction amount and quantity to
+        the balance and the turnover of the transaction's month,
+        without re-summing all transactions."""
+        try:
+            ri.cache[self.updateBalance.DELAY].add(self)
+            return
+        except KeyError:
+            pass
+        self.balance = [self.balance[0] + amount]
+        self.balance_quantity = [self.balance_quantity[0] + quantity]
+
+        period = Transaction.period(transaction_date)
+        turnover = self.period_turnover.value
+        turnover[period] = turnover.get(period, 0) + amount
+        self.period_turnover = turnover
+        turnover = self.period_turnover_quantity.value
+        turnover[period] = turnover.get(period, 0) + quantity
+        self.period_turnover_quantity = turnover
+
+    def turnover(self, from_date=None, to_date=None):
+        """Return (balance before from_date, turnover from from_date
+        to to_date inclusive).
+
+        Whole months are taken from period_turnover; only months that
+        are partially covered by the date range are summed transaction
+        by transaction."""
+        opening = self.opening_balance[0]
+        total = decimal.Decimal('0.00')
+        partial = []
+        for period, amount in self.period_turnover.items():
+            year, month = int(period[:4]), int(period[4:])
+            first = '%04d-%02d-01' % (year, month)
+            last = '%04d-%02d-%02d' % (year, month,
+                                       calendar.monthrange(year, month)[1])
+            if from_date and last < from_date:
+                opening += amount
+            elif to_date and first > to_date:
+                continue
+            elif ((from_date and first < from_date) or
+                  (to_date and last > to_date)):
+                partial.append((first, last))
+            else:
+                total += amount
+
+        for first, last in partial:
+            q = Transaction._query(account=self,
+                                   transaction_date=Q.Between(first, last))
+            q.attrList = ['amount', 'transaction_date']
+            for transaction in q.run():
+                date = transaction.transaction_date[0]
+                if from_date and date < from_date:
+                    opening += transaction.amount[0]
+                elif not to_date or date <= to_date:
+                    total += transaction.amount[0]
+
+        return opening, total
+
+    def balanceDrift(self):
+        """Return the difference between the stored balance and a full
+        re-sum of the transactions, as (amount, quantity)."""
+        amount, quantity = Transaction.sum(account=self)
+        return (self.opening_balance[0] + amount - self.balance[0],
+                self.opening_quantity[0] + quantity -
+                self.balance_quantity[0])
+
+    def turnoverDrift(self):
+        """Return the months where period_turnover or
+        period_turnover_quantity differ from a full re-sum of the
+        transactions, as {YYYYMM: (amount, quantity)}."""
+        amounts, quantities = Transaction.period_sums(account=self)
+        turnover = self.period_turnover.value
+        turnover_quantity = self.period_turnover_quantity.value
+        drift = {}
+        for period in (set(amounts) | set(quantities) | set(turnover) |
+                       set(turnover_quantity)):
+            amount = turnover.get(period, 0) - amounts.get(period, 0)
+            quantity = (turnover_quantity.get(period, 0) -
+                        quantities.get(period, 0))
+            if amount or quantity:
+                drift[period] = (amount, quantity)
+        return drift
+
     @method(ToiRef(ToiType('Account'), Quantity(1)))
     def new(self, accounting=ToiRef(ToiType('Accounting'), Quantity(1))):
         params = {}
@@ -1806,6 +1979,12 @@ class VerificationSeries(TO):
     class canBeDeleted(Bool(Quantity(1))):
         default = [True]
 
+    class last_number(Int(QuantityMax(1))):
+        # Highest verification number handed out in this series. Left
+        # empty when unknown (older series, or the highest verification
+        # has been deleted) in which case it is recalculated on demand.
+        pass
+
     def _check_name(self):
         if VerificationSeries._query(name=self.name,
                                      accounting=self.accounting).run() != [self]:
@@ -1817,6 +1996,13 @@ class VerificationSeries(TO):
         return self.name[0]
     sort_name_attrs = 'name',
 
+    def highestNumber(self, exclude=None):
+        if self.last_number:
+            return self.last_number[0]
+        q = Verification._query(series=[self], _attrList=['number'])
+        return max([v.number[0] for v in q.run()
+                    if v != exclude and v.number] or [0])
+
     @method(ToiRef(ToiType('VerificationSeries'), Quantity(1)))
     def copy(self, accounting=ToiRef(ToiType(Accounting), Quantity(1))):
         result = VerificationSeries._query(name=self.name,
@@ -1834,10 +2020,12 @@ class VerificationSeries(TO):
     def on_create(self):
         self._check_name()
         self.allowRead = self.accounting[0].allowRead
+        self.accounting[0].ledgerChanged()
 
     def on_update(self, newAttrValues):
         self._update(newAttrValues)
         self._check_name()
+        self.accounting[0].ledgerChanged()
 
     _allowDelete = False
     def on_delete(self):
@@ -1866,16 +2054,15 @@ class VerificationSeries(TO):
 def next_verification_data(series=ToiRef(ToiType(VerificationSeries),
                                          Quantity(1))):
     series, = series
-    q = Verification._query(series=series)
-    q.attrList = ['number', 'transaction_date']
+    previous = series.highestNumber()
+    q = Verification._query(series=series, number=previous)
+    q.attrList = ['transaction_date']
     verifications = q.run()
     if not verifications:
-        number = 1
         date = series.accounting[0].start[0]
     else:
-        maxver = max(verifications, key=lambda toi: toi.number.value)
-        number = maxver.number[0] + 1
-        date = maxver.transaction_date[0]
+        date = verifications[0].transaction_date[0]
+    number = previous + 1
     return dict(accounting=series.accounting[0].id[0],
                 number=number,
                 transaction_date=date)
@@ -2003,26 +2190,20 @@ class Verification(TO):
 
     @requireRoles('accountants')
     def on_create(self):
+        series = self.series[0]
+        previous = series.highestNumber(exclude=self)
         if not self.number:
-            try:
-                previous = ri.cache['verification-number']
-            except KeyError:
-                q = Verification._query(series=self.series,
-                                        _attrList=['number'])
-                try:
-                    previous = max(v.number[0] for v in q.run() if v != self)
-                except ValueError:
-                    previous = 0
-            number = ri.cache['verification-number'] = previous + 1
-            self.number = [number]
+            self.number = [previous + 1]
         else:
             q = Verification._query(series=self.series, number=self.number)
             if q.run() != [self]:
                 raise cBlmError('A Verification with the number %s already '
                                 'exists in this series.' % self.number[0])
+        series.last_number = [max(previous, self.number[0])]
 
-        self.series[0].canBeDeleted = [False]
+        series.canBeDeleted = [False]
         self.allowRead = self.accounting[0].allowRead
+        self.accounting[0].ledgerChanged()
 
     def on_update(self, newattrvalues):
         self.logVerification()
@@ -2043,8 +2224,13 @@ class Verification(TO):
             self.signature = list(map(str, client_user.id))
             self.signature_name = client_user.name
         self.registration_date = [time.strftime('%Y-%m-%d')]
+        self.accounting[0].ledgerChanged()
 
     def on_delete(self):
+        series = self.series[0]
+        if not series._deleted and series.last_number == self.number:
+            series.last_number = []
+        self.accounting[0].ledgerChanged()
         for toi in self.transactions:
             toi._delete()
 
@@ -2198,28 +2384,47 @@ class Transaction(TO):
             self.transaction_date = self.verification[0].transaction_date
         self.allowRead = self.verification[0].allowRead
         self.account[0].transactions.add(self)
-        self.account[0].updateBalance()
+        self.account[0].adjustBalance(self.amount[0], self.quantity[0],
+                                      self.transaction_date[0])
         for toi in self.accounting_objects:
             toi.updateBalance(self)
 
         if self.version != [0]:
             self.verification[0].logTransactionAdd(self)
+        self.verification[0].accounting[0].ledgerChanged()
+        TransactionText.changed(self._org(), self.text[0])
 
     def canWrite(self, user, attrName):
         return currentUserHasRole(self, 'accountants', user=user)
 
     def on_update(self, newattrvalues):
         account = self.account[0]
+        amount, quantity = self.amount[0], self.quantity[0]
+        transaction_date = self.transaction_date[0]
+        text = self.text[0]
         self.verification[0].logTransactionChange(self)
         self._update(newattrvalues)
-        for account in set([account, self.account[0]]):  # update both old and new acc
-            account.updateBalance()
+        if self.text[0] != text:
+            TransactionText.changed(self._org(), text)
+            TransactionText.changed(self._org(), self.text[0])
+        # move the old amount out of the old account and the new
+        # amount into the (possibly same) new account
+        account.adjustBalance(-amount, -quantity, transaction_date)
+        self.account[0].adjustBalance(self.amount[0], self.quantity[0],
+                                      self.transaction_date[0])
+        self.verification[0].accounting[0].ledgerChanged()
 
     def on_delete(self):
         self.verification[0].logTransactionChange(self)
         account = self.account[0]
         self.account = []  # make sure this transaction is ignored when recalculating balance
-        account.updateBalance()
+        account.adjustBalance(-self.amount[0], -self.quantity[0],
+                              self.transaction_date[0])
+        self.verification[0].accounting[0].ledgerChanged()
+        TransactionText.changed(self._org(), self.text[0])
+
+    def _org(self):
+        return self.verification[0].accounting[0].org.value
 
     @staticmethod
     def sum(**kw):
@@ -2235,7 +2440,147 @@ class Transaction(TO):
         quantity = sum((toi.quantity[0] for toi in transactions), 0)
         return amount, quantity
 
+    @staticmethod
+    def period(transaction_date):
+        "YYYY-MM-DD -> YYYYMM"
+        return transaction_date[:4] + transaction_date[5:7]
+
+    @staticmethod
+    def period_sums(**kw):
+        """Like sum(), but return dicts of amount and quantity per
+        month, keyed on YYYYMM."""
+        if list(kw.keys()) == ['account'] and getattr(kw['account'], '_new', False):
+            transactions = kw['account'].transactions
+        else:
+            query = Transaction._query(**kw)
+            query.attrList = ['amount', 'quantity', 'transaction_date']
+            transactions = query.run()
+        amounts = collections.defaultdict(lambda: decimal.Decimal('0'))
+        quantities = collections.defaultdict(lambda: decimal.Decimal('0'))
+        for toi in transactions:
+            period = Transaction.period(toi.transaction_date[0])
+            amounts[period] += toi.amount[0]
+            quantities[period] += toi.quantity[0]
+        return dict(amounts), dict(quantities)
+
 
+class TransactionText(TO):
+    """
+    The distinct transaction texts of an Org, and how many
+    transactions use each of them. Used for autocompletion.
+    """
+
+    class org(ToiRef(ToiType(Org), Quantity(1), Unchangeable())):
+        pass
+
+    class text(String(Quantity(1), Unchangeable())):
+        pass
+
+    class key(String(Quantity(1))):
+        "Lower case text, for prefix lookups"
+
+    class count(Int(Quantity(1))):
+        default = [0]
+
+    def canWrite(self, user, attrName):
+        return currentUserHasRole(self, 'accountants', user=user)
+
+    def on_create(self):
+        self.key = [self.text[0].lower()]
+        self.allowRead = self.org[0].ug
+
+    DELAY = 'delay-transaction-text-index'
+
+    # Seconds of margin for clock differences between the machines
+    # that mark texts and the one that recounts them
+    STALE_AGE = 60
+
+    @staticmethod
+    def changed(org, text):
+        "Note that the number of transactions in org using text changed."
+        if not org or not text:
+            return
+        try:
+            ri.cache[TransactionText.DELAY].add((org[0], text))
+            return
+        except KeyError:
+            pass
+        TransactionText.mark({(org[0], text)})
+
+    @staticmethod
+    def mark(texts):
+        """
+        Mark {(org, text)} as stale in the staletexts collection.
+
+        The index is recounted later, by update(), so that commits of
+        transactions in the same org don't all write the same
+        TransactionText TOIs. Marking a text again is harmless, so
+        commits that are rerun or fail at most cause a recount.
+
+        The mark is written before the commit is visible, so it must
+        not be removed until the commit has finished, see
+        bin/index_transaction_texts.py.
+        """
+        if not texts:
+            return
+        database = ContextBroker().context.database
+        now = time.time()
+        for org, text in texts:
+            mongo.update(database.staletexts,
+                         {'_id': '%s-%s' % (org.id[0], text)},
+                         {'$set': {'org': org.id[0], 'text': text,
+                                   'changed': now}},
+                         upsert=True)
+
+    @staticmethod
+    def stale(org, before=None):
+        "Return the texts of org that were marked stale before 'before'."
+        database = ContextBroker().context.database
+        spec = {'org': org.id[0]}
+        if before is not None:
+            spec['changed'] = {'$lt': before}
+        return set(doc['text'] for doc in
+                   mongo.find(database.staletexts, spec, projection=['text']))
+
+    @staticmethod
+    def update(org, before):
+        """
+        Recount the texts of org that were marked stale before the
+        timestamp 'before'. The marks are left for the caller to
+        remove once the commit has succeeded.
+        """
+        texts = TransactionText.stale(org, before)
+        if texts:
+            TransactionText.recount(org, texts)
+
+    @staticmethod
+    def rebuild(org):
+        """Recount the texts of all transactions of org."""
+        TransactionText.recount(org)
+
+    @staticmethod
+    def recount(org, texts=None):
+        accountings = Accounting._query(org=org).run()
+        accounts = Account._query(accounting=accountings).run()
+        kw = {} if texts is None else {'text': Q.In(list(texts))}
+        transactions = Transaction._query(account=accounts, _attrList=['text'],
+                                          **kw).run()
+        counts = collections.Counter(toi.text[0] for toi in transactions)
+        counts.pop('', None)
+
+        q = TransactionText._query(org=org, **kw)
+        q.attrList = ['text', 'count']
+        existing = dict((toi.text[0], toi) for toi in q.run())
+        for text, count in counts.items():
+            toi = existing.pop(text, None)
+            if toi is None:
+                TransactionText(org=[org], text=[text], count=[count])
+            elif toi.count != [count]:
+                toi.count = [count]
+        for toi in existing.values():
+            toi._delete()
+
+
 class ObjectBalanceBudget(Balance):
 
     class account_balance(Relation(Quantity(1), Unchangeable())):
@@ -2283,6 +2628,11 @@ class ObjectBalanceBudget(Balance):
     @requireRoles('accountants')
     def on_create(self):
         self.allowRead = self.account_balance[0].allowRead
+        self.account_balance[0].account[0].accounting[0].ledgerChanged()
+
+    def on_update(self, newattrvalues):
+        self._update(newattrvalues)
+        self.account_balance[0].account[0].accounting[0].ledgerChanged()
 
 
 class BalanceBudget(Balance):
@@ -2295,6 +2645,11 @@ class BalanceBudget(Balance):
 
     def on_create(self):
         self.allowRead = self.account_balance[0].allowRead
+        self.account_balance[0].account[0].accounting[0].ledgerChanged()
+
+    def on_update(self, newattrvalues):
+        self._update(newattrvalues)
+        self.account_balance[0].account[0].accounting[0].ledgerChanged()
 
 
 class VatCode(TO):
@@ -3540,12 +3895,27 @@ def transactionIndex(direct_data=Serializable()):
     else:
         raise ValueError('Unknown Org')
 
-    accountings = Accounting._query(org=orgid).run()
-    accounts = Account._query(accounting=accountings).run()
-    transactions = Transaction._query(account=accounts,
-                                      _attrList=['text']).run()
-    texts = set(transaction.text[0] for transaction in transactions)
-    texts.discard('')
+    # Optional prefix to complete, and max number of texts
+    prefix = data.get('query', '').lower().replace('*', '').replace('?', '')
+    limit = data.get('limit')
+
+    q = TransactionText._query(org=orgid)
+    if prefix:
+        q = TransactionText._query(org=orgid, key=Q.Like(prefix + '*'))
+    q.attrList = ['text', 'count']
+    texts = q.run()
+    texts.sort(key=lambda toi: (-toi.count[0], toi.text[0]))
+    texts = [toi.text[0] for toi in texts]
+
+    # Texts that have been used since the index was updated
+    for org in Org._query(id=orgid, _attrList=[]).run():
+        known = set(texts)
+        texts.extend(sorted(text for text in TransactionText.stale(org)
+                            if text not in known and
+                            text.lower().startswith(prefix)))
+
+    if limit:
+        texts = texts[:int(limit)]
     return [{'text': text, 'org': orgid} for text in texts]
 
 
@@ -3564,7 +3934,8 @@ def account_query(accounting, accountNumbers=None, full=False):
     else:
         q = Account._query(accounting=accounting)
 
-    q.attrList = ['number', 'name', 'account_balances', 'transactions']
+    q.attrList = ['number', 'name', 'account_balances', 'transactions',
+                  'opening_balance', 'period_turnover']
     accounts = q.run()
     if not full:
         accounts = [a for a in accounts
@@ -3596,29 +3967,38 @@ def main_ledger_report(accounting=ToiRef(ToiType(Accounting), Quantity(1)),
     return load_verifications(accounts)
 
 
+def load_balances(accounts):
+    # Balance reports work from Account.period_turnover, no need to
+    # load the individual transactions.
+    q = AccountBalance._query(account=accounts)
+    q.attrList = ['year', 'opening_balance', 'balance', 'budget']
+    q.run()
+
+    return accounts
+
+
 def balance_report(accounting=ToiRef(ToiType(Accounting), Quantity(1))):
     accounts = account_query(accounting)
     accounts = [a for a in accounts if a.number[0][0] in '12']
-    return load_verifications(accounts)
+    return load_balances(accounts)
 
 
 def income_statement_report(accounting=ToiRef(ToiType(Accounting), Quantity(1))):
     accounts = account_query(accounting)
     accounts = [a for a in accounts if a.number[0][0] not in '12']
-    return load_verifications(accounts)
+    return load_balances(accounts)
 
 
 def year_report(accounting=ToiRef(ToiType(Accounting), Quantity(1))):
     accounts = account_query(accounting, full=True)
     accounts = [a for a in accounts if a.number[0][0] not in '12']
-    return load_verifications(accounts)
+    return load_balances(accounts)
 
 
 def period_report(accounting=ToiRef(ToiType(Accounting), Quantity(1))):
     accounts = account_query(accounting, full=True)
     accounts = [a for a in accounts if a.number[0][0] not in '12']  #not balance accounts
-    return load_verifications(accounts)  #returns all acounts that are not balance accounts and
-                                                                #for the current year?
+    return load_balances(accounts)
 
 
 @method(ToiRef(ToiType(Accounting), Quantity(1)))
@@ -599,7 +599,6 @@ class TestOrg(BLMTests):
         assert org.ocrCounter == [1]
         ocr, = org.get_ocr()
         assert ocr == '10355'
-        assert org.ocrCounter == [2]
 
         ocr, = org.get_ocr()
         assert ocr == '11353'
@@ -607,8 +606,34 @@ class TestOrg(BLMTests):
         year = '2014'
         ocr, = org.get_ocr()
         assert ocr == '10454'
-        assert org.ocrYearReset == [4]
-        assert org.ocrCounter == [2]
+
+        # the Org itself is left alone
+        assert org.ocrYearReset == [3]
+        assert org.ocrCounter == [1]
+
+        counter = mongo.find_one(self.database.ocrcounters,
+                                 {'_id': '%s-2013' % org.id[0]})
+        assert counter['next'] == 3
+        counter = mongo.find_one(self.database.ocrcounters,
+                                 {'_id': '%s-2014' % org.id[0]})
+        assert counter['next'] == 2
+
+    def test_get_ocr_continues_org_counter(self, monkeypatch):
+        year = '2013'
+        monkeypatch.setattr(time, 'strftime', lambda s: year)
+
+        org = blm.accounting.Org(ocrCounter=[5])
+        stale = blm.accounting.Org(ocrCounter=[5])
+        assert org.ocrYearReset == [3]
+        ocr, = org.get_ocr()
+        assert ocr == '14357'
+        ocr, = org.get_ocr()
+        assert ocr == '15354'
+
+        # ocrCounter is from last year, start over
+        year = '2014'
+        ocr, = stale.get_ocr()
+        assert ocr == '10454'
 
     def test_get_ocr_rapidly(self):
         org = blm.accounting.Org()
@@ -638,8 +663,10 @@ class TestOrg(BLMTests):
             os.waitpid(pid, 0)
 
         self.sync()
-        org._clear()
-        assert org.ocrCounter == [1 + parallel]
+        counter = mongo.find_one(self.database.ocrcounters,
+                                 {'_id': '%s-%s' % (org.id[0],
+                                                    time.strftime('%Y'))})
+        assert counter['next'] == 1 + parallel
 
     def test_removeMembers(self):
         org = blm.accounting.Org(name=['foo inc.'], orgnum=['1234567890'])
@@ -1272,6 +1299,119 @@ class TestAccount(BLMTests):
         account(opening_balance=['5.00'])
         assert account.balance == [Decimal('15.00')]
 
+    def test_balance_delta(self):
+        account = blm.accounting.Account(number=['1234'],
+                                         opening_balance=['42.00'],
+                                         opening_quantity=['10'],
+                                         accounting=[self.accounting])
+        other = blm.accounting.Account(number=['2345'],
+                                       accounting=[self.accounting])
+        trans = blm.accounting.Transaction(verification=[self.ver],
+                                           account=[account],
+                                           version=self.ver.version,
+                                           amount=['10.00'], quantity=['5'])
+        self.commit()
+
+        account, other = sorted(blm.accounting.Account._query().run(),
+                                key=lambda toi: toi.number[0])
+        trans, = blm.accounting.Transaction._query().run()
+        trans(amount=['7.00'], quantity=['3'])
+        assert account.balance == [Decimal('49.00')]
+        assert account.balance_quantity == [Decimal('13')]
+
+        trans(account=[other])
+        assert account.balance == [Decimal('42.00')]
+        assert account.balance_quantity == [Decimal('10')]
+        assert other.balance == [Decimal('7.00')]
+        assert other.balance_quantity == [Decimal('3')]
+
+        trans._delete()
+        assert other.balance == [Decimal('0.00')]
+        assert other.balance_quantity == [Decimal('0')]
+
+    def test_period_turnover(self, monkeypatch):
+        account = blm.accounting.Account(number=['1234'],
+                                         opening_balance=['42.00'],
+                                         accounting=[self.accounting])
+        for date, amount in [('2010-01-10', '1.00'),
+                             ('2010-01-20', '2.00'),
+                             ('2010-02-15', '4.00'),
+                             ('2010-03-01', '8.00')]:
+            blm.accounting.Transaction(verification=[self.ver],
+                                       account=[account],
+                                       version=self.ver.version,
+                                       transaction_date=[date],
+                                       amount=[amount], quantity=['1'])
+        self.commit()
+
+        account, = blm.accounting.Account._query().run()
+        assert account.period_turnover == {'201001': Decimal('3.00'),
+                                           '201002': Decimal('4.00'),
+                                           '201003': Decimal('8.00')}
+        assert account.period_turnover_quantity['201001'] == Decimal('2')
+
+        assert account.turnover() == (Decimal('42.00'), Decimal('15.00'))
+        assert account.turnover('2010-02-01', '2010-02-28') == (
+            Decimal('45.00'), Decimal('4.00'))
+        # partially covered months
+        assert account.turnover('2010-01-15', '2010-02-10') == (
+            Decimal('43.00'), Decimal('2.00'))
+
+        trans, = blm.accounting.Transaction._query(
+            transaction_date='2010-03-01').run()
+        trans(transaction_date=['2010-02-01'])
+        assert account.period_turnover['201002'] == Decimal('12.00')
+        assert account.period_turnover['201003'] == Decimal('0.00')
+
+        account.updateBalance()
+        assert account.period_turnover == {'201001': Decimal('3.00'),
+                                           '201002': Decimal('12.00')}
+
+        # whole months, up to their real last day, are not re-summed
+        def _query(**kw):
+            raise AssertionError('transactions queried')
+        monkeypatch.setattr(blm.accounting.Transaction, '_query', _query)
+        assert account.turnover('2010-02-01', '2010-02-28') == (
+            Decimal('45.00'), Decimal('12.00'))
+        assert account.turnover('2010-01-01', '2010-01-31') == (
+            Decimal('42.00'), Decimal('3.00'))
+
+    def test_balanceDrift(self):
+        account = blm.accounting.Account(number=['1234'],
+                                         opening_balance=['42.00'],
+                                         accounting=[self.accounting])
+        blm.accounting.Transaction(verification=[self.ver],
+                                   account=[account],
+                                   version=self.ver.version,
+                                   amount=['10.00'], quantity=['5'])
+        self.commit()
+
+        account, = blm.accounting.Account._query().run()
+        assert account.balanceDrift() == (Decimal('0'), Decimal('0'))
+
+        account.balance = [Decimal('50.00')]
+        account.balance_quantity = [Decimal('6')]
+        assert account.balanceDrift() == (Decimal('2.00'), Decimal('-1'))
+
+    def test_turnoverDrift(self):
+        account = blm.accounting.Account(number=['1234'],
+                                         accounting=[self.accounting])
+        blm.accounting.Transaction(verification=[self.ver],
+                                   account=[account],
+                                   version=self.ver.version,
+                                   transaction_date=['2010-01-05'],
+                                   amount=['10.00'], quantity=['5'])
+        self.commit()
+
+        account, = blm.accounting.Account._query().run()
+        assert account.turnoverDrift() == {}
+
+        account.period_turnover = {'201001': Decimal('12.00'),
+                                   '201002': Decimal('1.00')}
+        assert account.turnoverDrift() == {
+            '201001': (Decimal('2.00'), Decimal('0')),
+            '201002': (Decimal('1.00'), Decimal('0'))}
+
     def test_fromtemplate(self, monkeypatch):
         accounting = blm.accounting.Accounting()
         acc = blm.accounting.BaseAccount(number=['1234'])
@@ -1394,6 +1534,32 @@ class TestVerification(BLMTests):
                        series=[self.series], accounting=[self.accounting],
                        number=[1])
 
+    def test_number_counter(self):
+        ver1 = self.mkVerification()
+        assert self.series.last_number == [1]
+        ver2 = self.mkVerification(number=[17])
+        assert self.series.last_number == [17]
+        ver3 = self.mkVerification(number=[5])
+        assert self.series.last_number == [17]
+        ver4 = self.mkVerification()
+        assert ver4.number == [18]
+        self.commit()
+
+        # series from before the counter was introduced
+        self.series.last_number = []
+        ver5 = self.mkVerification()
+        assert ver5.number == [19]
+        assert self.series.last_number == [19]
+
+        # deleting the last verification makes its number available again
+        ver5._delete()
+        assert self.series.last_number == []
+        ver6 = self.mkVerification()
+        assert ver6.number == [19]
+
+        ver3._delete()
+        assert self.series.last_number == [19]
+
     def test_update_signature_and_regdate(self):
         newUser = blm.accounting.User(name=['Förnamn Efternamn'])
         self.org.accountants.add(newUser)
@@ -1774,6 +1940,88 @@ class TestTransaction(BLMTests):
                           {'text': 'baz', 'org': str(self.org.id[0])},
                           {'text': 'foo', 'org': str(self.org.id[0])}]
 
+    def test_transactionIndex_prefix(self):
+        account = blm.accounting.Account(number=['9999'],
+                                         accounting=[self.accounting])
+
+        for text in ('Foo', 'foobar', 'foobar', 'bar', 'foobaz', 'foobaz',
+                     'foobaz'):
+            blm.accounting.Transaction(account=account, verification=[self.ver],
+                                       version=self.ver.version, text=[text])
+        self.commit()
+        org, = blm.accounting.Org._query(id=self.org.id).run()
+        org.updateTransactionIndex([time.time() + 1])
+        blm.accounting.Transaction(account=account, verification=[self.ver],
+                                   version=self.ver.version, text=['foonew'])
+        self.commit()
+
+        orgid = str(self.org.id[0])
+        direct_query = {'filter': [{'property': 'org', 'value': orgid}],
+                        'query': 'FOO', 'limit': 2}
+        result = blm.accounting.transactionIndex([direct_query])
+        assert result == [{'text': 'foobaz', 'org': orgid},
+                          {'text': 'foobar', 'org': orgid}]
+
+        # texts used since the index was updated come last
+        del direct_query['limit']
+        result = blm.accounting.transactionIndex([direct_query])
+        assert [r['text'] for r in result] == ['foobaz', 'foobar', 'Foo',
+                                               'foonew']
+
+    def test_transaction_text_index(self):
+        account = blm.accounting.Account(number=['9999'],
+                                         accounting=[self.accounting])
+        t1 = blm.accounting.Transaction(account=account, verification=[self.ver],
+                                        version=self.ver.version, text=['foo'])
+        t2 = blm.accounting.Transaction(account=account, verification=[self.ver],
+                                        version=self.ver.version, text=['foo'])
+        self.commit()
+
+        def index():
+            return dict((toi.text[0], toi.count[0]) for toi in
+                        blm.accounting.TransactionText._query(
+                            org=self.org).run())
+
+        def update():
+            org, = blm.accounting.Org._query(id=self.org.id).run()
+            org.updateTransactionIndex([time.time() + 1])
+            self.commit()
+            self.database.staletexts.delete_many({})
+
+        # transactions only mark their texts as stale
+        assert index() == {}
+        assert blm.accounting.TransactionText.stale(self.org) == {'foo'}
+        update()
+        assert index() == {'foo': 2}
+
+        t1, t2 = blm.accounting.Transaction._query(id=[t1.id[0], t2.id[0]]).run()
+        t1(text=['bar'])
+        self.commit()
+        assert blm.accounting.TransactionText.stale(self.org) == {'foo', 'bar'}
+        update()
+        assert index() == {'foo': 1, 'bar': 1}
+
+        t2, = blm.accounting.Transaction._query(id=t2.id).run()
+        t2._delete()
+        self.commit()
+        # only texts marked before the given time are recounted
+        org, = blm.accounting.Org._query(id=self.org.id).run()
+        org.updateTransactionIndex([time.time() - 60])
+        self.commit()
+        assert index() == {'foo': 1, 'bar': 1}
+        update()
+        assert index() == {'bar': 1}
+
+        for toi in blm.accounting.TransactionText._query().run():
+            toi._delete()
+        self.commit()
+        assert index() == {}
+
+        org, = blm.accounting.Org._query(id=self.org.id).run()
+        org.rebuildTransactionIndex()
+        self.commit()
+        assert index() == {'bar': 1}
+
     def test_strip_text(self):
         account = blm.accounting.Account(number=['9999'],
                                          accounting=[self.accounting])
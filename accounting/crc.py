@@ -14,24 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# This is the SIE checksum calculation as translated from the C
-# implementation in the standards document
+# This is the SIE checksum calculation from the standards document,
+# which is the same CRC-32 as zlib's
 
-CRC32_POLYNOMIAL = 0xedb88320
+import zlib
 
-CRCTable = []
-
-# Denna rutin skall anropas för att initiera lookup-tabellen
-# innan beräkningen påbörjas
-
-for i in range(256):
-    crc = i
-    for j in range(8):
-        if crc & 1:
-            crc = ( crc >> 1 ) ^ CRC32_POLYNOMIAL
-        else:
-            crc >>= 1
-    CRCTable.append(crc)
 
 class Crc(object):
     def __init__(self):
@@ -40,17 +27,9 @@ class Crc(object):
     # Denna rutin anropas för varje textdel som ska ingå
     # i kontrollsumman
     def crc(self, buffer):
-        #print '"'+buffer+'"'
-        for c in buffer:
-            try:
-                c = ord(c)  # python 2
-            except TypeError:
-                pass  # python 3
-            temp1 = ( self.crc_value >> 8 ) & 0x00ffffff
-            temp2 = CRCTable[ (self.crc_value ^ c) & 0xff ]
-            self.crc_value = temp1 ^ temp2
-        #with open('apa', 'a') as fp:
-        #    fp.write('%x %s\n' % (self.crc_value, buffer))
+        # zlib works on the post-conditioned value
+        crc = zlib.crc32(buffer, self.crc_value ^ 0xffffffff)
+        self.crc_value = (crc ^ 0xffffffff) & 0xffffffff
 
     def reset(self):
         self.crc_value = 0xffffffff
@@ -192,9 +192,23 @@ class Router(object):
             # find first sorter, or None
             sort = reduce(lambda x, y: x, params.get('sort', []) + [None])
 
+            # ExtJS proxies send start/limit by default, so paging
+            # must be asked for explicitly to not truncate old grids:
+            # a paging grid sets extraParams: {paging: true} on its
+            # proxy, and gets the total along with the page. With
+            # count, only the total is returned.
+            paged = params.get('paging', False) or params.get('count', False)
+
             query = toc._query(**query_params)
 
-            if sort and sort['property'] != 'id':
+            if paged:
+                # Only fetch what is needed to find the page, the
+                # requested attributes are loaded for that page below.
+                if sort and sort['property'] != 'id':
+                    query.attrList = [sort['property']]
+                else:
+                    query.attrList = []
+            elif sort and sort['property'] != 'id':
                 query.attrList = params['attributes'] + [sort['property']]
             else:
                 query.attrList = params['attributes']
@@ -209,10 +223,28 @@ class Router(object):
 
                 tois.sort(key=key, reverse=sort['direction'] == 'DESC')
 
+            if paged:
+                total = len(tois)
+                if params.get('count', False):
+                    return {'success': success, 'total': total}
+                start = int(params.get('start') or 0)
+                limit = int(params.get('limit') or 0)
+                if limit > 0:
+                    tois = tois[start:start + limit]
+                else:
+                    tois = tois[start:]
+                if (tois and params['attributes'] and
+                    not params.get('polymorph', False)):
+                    query = toc._query(id=[toi.id[0] for toi in tois])
+                    query.attrList = params['attributes']
+                    query.run()
+
             for toi in tois:
                 result.append(self._get_toidata(toi, params['attributes'],
                                                 params.get('polymorph', False)))
 
+        if paged:
+            return {'success': success, 'tois': result, 'total': total}
         return {'success': success, 'tois': result}
 
     def do_update(self, blmname, tocname, params):
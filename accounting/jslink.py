@@ -17,9 +17,12 @@ log = logging.getLogger(__name__)
 
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
+import contextlib
 import os
+import threading
 import time
 import uuid
+import pymongo.errors
 import simplejson
 import werkzeug
 import flask
@@ -40,6 +43,119 @@ def simpleResponse(code, stream):
     return werkzeug.Response(response=stream, status=code)
 
 
+class Notifier(object):
+    """
+    Wakes up long polling clients when one of their links is outdated
+    or they are sent updates.
+
+    The commit handler marks links as outdated in the database, so
+    this watches a MongoDB change stream in a background thread, one
+    per process and database. Change streams need a replica set;
+    without one, or if the stream fails, long polls are answered
+    right away like ordinary polls.
+    """
+
+    _notifiers = {}
+    _lock = threading.Lock()
+
+    # Updates are matched on what they change, so that the documents
+    # don't have to be looked up. Polls empty the updates of a client,
+    # which wakes nobody.
+    pipeline = [
+        {'$match': {'$or': [
+            {'operationType': 'update', 'ns.coll': 'links',
+             'updateDescription.updatedFields.outdatedBy': {'$exists': True,
+                                                            '$ne': None}},
+            {'operationType': 'update', 'ns.coll': 'clients',
+             'updateDescription.updatedFields.updates': {'$ne': []}},
+            {'operationType': 'replace', 'ns.coll': 'links',
+             'fullDocument.outdatedBy': {'$ne': None}},
+            {'operationType': 'replace', 'ns.coll': 'clients',
+             'fullDocument.updates': {'$ne': []}}]}},
+        {'$project': {'ns.coll': 1, 'documentKey': 1,
+                      'fullDocument.client': 1}},
+    ]
+
+    @classmethod
+    def get(cls, database):
+        with cls._lock:
+            try:
+                return cls._notifiers[database.name]
+            except KeyError:
+                notifier = cls._notifiers[database.name] = cls(database)
+                return notifier
+
+    def __init__(self, database):
+        self.database = database
+        self.available = True
+        self.listeners = {}  # clientId -> set of threading.Event
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @contextlib.contextmanager
+    def listen(self, clientId):
+        """
+        Yield an Event that is set when clientId may have something
+        to poll, or None if notification is unavailable.
+        """
+        event = None
+        with self.lock:
+            if self.available:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run,
+                                                   name='jslink-notifier')
+                    self.thread.daemon = True
+                    self.thread.start()
+                event = threading.Event()
+                self.listeners.setdefault(clientId, set()).add(event)
+        if event is None:
+            yield None
+            return
+        try:
+            yield event
+        finally:
+            with self.lock:
+                events = self.listeners.get(clientId, set())
+                events.discard(event)
+                if not events:
+                    self.listeners.pop(clientId, None)
+
+    def notify(self, clientId):
+        with self.lock:
+            for event in self.listeners.get(clientId, ()):
+                event.set()
+
+    def dispatch(self, change):
+        if change['ns']['coll'] == 'links':
+            with self.lock:
+                if not self.listeners:
+                    return
+            link = change.get('fullDocument')
+            if link is None:
+                link = mongo.find_one(self.database.links,
+                                      {'_id': change['documentKey']['_id']},
+                                      projection=['client'])
+            if link is not None:
+                self.notify(link['client'])
+        else:
+            self.notify(change['documentKey']['_id'])
+
+    def run(self):
+        try:
+            with self.database.watch(self.pipeline) as stream:
+                for change in stream:
+                    self.dispatch(change)
+        except pymongo.errors.PyMongoError:
+            log.exception('Change stream failed, long polling disabled')
+        with self.lock:
+            self.available = False
+            self.thread = None
+            # let everybody fall back to polling
+            for events in self.listeners.values():
+                for event in events:
+                    event.set()
+
+
 class JsLink(object):
     """
     resource to create python endpoint for JsLink callback system
@@ -47,14 +163,18 @@ class JsLink(object):
     version = 2
     TOUCH_INTERVAL = 60 * 60
 
-    def __init__(self, linkFactory, registerClient=None, logout=None):
+    def __init__(self, linkFactory, registerClient=None, logout=None,
+                 longPoll=0):
         """
         linkFactory - factory function which takes the request and returns
                       a Link subclass
+        longPoll - seconds a poll may block waiting for updates, sent to
+                   the clients on handshake. 0 disables long polling.
         """
         self.linkFactory = linkFactory
         self.registerClient = registerClient
         self.logout = logout
+        self.longPoll = longPoll
 
     @property
     def database(self):
@@ -99,11 +219,30 @@ class JsLink(object):
             'type' : 'handshake',
             'version' : self.version,
             'clientId' : str(clientId),
+            'longPoll': self.longPoll,
             'extraInfo': {}
             }
 
     def _msg_poll(self, clientId, msg, request):
+        """
+        Return pending updates for the client.
+
+        If msg has a 'wait' (seconds, at most self.longPoll), block
+        until there are updates, or the time is up, instead of
+        returning nothing.
+        """
         log.debug('client poll %s', clientId)
+        wait = min(msg.get('wait') or 0, self.longPoll)
+        if not wait:
+            return self._poll(clientId)
+
+        with Notifier.get(self.database).listen(clientId) as event:
+            updates = self._poll(clientId)
+            if not updates and event is not None and event.wait(wait):
+                updates = self._poll(clientId)
+            return updates
+
+    def _poll(self, clientId):
         updated_or_outdated = False
         for link in self.linkFactory.iter({'client': clientId,
                                            'outdatedBy': {'$ne': None}}):
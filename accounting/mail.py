@@ -15,9 +15,15 @@
 from email.header import Header
 from email.mime.text import MIMEText
 from email.utils import getaddresses, formataddr
+import multiprocessing
 import os
 import re
+import smtplib
+import socket
+import time
 import dkim
+from pytransact.contextbroker import ContextBroker
+from pytransact import mongo
 from . import smtppipe
 import accounting.config
 log = accounting.config.getLogger('mail')
@@ -65,9 +71,7 @@ def makemail(body, bcc='', envfrom='<>', **headers):
     return envfrom, all_recipients, msgtxt
 
 
-def sendmail(fromaddr, all_recipients, data, identity=None):
-    global dkim_key
-
+def filter_recipients(all_recipients):
     recipients_filter = accounting.config.config.get('accounting', 'smtp_to_filter')
     filtered_recipients = []
     for recipient in all_recipients:
@@ -75,11 +79,15 @@ def sendmail(fromaddr, all_recipients, data, identity=None):
             log.warn('Not sending to %s', recipient)
         else:
             filtered_recipients.append(recipient)
+    return filtered_recipients
 
-    if not filtered_recipients:
-        return
 
-    # DKIM sign
+def sign(data, identity=None):
+    """
+    Return data, DKIM signed for identity at smtp_domain.
+    """
+    global dkim_key
+
     if dkim_key is None:
         with open(
             os.path.join(
@@ -98,15 +106,242 @@ def sendmail(fromaddr, all_recipients, data, identity=None):
         identity=py23txt('{}@{}'.format(identity, smtp_domain)),
         canonicalize=(b'relaxed', b'simple'))
     dkim_sig = b'\n'.join(dkim_sig.split(b'\r\n')) # fix newlines
+    return dkim_sig + py23txt(data)
+
+
+def _sign(args):
+    # Pool.map() only passes one argument
+    return sign(*args)
 
+
+def qualify(fromaddr):
+    smtp_domain = accounting.config.config.get('accounting', 'smtp_domain')
     if fromaddr and fromaddr != '<>' and '@' not in fromaddr:
         fromaddr = '{}@{}'.format(fromaddr, smtp_domain)
+    return fromaddr
+
+
+def sendmail(fromaddr, all_recipients, data, identity=None):
+    filtered_recipients = filter_recipients(all_recipients)
+    if not filtered_recipients:
+        return
 
     s = smtppipe.SMTP(accounting.config.config.get('accounting', 'smtp_command'))
-    s.sendmail(fromaddr, filtered_recipients, dkim_sig + py23txt(data))
+    s.sendmail(qualify(fromaddr), filtered_recipients, sign(data, identity))
     s.quit()
 
 
+def enqueue(fromaddr, all_recipients, data, identity=None, database=None,
+            key=None, confirm=None):
+    """
+    Store a message in the outbox, to be delivered by an Outbox worker.
+
+    Takes the same arguments as sendmail(). If database is not given,
+    the database of the current context is used.
+
+    Messages queued from a commit should give both of:
+
+    key - a unique id for the message, so that a commit that is rerun
+          queues it only once
+    confirm - (toid, attrName, value) that the commit stores, so that
+              the message is only delivered if the commit succeeded;
+              with value None, attrName (a MongoDB path, like
+              'reminderEmailsSent.2') only has to exist
+    """
+    if database is None:
+        database = ContextBroker().context.database
+    now = time.time()
+    message = {
+        'fromaddr': fromaddr,
+        'recipients': list(all_recipients),
+        'data': data,
+        'identity': identity,
+        'state': 'pending',
+        'attempts': 0,
+        'created': now,
+        'next_attempt': now}
+    if confirm is not None:
+        toid, attr, value = confirm
+        message['confirm'] = {'toid': toid, 'attr': attr, 'value': value}
+    if key is None:
+        return mongo.insert(database.outbox, message)
+    mongo.update(database.outbox, {'_id': key}, {'$setOnInsert': message},
+                 upsert=True)
+    return key
+
+
+class Outbox(object):
+    """
+    Deliver messages stored with enqueue().
+
+    Messages are claimed in batches, signed by a pool of worker
+    processes and sent over a single SMTP session per batch. Messages
+    that fail temporarily are retried with exponential backoff, and
+    given up on (state 'failed') after max_attempts tries, or at once
+    if the server rejects them permanently. Claims held by a worker
+    that died are released after claim_timeout seconds. Messages
+    queued with 'confirm' are held back until their commit shows in
+    the database, and dropped if it doesn't within confirm_timeout.
+    """
+
+    claim_timeout = 15 * 60
+    confirm_timeout = 15 * 60
+
+    def __init__(self, database, batch=None, workers=None,
+                 max_attempts=None, retry_delay=None):
+        cfg = accounting.config.config
+        self.database = database
+        self.batch = batch or cfg.getint('outbox', 'batch')
+        if workers is None:
+            workers = cfg.getint('outbox', 'workers')
+        self.workers = workers
+        self.max_attempts = max_attempts or cfg.getint('outbox', 'max_attempts')
+        self.retry_delay = retry_delay or cfg.getint('outbox', 'retry_delay')
+        self._pool = None
+
+    def map(self, func, items):
+        if self.workers <= 1 or len(items) <= 1:
+            return list(map(func, items))
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+        return self._pool.map(func, items)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def claim(self):
+        now = time.time()
+        messages = []
+        while len(messages) < self.batch:
+            message = mongo.find_and_modify(
+                self.database.outbox,
+                {'$or': [{'state': 'pending', 'next_attempt': {'$lte': now}},
+                         {'state': 'sending',
+                          'claimed': {'$lt': now - self.claim_timeout}}]},
+                {'$set': {'state': 'sending', 'claimed': now},
+                 '$inc': {'attempts': 1}})
+            if message is None:
+                break
+            message['attempts'] += 1
+            messages.append(message)
+        return messages
+
+    def confirmed(self, message):
+        confirm = message.get('confirm')
+        if confirm is None:
+            return True
+        value = confirm['value']
+        if value is None:
+            value = {'$exists': True}
+        return mongo.find_one(self.database.tois,
+                              {'_id': confirm['toid'],
+                               confirm['attr']: value},
+                              projection=[]) is not None
+
+    def unconfirmed(self, message):
+        """
+        Hold back a message whose commit has not succeeded (yet), or
+        drop it if the commit should have finished long ago.
+        """
+        now = time.time()
+        if now - message['created'] > self.confirm_timeout:
+            log.info('Dropping outbox message %s, its commit failed',
+                     message['_id'])
+            update = {'state': 'cancelled'}
+        else:
+            update = {'state': 'pending',
+                      'next_attempt': now + self.retry_delay}
+        mongo.update(self.database.outbox, {'_id': message['_id']},
+                     {'$set': update, '$inc': {'attempts': -1}})
+
+    def sent(self, message):
+        mongo.update(self.database.outbox, {'_id': message['_id']},
+                     {'$set': {'state': 'sent', 'sent': time.time()},
+                      '$unset': {'data': ''}})
+
+    def failed(self, message, error, permanent=False):
+        update = {'error': str(error)}
+        if permanent or message['attempts'] >= self.max_attempts:
+            log.error('Giving up on outbox message %s: %s',
+                      message['_id'], error)
+            update['state'] = 'failed'
+        else:
+            delay = self.retry_delay * 2 ** (message['attempts'] - 1)
+            log.warn('Outbox message %s failed, retrying in %ds: %s',
+                     message['_id'], delay, error)
+            update['state'] = 'pending'
+            update['next_attempt'] = time.time() + delay
+        mongo.update(self.database.outbox, {'_id': message['_id']},
+                     {'$set': update})
+
+    def deliver(self):
+        """
+        Deliver one batch of messages. Return the number of messages
+        that were processed.
+        """
+        messages = self.claim()
+        if not messages:
+            return 0
+
+        outgoing = []
+        for message in messages:
+            if not self.confirmed(message):
+                self.unconfirmed(message)
+                continue
+            recipients = filter_recipients(message['recipients'])
+            if recipients:
+                outgoing.append((message, recipients))
+            else:
+                self.sent(message)
+
+        signed = self.map(_sign, [(message['data'], message['identity'])
+                                  for message, _ in outgoing])
+
+        smtp = None
+        for (message, recipients), data in zip(outgoing, signed):
+            try:
+                if smtp is None:
+                    smtp = smtppipe.SMTP(accounting.config.config.get(
+                        'accounting', 'smtp_command'))
+                refused = smtp.sendmail(qualify(message['fromaddr']),
+                                        recipients, data)
+            except smtplib.SMTPRecipientsRefused as e:
+                self.failed(message, e, permanent=all(
+                    code >= 500 for code, _ in e.recipients.values()))
+            except smtplib.SMTPResponseException as e:
+                self.failed(message, e, permanent=e.smtp_code >= 500)
+            except (smtplib.SMTPException, socket.error) as e:
+                # the session is probably broken, start a new one
+                self.failed(message, e)
+                smtp = None
+            else:
+                if refused:
+                    log.warn('Outbox message %s refused for %s',
+                             message['_id'], ', '.join(refused))
+                self.sent(message)
+
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        return len(messages)
+
+    def run(self, interval=None):
+        if interval is None:
+            interval = accounting.config.config.getint('outbox',
+                                                      'poll_interval')
+        try:
+            while True:
+                if not self.deliver():
+                    time.sleep(interval)
+        finally:
+            self.close()
+
+
 def makeAddressHeader(headerName, addrs):
     to = Header(charset='iso-8859-1', header_name=headerName)
     lastaddr = None
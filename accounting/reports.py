@@ -14,15 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
-import functools, re, time
+import functools, re, threading, time
 from flask import current_app, g, json, make_response, render_template, request
 import jinja2
 import os
 from pytransact.context import ReadonlyContext
 from pytransact import queryops
+from accounting import lang as accounting_lang
 import blm.accounting
 import bson
 
@@ -64,6 +65,9 @@ def absolute(d): # xxx could this be merged with negate_no_decimals?
         return d
 
 def get_timestamp():
+    placeholder = getattr(g, 'report_time', None)
+    if placeholder is not None:
+        return placeholder
     now = datetime.now()
     return now.strftime('%Y-%m-%d %H:%M')
 
@@ -76,6 +80,11 @@ Row = namedtuple('Row', 'number name opening_balance total')
 def make_sums(accounts, from_accno, to_accno, from_date=None, to_date=None):
 
     def process_account(account):
+        if hasattr(account, 'turnover'):
+            # blm.accounting.Account maintains monthly sums
+            opening_balance, total = account.turnover(from_date, to_date)
+            return Row(account.number, account.name, [opening_balance], [total])
+
         opening_balance = account.opening_balance[0]
         total = Decimal('0.00')
         for transaction in account.transactions:
@@ -134,14 +143,91 @@ def parse_range(s, npat=r'\d+'):
     return list(map(str, result))
 
 
+_static_files = {}
+
+def read_static(filename):
+    """
+    Return the contents of a file in the static directory.
+
+    The file is read once per process. If the jinja environment
+    reloads changed templates, changed static files are reread too.
+    """
+    path = os.path.join(static_dir, filename)
+    mtime, data = _static_files.get(path, (None, None))
+    if data is None or current_app.jinja_env.auto_reload:
+        current = os.path.getmtime(path)
+        if current != mtime:
+            with open(path, 'r') as f:
+                data = f.read()
+            _static_files[path] = current, data
+    return data
+
+
 def render_report_template(*args, **kw):
-    with open(os.path.join(static_dir, 'report.css'), 'r') as f:
-        css = f.read()
-    kw.setdefault('css', css)
+    kw.setdefault('css', read_static('report.css'))
     return render_template(*args, **kw)
 
 
-def report(filename):
+def setup_environment(env):
+    if getattr(env, 'report_setup', False):
+        return
+    env.filters['thousand_sep'] = thousand_sep
+    env.filters['negate_no_decimals'] = negate_no_decimals
+    env.filters['no_decimals'] = no_decimals
+    env.filters['timestamp2date'] = timestamp2date
+    env.globals['make_running_totals'] = RunningTotals
+    env.filters['abs'] = absolute
+    env.report_setup = True
+
+
+# Rendered reports, keyed on the accounting's ledger_revision, which
+# is bumped in the same commit as the changes it covers. The reports
+# are rendered with a placeholder for the time they were made, which
+# is filled in each time a report is served.
+report_cache = OrderedDict()
+report_cache_size = 32
+report_cache_lock = threading.Lock()
+TIME_PLACEHOLDER = u'\ue000time\ue000'
+
+
+def report_cache_key(func, kw):
+    q = blm.accounting.Accounting._query(id=kw['accounting'])
+    q.attrList = ['ledger_revision']
+    accounting = q.run()
+    if not accounting:
+        return None  # let the report deal with it
+    accounting, = accounting
+    return (func.__name__, accounting.id[0],
+            tuple(accounting.ledger_revision.value),
+            g.user.id[0] if g.user else None,
+            accounting_lang.get_language(request),
+            json.dumps(kw.get('filters', {}), sort_keys=True))
+
+
+def cached_report(func, kw):
+    key = report_cache_key(func, kw)
+    if key is None:
+        return func(**kw)
+    with report_cache_lock:
+        response = report_cache.pop(key, None)
+        if response is not None:
+            report_cache[key] = response
+    if response is None:
+        g.report_time = TIME_PLACEHOLDER
+        try:
+            response = func(**kw)
+        finally:
+            del g.report_time
+        # The revision was read before the ledger, so the report is at
+        # least as new as the key says
+        with report_cache_lock:
+            report_cache[key] = response
+            while len(report_cache) > report_cache_size:
+                report_cache.popitem(last=False)
+    return response.replace(TIME_PLACEHOLDER, get_timestamp())
+
+
+def report(filename, cache=False):
     """
     Decorator for report producing functions.
 
@@ -150,9 +236,14 @@ def report(filename):
      - Attach the correct Content-Disposition header in case the user
        is downloading the report as a file.
      - Set up a jinja environment with commonly used utility functions
+     - Optionally reuse a previously rendered report, as long as
+       nothing in the accounting has changed
 
     Arguments: filename - The filename of the downloaded version of
                           the report
+               cache - If true, the report function only depends on
+                       the ledger of its 'accounting' argument and
+                       the filters
     """
     # explodes if filename isn't ascii, which is the only thing we
     # support right now
@@ -162,13 +253,9 @@ def report(filename):
         @functools.wraps(func)
         def decorator(*args, **kw):
             env = current_app.jinja_env
-            env.filters['thousand_sep'] = thousand_sep
-            env.filters['negate_no_decimals'] = negate_no_decimals
-            env.filters['no_decimals'] = no_decimals
-            env.filters['timestamp2date'] = timestamp2date
-            env.globals['make_running_totals'] = RunningTotals
+            setup_environment(env)
+            # some reports replace this one
             env.globals['make_sums'] = make_sums
-            env.filters['abs'] = absolute
 
             if 'filters' in request.values:
                 kw.setdefault('filters', json.loads(request.values['filters']))
@@ -176,7 +263,10 @@ def report(filename):
             with ReadonlyContext(g.database, g.user) as ctx:
                 # maybe we should move the actual template rendering
                 # here too?
-                response = func(*args, **kw)
+                if cache and not args:
+                    response = cached_report(func, kw)
+                else:
+                    response = func(*args, **kw)
                 if request.args.get('mode') == 'download':
                     response = make_response(response)
                     response.headers['Content-Disposition'] = \
@@ -221,7 +311,7 @@ def route(app, requires_login):
 
 # reports
 
-@report('kontoplan.html')
+@report('kontoplan.html', cache=True)
 def kontoplan(accounting):
     accounting = blm.accounting.Accounting._query(id=accounting).run()
     report_result = blm.accounting.accounts_layout(accounting)
@@ -229,7 +319,7 @@ def kontoplan(accounting):
         time=get_timestamp(), result=report_result)
 
 
-@report('huvudbok.html')
+@report('huvudbok.html', cache=True)
 def huvudbok(accounting, filters={}):
     accounting = blm.accounting.Accounting._query(id=accounting).run()
     numbers = []
@@ -241,7 +331,7 @@ def huvudbok(accounting, filters={}):
         time=get_timestamp(), result=report_result)
 
 
-@report('balansrakning.html')
+@report('balansrakning.html', cache=True)
 def balance_report(accounting, filters={}):
     env = current_app.jinja_env
 
@@ -262,7 +352,7 @@ def balance_report(accounting, filters={}):
         acc=accounting[0], result=report_result)
 
 
-@report('resultatrakning.html')
+@report('resultatrakning.html', cache=True)
 def income_statement_report(accounting, filters={}):
     env = current_app.jinja_env
 
@@ -447,9 +537,7 @@ create logic for providing filter values when one or more are not provided by us
 
     def account_period_sum(account,  start_date, end_date):
         #sum transactions in given accountobject based on period dates
-        return sum((transaction.amount[0] for transaction in account.transactions
-                            if  start_date <= transaction.transaction_date[0] <= end_date),
-                            Decimal('0.00'))
+        return account.turnover(start_date, end_date)[1]
 
 
     for r in accounts:
@@ -755,12 +843,9 @@ def sales_report(toid):
     items = [item for item in items if (item.purchase and item.paid[0] and item.purchase[0].kind[0] != 'credit')]
     items.sort(key=lambda toi: toi.id[0])
 
-    with open(os.path.join(static_dir, 'sales_report.css'), 'r') as f:
-        sales_css = f.read()
-
     return render_report_template('sales_report.html', product=product,
                                   fields=fields, items=items,
-                                  sales_css=sales_css)
+                                  sales_css=read_static('sales_report.css'))
 
 
 @report('accountspayable_report.html')
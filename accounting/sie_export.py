@@ -26,69 +26,119 @@ try:
     basestring
 except NameError:
     basestring = str
+VERIFICATION_CHUNK_SIZE = 500
+
+verification_attrs = ['series', 'number', 'transaction_date', 'text',
+                      'registration_date', 'signature', 'transactions']
+transaction_attrs = ['account', 'transtype', 'amount', 'transaction_date',
+                     'text', 'quantity', 'signature']
+
+
 def sie_export(fp, acc):
     '''Takes a cp437 encoded file handle.'''
-    fp.write(u'#FLAGGA 0\n')
-    fp.write(print_program_name())
-    fp.write(print_format())
-    fp.write(print_gen())
-    fp.write(print_sietype())
+    for s in iter_sie_export(acc):
+        fp.write(s)
+
+
+def iter_sie_export(acc, chunksize=VERIFICATION_CHUNK_SIZE):
+    '''Generate the SIE file as unicode strings.
+
+    Verifications and their transactions are loaded in bulk for chunks
+    of verifications, and each chunk of #VER blocks is yielded as soon
+    as it is ready.'''
+    yield u'#FLAGGA 0\n'
+    yield print_program_name()
+    yield print_format()
+    yield print_gen()
+    yield print_sietype()
     " Skipping #PROSA"
-    fp.write(print_orgtype(acc))
-    fp.write(print_org_id(acc))
-    fp.write(print_orgnum(acc))
-    fp.write(print_industry_code(acc))
-    fp.write(print_address(acc))
-    fp.write(print_orgname(acc))
-    fp.write(print_accounting_year(acc))
+    yield print_orgtype(acc)
+    yield print_org_id(acc)
+    yield print_orgnum(acc)
+    yield print_industry_code(acc)
+    yield print_address(acc)
+    yield print_orgname(acc)
+    yield print_accounting_year(acc)
     for year in acc.years.keys():
         if year != '0':
-            fp.write(print_prev_accounting_year(year,
-                acc.years[year][0], acc.years[year][1]))
-    fp.write(print_taxation_year(acc))
+            yield print_prev_accounting_year(year,
+                acc.years[year][0], acc.years[year][1])
+    yield print_taxation_year(acc)
     # Skipping #OMFATTN
-    fp.write(print_layout(acc))
-    fp.write(print_currency(acc))
+    yield print_layout(acc)
+    yield print_currency(acc)
 
     # Defining accounts, dimensions and objects
     q = accounting.Account._query(accounting=acc)
     q.attrList = ['number', 'name', 'type', 'unit', 'sru', 'account_balances']
     accounts = sorted(q.run(), key=lambda acc: acc.number[0]) 
     for account in accounts:
-        fp.write(print_account(account))
-        fp.write(print_account_type(account))
+        yield print_account(account)
+        yield print_account_type(account)
         if len(account.unit):
-            fp.write(print_unit(account))
+            yield print_unit(account)
         if len(account.sru):
-            fp.write(print_sru(account))
+            yield print_sru(account)
     dims = sorted(accounting.Dimension._query(accounting=acc).run(),
                   key=lambda dim: dim.number[0])
+    objects = {}
+    if dims:
+        for obj in accounting.AccountingObject._query(dimension=dims).run():
+            objects.setdefault(obj.dimension[0], []).append(obj)
     for dim in dims:
         if len(dim.subdim_of) == 0:
-            fp.write(print_dim(dim))
+            yield print_dim(dim)
         else:
-            fp.write(print_subdim(dim))
-        for obj in accounting.AccountingObject._query(dimension=dim).run():
-            fp.write(print_accounting_object(obj))
+            yield print_subdim(dim)
+        for obj in objects.get(dim, []):
+            yield print_accounting_object(obj)
 
     # Setting opening balances etc
     for account in accounts:
         for bal in account.account_balances.value.values():
             if account.type[0] in ['T', 'S']:
-                fp.write(print_opening_balance(account.number[0], bal))
-                fp.write(print_closing_balance(account.number[0], bal))
+                yield print_opening_balance(account.number[0], bal)
+                yield print_closing_balance(account.number[0], bal)
             else:
-                fp.write(print_turnover(account.number[0], bal))
+                yield print_turnover(account.number[0], bal)
     
     # Skipping object balances for now
     # Skipping period balances and period budgets for now
 
-    for ver in blm.accounting.Verification._query(accounting=acc).run():
-        fp.write(print_verification(ver))
-        fp.write(u'{\n')
+    # preload series names, the account numbers are loaded above
+    q = accounting.VerificationSeries._query(accounting=acc)
+    q.attrList = ['name']
+    q.run()
+
+    # Everything is read in the caller's context, so that the file is
+    # a consistent snapshot. Only the verification ids are queried up
+    # front; the verifications and their transactions are loaded a
+    # chunk at a time.
+    q = blm.accounting.Verification._query(accounting=acc)
+    q.attrList = []
+    toids = [ver.id[0] for ver in q.run()]
+
+    for i in range(0, len(toids), chunksize):
+        yield _export_verifications(toids[i:i + chunksize])
+
+
+def _export_verifications(toids):
+    q = blm.accounting.Verification._query(id=toids)
+    q.attrList = verification_attrs
+    verifications = dict((ver.id[0], ver) for ver in q.run())
+    q = blm.accounting.Transaction._query(verification=toids)
+    q.attrList = transaction_attrs
+    q.run()
+
+    out = []
+    for toid in toids:
+        ver = verifications[toid]
+        out.append(print_verification(ver))
+        out.append(u'{\n')
         for trans in ver.transactions:
-            fp.write(print_transaction(trans))
-        fp.write(u'}\n')
+            out.append(print_transaction(trans))
+        out.append(u'}\n')
+    return u''.join(out)
 
 def remove_dashes_from_date(date):
     date_list = date.split("-")
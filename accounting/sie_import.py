@@ -24,6 +24,8 @@ else:
 import copy
 
 import os
+import re
+import time
 from datetime import datetime
 from decimal import Decimal
 
@@ -31,6 +33,7 @@ from .crc import Crc
 import logging
 from accounting import db
 from pytransact import blm, commit
+import pytransact.runtime as ri
 from blm import fundamental, accounting
 
 try:
@@ -47,6 +50,7 @@ class SIEImporter(object):
     '''
 
     ignoretransactions = True
+    progress_interval = 10000  # lines
 
     def __init__(self, org=[], mapping=None):
         # All the attributes are saved in codepage 437 encoding, which is
@@ -61,6 +65,8 @@ class SIEImporter(object):
         self.program = None
         self.org = list(org)
         self.mapping = mapping
+        self.rows = 0
+        self.elapsed = 0
         logging.basicConfig(format='%(asctime)s %(message)s',
                             level=logging.INFO)
 
@@ -83,23 +89,74 @@ class SIEImporter(object):
         if lines[-1][-1] != b'\n':
            lines[-1] = lines[-1] + b'\n'
 
-        CRCCalculatingParser(lines)  # raises exception on checksum mismatch
+        crc = start_checksum(lines)  # raises exception on bad #FLAGGA
+        last = len(lines)
 
-        self.accounting = accounting.Accounting(org=self.org, imported=[True])
-        self.accounting.ignoretransactions = self.ignoretransactions
+        # The accounting is given to the parser once the file has been
+        # tokenized and its checksum verified, so that nothing is
+        # created from a corrupt file.
         if not self.mapping:
-            p = Parser(self.accounting)
+            p = Parser(None)
         else:
             from . import remapping_sie_import
-            p = remapping_sie_import.RemappingParser(self.accounting, self.mapping)
+            p = remapping_sie_import.RemappingParser(None, self.mapping)
+
+        start = time.time()
+        parsed = []
         for n, line in enumerate(lines[1:], 2):
             try:
-                p.parse(line, n)
+                record = p.tokenize(line, n)
             except DoneException:
-                pass
+                continue
             except Exception:
                 print('Error on line %d' % n)
                 raise
+            if record is None:
+                continue
+            label, params, crcdata = record
+            if crc is not None and 2 < n < last:
+                # the checksum covers everything between the
+                # opening and closing #KSUMMA
+                crc.crc(b''.join(crcdata))
+            parsed.append((n, label, params))
+        if crc is not None:
+            check_checksum(crc, lines[-1])
+
+        self.accounting = accounting.Accounting(org=self.org, imported=[True])
+        self.accounting.ignoretransactions = self.ignoretransactions
+        p.acc = self.accounting
+
+        # Balances and the transaction text index are updated in one
+        # pass when all transactions have been created, rather than
+        # once per transaction.
+        delay = {accounting.Account.updateBalance.DELAY: set(),
+                 accounting.AccountingObject.updateBalance.DELAY: set(),
+                 accounting.TransactionText.DELAY: set()}
+        with ri.cache.set(delay) as cache:
+            for n, label, params in parsed:
+                try:
+                    p.apply(label, params, n)
+                except Exception:
+                    print('Error on line %d' % n)
+                    raise
+                if n % self.progress_interval == 0:
+                    logging.info(u'{}: {} of {} lines, {:.0f} lines/s'.format(
+                        filename, n, len(lines), n / (time.time() - start)))
+            accounts = cache[accounting.Account.updateBalance.DELAY]
+            objects = cache[accounting.AccountingObject.updateBalance.DELAY]
+            texts = cache[accounting.TransactionText.DELAY]
+
+        for account in accounts:
+            account.updateBalance()
+        for accounting_object, account in objects:
+            accounting_object.updateAccountBalance(account)
+        accounting.TransactionText.mark(texts)
+
+        self.rows = len(lines)
+        self.elapsed = time.time() - start
+        logging.info(u'{}: {} lines in {:.1f} s, {:.0f} lines/s'.format(
+            filename, self.rows, self.elapsed,
+            self.rows / max(self.elapsed, 1e-6)))
         # If self.flag is None, we have a format error
         # If self.flag is True, whe have already read the file - skip
         if p.parse_warnings:
@@ -116,7 +173,7 @@ class DoneException(Exception):
 class MultipleFlagException(Exception):
     pass
 
-class ChecksumError(Exception):
+class ChecksumError(ValueError):
     pass
 
 class UnsupportedSIEVersion(ValueError):
@@ -132,6 +189,9 @@ label_chars = b'#ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 digits = b'1234567890'
 
 class BaseParser(object):
+    # The original character by character parser. Parser uses
+    # RecordTokenizer instead, this is kept as the reference that the
+    # tokenizer is tested against.
 
     def getc(self, offset=0):
         try:
@@ -328,71 +388,198 @@ class BaseParser(object):
                         params.append('%s-%s-%s' % (s[:4], s[4:6], s[6:]))
         return params
 
-class CRCCalculatingParser(BaseParser):
-    def __init__(self, lines):
-        self.lines = lines
-        self.s = self.lines[0]
-        self.pos = 0
-        BPcl=BaseParser.consume_label(self)
-        if BPcl == b'#FLAGGA':
-            flag = BaseParser.consume_string(self)
-            if flag != b'0':
-                raise ValueError
-        else:
-            # File not to be read
-            raise ValueError
-
-        if not self.lines[1].startswith(b'#KSUMMA'):
-            self.result = True # No checksum. Assume file is ok
-            return
-
-        self.crc = Crc()
-        for line in lines[2:-1]:
-            self.parse(line)
-
-        crc = self.crc.finalize()
-        self.s = self.lines[-1]
-        self.pos = 0
-        BPcl=BaseParser.consume_label(self)
-        if BPcl == b'#KSUMMA':
-            checksum = BaseParser.consume_string(self)
-            if crc == int(checksum):
-                self.result = True
-                return
+def start_checksum(lines):
+    """Check the #FLAGGA line, and return a Crc to accumulate the
+    checksum into if the file has a #KSUMMA, else None."""
+    try:
+        record = RecordTokenizer().tokenize(lines[0],
+                                            {b'#FLAGGA': ('T', None)})
+    except (KeyError, DoneException):
+        record = None
+    if record is None or record[1] != [b'0']:
+        # File not to be read
         raise ValueError
+    if len(lines) > 1 and lines[1].startswith(b'#KSUMMA'):
+        return Crc()
+    return None
+
+
+def check_checksum(crc, line):
+    """Compare the accumulated checksum to the closing #KSUMMA."""
+    try:
+        record = RecordTokenizer().tokenize(line, {b'#KSUMMA': ('T', None)})
+    except (KeyError, DoneException):
+        record = None
+    if record is None or crc.finalize() != int(record[1][0] or -1):
+        raise ChecksumError(line)
+
+
+_ws = re.compile(b'[ \t\f]*')
+_label = re.compile(b'[#A-Z]*')
+_text = re.compile(b'[^ \t\f\n\r]*')
+_numeric = re.compile(b'[^ \t\f\n\r{]*')
+_object = re.compile(b'[^ \t\f}]*')
+_control = re.compile(b'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+_newline = b'\n\r'
+_quote, _backslash, _startcurly, _endcurly, _hash = b'"\\{}#'
+if not PYT3:
+    _quote, _backslash, _startcurly, _endcurly, _hash = '"\\{}#'
+
+_formats = {}
+
+
+class RecordTokenizer(object):
+    """
+    Split an SIE record line into its fields in a single scan.
+
+    tokenize() returns the label, the parameters converted the same
+    way as BaseParser.read_record() and the bytes that go into the
+    KSUMMA checksum, so the checksum and the record can be computed
+    from the same pass over the line.
+    """
+
+    def __init__(self, encoding=None):
+        self.encoding = encoding
+
+    def tokenize(self, line, records):
+        """Return (label, params, crcdata), or None for lines that are
+        not records."""
+        end = len(line)
+        pos = _ws.match(line).end()
+        if pos >= end:
+            raise DoneException
+        if line[pos] != _hash:
+            self._check(line, pos)
+            return None
+        p = pos
+        pos = _label.match(line, pos).end()
+        label = line[p:pos]
+        pos = self._whitespace(line, pos)
 
-    def parse(self, line):
-        self.s = line
-        self.pos = 0
-        c = self.consume_whitespace()
-        if c == b'#':
-            label = self.consume_label()
-            fmt = records[label][0]
-            self.read_record(fmt)
+        try:
+            fmt = _formats[records[label][0]]
+        except KeyError:
+            fmt = _formats[records[label][0]] = tuple(
+                param for param in records[label][0].split(' ') if param)
 
-    def get_crc32(self):
-        return self.crc.finalize()
+        crcdata = [label]
+        params = []
+        for param in fmt:
+            optional = param[0] == '['
+            if optional:
+                if line[pos:pos + 1] in (b'\n', b'\r'):
+                    continue
+                param = param[1:-1]
+            if param == 'L':
+                value, pos = self._object_list(line, pos)
+                crcdata.extend(value)
+                if self.encoding:
+                    value = [o.decode(self.encoding) for o in value]
+                params.append(value)
+                continue
+            if param == 'T*':
+                value, pos = self._numeric(line, pos)
+            else:
+                value, pos = self._string(line, pos)
+            crcdata.append(value)
+            if param in ('T', 'T*'):
+                if self.encoding:
+                    value = value.decode(self.encoding)
+            elif param == 'N':
+                value = Decimal(value.decode('ascii')) if value else Decimal(0)
+            elif param == 'D':
+                if value or not optional:
+                    value = value.decode('ascii')
+                    value = '%s-%s-%s' % (value[:4], value[4:6], value[6:])
+                else:
+                    value = None
+            elif param == 'I':
+                value = int(value) if value else -1
+            params.append(value)
 
-    def consume_label(self):
-        s = BaseParser.consume_label(self)
-        self.crc.crc(s)
-        return s
+        self._check(line, pos)
+        return label, params, crcdata
 
-    def consume_string(self):
-        s = BaseParser.consume_string(self)
-        self.crc.crc(s)
-        return s
+    def _check(self, line, pos):
+        # BaseParser.getc() refuses control characters in the part of
+        # the line that it reads
+        if _control.search(line, 0, pos + 1):
+            raise ValueError(line)
 
-    def consume_numeric(self):
-        s = BaseParser.consume_numeric(self)
-        self.crc.crc(s)
-        return s
+    def _whitespace(self, line, pos):
+        pos = _ws.match(line, pos).end()
+        if pos >= len(line):
+            raise DoneException
+        return pos
+
+    def _quoted(self, line, pos):
+        # pos is just after the opening quote
+        p = pos
+        while True:
+            pos = line.find(b'"', pos)
+            if pos == -1:
+                raise DoneException
+            if pos > p and line[pos - 1] == _backslash:
+                pos += 1
+                continue
+            return line[p:pos].replace(b'\\"', b'"'), pos + 1
+
+    def _string(self, line, pos):
+        if line[pos] == _quote:
+            value, pos = self._quoted(line, pos + 1)
+        else:
+            p = pos
+            pos = _text.match(line, pos).end()
+            value = line[p:pos]
+        return value, self._whitespace(line, pos)
+
+    def _numeric(self, line, pos):
+        if line[pos] == _quote:
+            p = pos + 1
+            pos = line.find(b'"', p)
+            if pos == -1:
+                raise DoneException
+            value = line[p:pos]
+            if not value.isdigit() and value:
+                raise ValueError(value)
+            pos += 1
+        else:
+            p = pos
+            pos = _numeric.match(line, pos).end()
+            value = line[p:pos]
+        return value, self._whitespace(line, pos)
+
+    def _object_list(self, line, pos):
+        if line[pos] != _startcurly:
+            raise ValueError(line[pos:pos + 1])
+        pos = self._whitespace(line, pos + 1)
+        objects = []
+        end = len(line)
+        while True:
+            if line[pos] == _endcurly:
+                pos += 1
+                break
+            if line[pos] == _quote:
+                value, pos = self._quoted(line, pos + 1)
+            else:
+                p = pos
+                while True:
+                    pos = _object.match(line, pos).end()
+                    if pos >= end:
+                        raise DoneException
+                    if (line[pos] == _endcurly and
+                        line[pos + 1:pos + 2] == b'}'):
+                        pos += 1
+                        continue
+                    break
+                value = line[p:pos]
+            objects.append(value)
+            pos = self._whitespace(line, pos)
+        pos = self._whitespace(line, pos)
+        if len(objects) % 2 != 0:
+            raise ValueError(objects)
+        return objects, pos
 
-    def consume_object_list(self):
-        objects = BaseParser.consume_object_list(self)
-        for o in objects:
-            self.crc.crc(o)
-        return objects
 
 class Codepage437TranslatingParser(BaseParser):
     def consume_string(self):
@@ -407,7 +594,7 @@ class Codepage437TranslatingParser(BaseParser):
         objects = BaseParser.consume_object_list(self)
         return [o.decode('cp437') for o in objects]
 
-class Parser(Codepage437TranslatingParser):
+class Parser(object):
     def __init__(self, acc):
         self.acc = acc
         self.added_trans = False
@@ -417,18 +604,27 @@ class Parser(Codepage437TranslatingParser):
         self.parse_warnings = []
         self.records = records # Makes Parser inheritable
         self.lineno = -1
+        self.tokenizer = RecordTokenizer('cp437')
 
     def parse(self, line, lineno=-1):
-        self.s = line
+        """Parse and apply one line, and return the data that goes
+        into the KSUMMA checksum."""
+        record = self.tokenize(line, lineno)
+        if record is not None:
+            label, params, crcdata = record
+            self.apply(label, params, lineno)
+            return crcdata
+
+    def tokenize(self, line, lineno=-1):
+        """Return (label, params, crcdata) of one line, or None if
+        it has no record."""
+        self.lineno = lineno
+        return self.tokenizer.tokenize(line, self.records)
+
+    def apply(self, label, params, lineno=-1):
+        """Apply a record returned by tokenize()."""
         self.lineno = lineno
-        self.pos = 0
-        c = self.consume_whitespace()
-        if c == b'#':
-            label = self.consume_label()
-            format = self.records[label][0]
-            method = self.records[label][1]
-            params = self.read_record(format)
-            method(self, *params)
+        self.records[label][1](self, *params)
 
     def get_account(self, number):
         try:
@@ -73,17 +73,52 @@ formatters.all = [s for s in dir(formatters) if not (s.startswith('__') or s ==
                 #filter(lambda s: not (s.startswith('__') or s == 'apply'),
                         # #dir(formatters))
 
-def render_template(template, *args, **kw):
-    if os.path.exists(template):
-        def load_template(template):
-            with open(template, 'r') as f:
-                return f.read()
+# Environments are kept for the life of the process, so that compiled
+# templates are cached (and checked for changes on disk) rather than
+# compiled for each rendering. Compiled code is also shared between
+# processes through a bytecode cache.
+
+_environments = {}
+_bytecode_cache = jinja2.FileSystemBytecodeCache()
+
+
+def load_template(template):
+    with open(template, 'r') as f:
+        source = f.read()
+    mtime = os.path.getmtime(template)
+    return source, template, lambda: os.path.getmtime(template) == mtime
+
+
+def get_environment(template_dir=None):
+    """
+    Return the environment for templates in template_dir, or for
+    templates given by path if template_dir is None.
+    """
+    try:
+        return _environments[template_dir]
+    except KeyError:
+        pass
+    if template_dir is None:
         loader = jinja2.FunctionLoader(load_template)
     else:
-        loader = jinja2.FileSystemLoader(config.template_dir)
-
-    env = jinja2.Environment(loader=loader)
+        loader = jinja2.FileSystemLoader(template_dir)
+    env = jinja2.Environment(loader=loader, bytecode_cache=_bytecode_cache)
     formatters.apply(env, *formatters.all)
+    return _environments.setdefault(template_dir, env)
+
+
+def precompile(prefix='email/'):
+    """Compile all templates starting with prefix ahead of time."""
+    env = get_environment(config.template_dir)
+    for name in env.list_templates(filter_func=lambda n: n.startswith(prefix)):
+        env.get_template(name)
+
+
+def render_template(template, *args, **kw):
+    if os.path.exists(template):
+        env = get_environment(None)
+    else:
+        env = get_environment(config.template_dir)
     template = env.get_template(template)
     return template.render(*args, **kw)
 
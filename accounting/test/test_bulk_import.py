@@ -71,3 +71,5 @@ class TestBulkImport(BLMTests):
         assert blm.accounting.Accounting._query().run() == [importer.accounting]
 
         print(repr(filename), 'took %s seconds' % (time.time() - start))
+        print(repr(filename), '%d lines, %.0f lines/s' % (
+            importer.rows, importer.rows / max(importer.elapsed, 1e-6)))
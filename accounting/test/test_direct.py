@@ -311,6 +311,109 @@ class TestRouter(pytransact.testsupport.BLMTests):
                 ]
             }
 
+    def test_do_read_paging(self):
+        foos = [blm.testblm.Foo(string=['foo'], int=[i]) for i in range(5)]
+        self.commit()
+
+        result = self.router.do_read(
+            'testblm', 'Foo',
+            [{'attributes': ['int'],
+              'paging': True, 'start': 1, 'limit': 2,
+              'sort': [{'property': 'int', 'direction': 'DESC'}]}])
+        assert result == {
+            'success': True,
+            'total': 5,
+            'tois': [
+                {'id': [str(foos[3].id[0])], 'int': [3]},
+                {'id': [str(foos[2].id[0])], 'int': [2]}
+                ]
+            }
+
+        # start and limit without paging are ignored
+        result = self.router.do_read(
+            'testblm', 'Foo',
+            [{'attributes': ['int'], 'start': 0, 'limit': 2}])
+        assert len(result['tois']) == 5
+        assert 'total' not in result
+
+    def test_do_read_count(self):
+        foo = blm.testblm.Foo(string=['foo'])
+        bar = blm.testblm.Foo(string=['bar'])
+        baz = blm.testblm.Foo(string=['baz'])
+        self.commit()
+
+        result = self.router.do_read(
+            'testblm', 'Foo',
+            [{'count': True, 'like': {'string': 'ba*'}}])
+        assert result == {'success': True, 'total': 2}
+
+    def test_do_read_paging_loads_page_only(self):
+        foos = [blm.testblm.Foo(string=['foo', 'bar'][i % 2], int=[i])
+                for i in range(10)]
+        self.commit()
+
+        queries = []
+        orig = blm.testblm.Foo._query
+        def _query(**kw):
+            queries.append(kw)
+            return orig(**kw)
+        blm.testblm.Foo._query = staticmethod(_query)
+        try:
+            result = self.router.do_read(
+                'testblm', 'Foo',
+                [{'attributes': ['int'],
+                  'filter': [{'property': 'string', 'value': ['foo']}],
+                  'paging': True, 'start': 1, 'limit': 2,
+                  'sort': [{'property': 'int', 'direction': 'ASC'}]}])
+        finally:
+            blm.testblm.Foo._query = orig
+
+        assert result == {
+            'success': True,
+            'total': 5,
+            'tois': [
+                {'id': [str(foos[2].id[0])], 'int': [2]},
+                {'id': [str(foos[4].id[0])], 'int': [4]}
+                ]
+            }
+        # the requested attributes are only loaded for the page
+        assert queries[-1] == {'id': [foos[2].id[0], foos[4].id[0]]}
+
+    def test_do_read_paging_permissions(self):
+        user = blm.accounting.User()
+        readable = [blm.testblm.Foo(int=[i], allowRead=[user])
+                    for i in range(3)]
+        for i in range(3, 6):
+            blm.testblm.Foo(int=[i])
+        self.commit()
+
+        user, = blm.accounting.User._query(id=user.id).run()
+        router = direct.Router(self.database, user)
+        result = router.do_read(
+            'testblm', 'Foo',
+            [{'attributes': ['int'],
+              'paging': True, 'start': 1, 'limit': 5,
+              'sort': [{'property': 'int', 'direction': 'ASC'}]}])
+        assert result['total'] == 3
+        assert [toi['id'] for toi in result['tois']] == [
+            [str(foo.id[0])] for foo in readable[1:]]
+
+        result = router.do_read('testblm', 'Foo', [{'count': True}])
+        assert result == {'success': True, 'total': 3}
+
+    def test_do_read_paging_decimal(self):
+        foos = [blm.testblm.Foo(decimal=[i]) for i in (3, 1, 2)]
+        self.commit()
+
+        result = self.router.do_read(
+            'testblm', 'Foo',
+            [{'attributes': ['decimal'],
+              'paging': True, 'start': 0, 'limit': 2,
+              'sort': [{'property': 'decimal', 'direction': 'ASC'}]}])
+        assert result['total'] == 3
+        assert [toi['id'] for toi in result['tois']] == [
+            [str(foos[1].id[0])], [str(foos[2].id[0])]]
+
     def test_update(self):
         foo = blm.testblm.Foo(string=['foo'], decimal=['42.27'])
         self.commit()
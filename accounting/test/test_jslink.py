@@ -18,7 +18,8 @@
 # Tests for JsLink
 #
 
-import flask, os, py, simplejson, time, urllib
+import contextlib, flask, os, py, simplejson, threading, time, urllib
+import pymongo.errors
 import bson
 from bson.objectid import ObjectId
 from werkzeug.datastructures import FileStorage, MultiDict
@@ -319,6 +320,126 @@ class TestJsLink(ContextTests):
         assert timestamp == now # touched
 
 
+    def test_long_poll(self, monkeypatch):
+        class LinkFactory(object):
+            def iter(self, spec):
+                return []
+        jslink = JsLink.JsLink(LinkFactory(), longPoll=25)
+        data = doRequest(jslink, data=[{"type": "handshake"}])
+        assert data['longPoll'] == 25
+        clientId = data['clientId']
+
+        events = []
+        class Notifier(object):
+            @contextlib.contextmanager
+            def listen(self, clientId):
+                event = threading.Event()
+                events.append((clientId, event))
+                yield event
+        monkeypatch.setattr(JsLink.Notifier, 'get',
+                            staticmethod(lambda database: Notifier()))
+
+        def update():
+            while not events:
+                time.sleep(0.01)
+            DB.update(self.ctx.database.clients,
+                      {'_id': ObjectId(clientId)},
+                      {'$set': {'updates': [{'foo': 42}]}})
+            self.sync()
+            events[0][1].set()
+        thread = threading.Thread(target=update)
+        thread.start()
+
+        data = doRequest(jslink, data=[{'type': 'poll',
+                                        'clientId': clientId,
+                                        'wait': 10}])
+        thread.join()
+        assert events[0][0] == ObjectId(clientId)
+        assert data == [{'foo': 42}]
+
+    def test_long_poll_disabled(self, monkeypatch):
+        class LinkFactory(object):
+            def iter(self, spec):
+                return []
+        jslink = JsLink.JsLink(LinkFactory())
+        data = doRequest(jslink, data=[{"type": "handshake"}])
+        assert data['longPoll'] == 0
+        clientId = data['clientId']
+
+        def get(database):
+            raise AssertionError('should not wait')
+        monkeypatch.setattr(JsLink.Notifier, 'get', staticmethod(get))
+
+        data = doRequest(jslink, data=[{'type': 'poll',
+                                        'clientId': clientId,
+                                        'wait': 10}])
+        assert data == []
+
+
+class FakeDatabase(object):
+    name = 'test'
+
+    def watch(self, pipeline, **kw):
+        raise pymongo.errors.OperationFailure('not a replica set')
+
+
+class TestNotifier(object):
+
+    def test_notify(self):
+        database = FakeDatabase()
+        notifier = JsLink.Notifier(database)
+        notifier.run = lambda: None  # don't start watching
+        client1, client2 = ObjectId(), ObjectId()
+
+        with notifier.listen(client1) as event1:
+            with notifier.listen(client2) as event2:
+                notifier.dispatch({'ns': {'coll': 'links'},
+                                   'documentKey': {'_id': ObjectId()},
+                                   'fullDocument': {'client': client1}})
+                assert event1.is_set()
+                assert not event2.is_set()
+
+                notifier.dispatch({'ns': {'coll': 'clients'},
+                                   'documentKey': {'_id': client2},
+                                   'fullDocument': {}})
+                assert event2.is_set()
+        assert notifier.listeners == {}
+
+    def test_notify_lookup(self, monkeypatch):
+        database = FakeDatabase()
+        database.links = object()
+        notifier = JsLink.Notifier(database)
+        notifier.run = lambda: None  # don't start watching
+        clientId, linkId = ObjectId(), ObjectId()
+        lookups = []
+        def find_one(coll, spec, projection=None):
+            lookups.append((coll, spec))
+            return {'_id': linkId, 'client': clientId}
+        monkeypatch.setattr(JsLink.mongo, 'find_one', find_one)
+
+        change = {'ns': {'coll': 'links'}, 'documentKey': {'_id': linkId}}
+        notifier.dispatch(change)
+        assert lookups == []  # nobody listening
+
+        with notifier.listen(clientId) as event:
+            notifier.dispatch(change)
+            assert event.is_set()
+        assert lookups == [(database.links, {'_id': linkId})]
+
+    def test_unavailable(self):
+        database = FakeDatabase()
+        notifier = JsLink.Notifier(database)
+        clientId = ObjectId()
+
+        with notifier.listen(clientId) as event:
+            # the failing change stream wakes everybody up
+            assert event.wait(5)
+        assert not notifier.available
+
+        with notifier.listen(clientId) as event:
+            assert event is None
+
+
 class TestJsLinkCalls(ContextTests):
 
     now = 1
@@ -22,7 +22,12 @@ except ImportError:
 import dkim
 import email.message
 import os
+import smtplib
+import time
 
+from bson.objectid import ObjectId
+from pytransact import mongo
+from pytransact.testsupport import ContextTests
 from accounting import config
 from .. import mail, smtppipe
 import codecs
@@ -53,6 +58,18 @@ class SMTP(object):
         self._quit = True
 
 
+class FailingSMTP(SMTP):
+
+    # recipient -> (code, message)
+    errors = {}
+
+    def sendmail(self, fromaddr, recipients, data):
+        for recipient in recipients:
+            if recipient in self.errors:
+                raise smtplib.SMTPResponseException(*self.errors[recipient])
+        super(FailingSMTP, self).sendmail(fromaddr, recipients, data)
+
+
 class TestMail(object):
 
     def setup_method(self, method):
@@ -206,6 +223,242 @@ class TestMail(object):
         args, = self.smtps[-1]._sendmail
         assert args[:2] == ('<>', ['to@test'])
 
+class TestOutbox(ContextTests):
+
+    now = 1000
+
+    def time(self):
+        return self.now
+
+    def setup_method(self, method):
+        super(TestOutbox, self).setup_method(method)
+        self._smtp = smtppipe.SMTP
+        smtppipe.SMTP = self.SMTP
+        self.smtps = []
+        self.config = config.save()
+        config.config.set('accounting', 'dkim_privkey', os.path.join(
+            os.path.dirname(__file__), 'dkim_test.private'))
+        config.config.set('accounting', 'dkim_domain', 'example.org')
+        config.config.set('accounting', 'smtp_domain', 'test.example.org')
+        config.config.set('accounting', 'smtp_to_filter', '.*@example')
+        self.pubkey = open(os.path.join(
+            os.path.dirname(__file__), 'dkim_test.txt'), 'rb').read()
+        FailingSMTP.errors = {}
+
+    def teardown_method(self, method):
+        super(TestOutbox, self).teardown_method(method)
+        smtppipe.SMTP = self._smtp
+        config.restore(self.config)
+
+    def SMTP(self, *args, **kw):
+        smtp = FailingSMTP(*args, **kw)
+        self.smtps.append(smtp)
+        return smtp
+
+    def enqueue(self, to, identity=None):
+        fromaddr, all_rcpts, message = mail.makemail(
+            u'räksmörgås', subject=u'Räksmörgåsar!', to=to)
+        return mail.enqueue(fromaddr, all_rcpts, message, identity=identity)
+
+    def test_enqueue(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        msgid = mail.enqueue('org', ['foo@example'], 'data', identity='org')
+        self.sync()
+
+        message, = mongo.find(self.database.outbox, {})
+        assert message['_id'] == msgid
+        assert message['fromaddr'] == 'org'
+        assert message['recipients'] == ['foo@example']
+        assert message['data'] == 'data'
+        assert message['identity'] == 'org'
+        assert message['state'] == 'pending'
+        assert message['attempts'] == 0
+        assert message['next_attempt'] == 1000
+        assert self.smtps == []
+
+    def test_enqueue_key(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        # a commit that is rerun queues the message again
+        assert mail.enqueue('org', ['foo@example'], 'data',
+                            key='foo-1') == 'foo-1'
+        self.now = 1005
+        assert mail.enqueue('org', ['foo@example'], 'data',
+                            key='foo-1') == 'foo-1'
+        self.sync()
+
+        message, = mongo.find(self.database.outbox, {})
+        assert message['_id'] == 'foo-1'
+        assert message['created'] == 1000
+
+        outbox = mail.Outbox(self.database, workers=1)
+        assert outbox.deliver() == 1
+        self.sync()
+        assert len(self.smtps[0]._sendmail) == 1
+
+        # and once it is sent, it stays sent
+        mail.enqueue('org', ['foo@example'], 'data', key='foo-1')
+        self.sync()
+        message, = mongo.find(self.database.outbox, {})
+        assert message['state'] == 'sent'
+        assert outbox.deliver() == 0
+
+    def test_confirm(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        toid = ObjectId()
+        mail.enqueue('org', ['foo@example'], 'data', key='foo-1',
+                     confirm=(toid, 'confirmationEmailSent', True))
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1, retry_delay=10)
+        # the commit has not shown up yet, hold on to the message
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {})
+        assert message['state'] == 'pending'
+        assert message['attempts'] == 0
+        assert message['next_attempt'] == 1010
+        assert self.smtps == []
+
+        mongo.insert(self.database.tois, {'_id': toid,
+                                          'confirmationEmailSent': [True]})
+        self.now = 1010
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {})
+        assert message['state'] == 'sent'
+        assert len(self.smtps[0]._sendmail) == 1
+
+    def test_confirm_exists(self):
+        toid = ObjectId()
+        mongo.insert(self.database.tois, {'_id': toid,
+                                          'reminderEmailsSent': [1000.0]})
+        outbox = mail.Outbox(self.database)
+        def message(n):
+            return {'confirm': {'toid': toid,
+                                'attr': 'reminderEmailsSent.%d' % n,
+                                'value': None}}
+        assert outbox.confirmed(message(0))
+        assert not outbox.confirmed(message(1))
+
+    def test_confirm_failed_commit(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        mail.enqueue('org', ['foo@example'], 'data', key='foo-1',
+                     confirm=(ObjectId(), 'confirmationEmailSent', True))
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1, retry_delay=10)
+        self.now = 1000 + outbox.confirm_timeout + 1
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {})
+        assert message['state'] == 'cancelled'
+        assert self.smtps == []
+        assert outbox.deliver() == 0
+
+    def test_deliver(self):
+        ids = [self.enqueue('foo%d@example' % i, identity='foo')
+               for i in range(3)]
+        filtered = self.enqueue('bar@elsewhere')
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1)
+        assert outbox.deliver() == 4
+        self.sync()
+
+        # one session for all messages
+        smtp, = self.smtps
+        assert smtp._quit
+        assert sorted(args[1][0] for args in smtp._sendmail) == [
+            'foo0@example', 'foo1@example', 'foo2@example']
+        for fromaddr, recipients, message in smtp._sendmail:
+            assert fromaddr == '<>'
+            assert dkim.verify(message, dnsfunc=lambda *_, **kw: self.pubkey)
+            assert b'i=foo@test.example.org' in message
+
+        for msgid in ids + [filtered]:
+            message, = mongo.find(self.database.outbox, {'_id': msgid})
+            assert message['state'] == 'sent'
+            assert 'data' not in message
+
+        assert outbox.deliver() == 0
+        assert len(self.smtps) == 1
+
+    def test_retry(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        FailingSMTP.errors = {'foo@example': (451, 'try again later')}
+        msgid = self.enqueue('foo@example')
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1, max_attempts=3,
+                             retry_delay=10)
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {'_id': msgid})
+        assert message['state'] == 'pending'
+        assert message['attempts'] == 1
+        assert message['next_attempt'] == 1010
+        assert 'try again later' in message['error']
+
+        # not yet
+        assert outbox.deliver() == 0
+
+        self.now = 1010
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {'_id': msgid})
+        assert message['state'] == 'pending'
+        assert message['attempts'] == 2
+        assert message['next_attempt'] == 1030
+
+        self.now = 1030
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {'_id': msgid})
+        assert message['state'] == 'failed'
+        assert message['attempts'] == 3
+
+        self.now = 2000
+        assert outbox.deliver() == 0
+
+    def test_permanent_failure(self):
+        FailingSMTP.errors = {'foo@example': (550, 'no such user')}
+        failing = self.enqueue('foo@example')
+        ok = self.enqueue('bar@example')
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1)
+        assert outbox.deliver() == 2
+        self.sync()
+
+        message, = mongo.find(self.database.outbox, {'_id': failing})
+        assert message['state'] == 'failed'
+        assert message['attempts'] == 1
+        message, = mongo.find(self.database.outbox, {'_id': ok})
+        assert message['state'] == 'sent'
+
+        # the session survived the rejected message
+        smtp, = self.smtps
+        (fromaddr, recipients, data), = smtp._sendmail
+        assert recipients == ['bar@example']
+
+    def test_stale_claim(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', self.time)
+        msgid = self.enqueue('foo@example')
+        self.sync()
+        mongo.update(self.database.outbox, {'_id': msgid},
+                     {'$set': {'state': 'sending', 'claimed': 1000}})
+        self.sync()
+
+        outbox = mail.Outbox(self.database, workers=1)
+        assert outbox.deliver() == 0
+
+        self.now = 1000 + outbox.claim_timeout + 1
+        assert outbox.deliver() == 1
+        self.sync()
+        message, = mongo.find(self.database.outbox, {'_id': msgid})
+        assert message['state'] == 'sent'
+
+
 def test_makeAddressHeader():
     addrs = [(u'kalle anka', 'kalle@anka.se'),
              (u'foo@bar', 'foo@bar.com'),
@@ -283,6 +283,84 @@ class TestKontoplan(ReportTests):
             assert row.findtext('td[@class="name"]') == account.name[0]
             assert row.findtext('td[@class="type"]') == account.type[0]
 
+    def test_cached(self):
+        account = self.mkAccount(1000)
+        self.commit()
+        accounting.reports.report_cache.clear()
+
+        tree = self.run_report()
+        assert len(accounting.reports.report_cache) == 1
+        key, = accounting.reports.report_cache
+        assert key[:2] == ('kontoplan', self.accounting.id[0])
+        # the time the report is served is not cached
+        cached = accounting.reports.report_cache[key]
+        assert accounting.reports.TIME_PLACEHOLDER in cached
+        html = self.run_report(html=True)
+        assert accounting.reports.TIME_PLACEHOLDER not in html.text_content()
+        assert list(accounting.reports.report_cache) == [key]
+
+    def test_commit_then_report(self):
+        account = self.mkAccount(1000)
+        self.commit()
+        accounting.reports.report_cache.clear()
+        self.run_report()
+
+        # the next report sees the commit, without waiting for anything
+        account, = blm.accounting.Account._query(id=account.id).run()
+        account(name=['Kassa'])
+        self.commit()
+        tree = self.run_report()
+        row, = tree.xpath('//tr[@class="account"]')
+        assert row.findtext('td[@class="name"]') == 'Kassa'
+        assert len(accounting.reports.report_cache) == 2
+
+        acc, = blm.accounting.Accounting._query(id=self.accounting.id).run()
+        acc(orgname=['Kassakompaniet AB'])
+        self.commit()
+        html = self.run_report(html=True)
+        assert 'Kassakompaniet AB' in html.text_content()
+        assert len(accounting.reports.report_cache) == 3
+
+
+class TestLedgerRevision(ReportTests):
+
+    def revision(self):
+        acc, = blm.accounting.Accounting._query(id=self.accounting.id).run()
+        return acc.ledger_revision[0] if acc.ledger_revision else 0
+
+    def test_ledger_revision(self):
+        self.commit()
+        revisions = [self.revision()]
+
+        def changed():
+            self.commit()
+            revision = self.revision()
+            assert revision > revisions[-1]
+            revisions.append(revision)
+
+        account = self.mkAccount(1000)
+        changed()
+        dimension = blm.accounting.Dimension(
+            accounting=self.accounting, number=['1'], name=['Dim'])
+        changed()
+        blm.accounting.AccountingObject(
+            dimension=dimension, number=['1'], name=['Obj'])
+        changed()
+        ver = self.mkVer(transactions=[
+            collections.namedtuple('T', 'account amount text')(
+                account, Decimal('10.00'), 'text')])
+        changed()
+        trans, = blm.accounting.Transaction._query(verification=ver).run()
+        trans(text=['other'])
+        changed()
+        trans, = blm.accounting.Transaction._query(id=trans.id).run()
+        trans._delete()
+        changed()
+
+        other = blm.accounting.Accounting(org=self.org)
+        self.commit()
+        assert self.revision() == revisions[-1]
+
 
 class TestHuvudbok(ReportTests):
 
@@ -16,7 +16,7 @@
 
 import os
 from pytransact.testsupport import BLMTests
-from accounting.sie_export import sie_export, remove_dashes_from_date, \
+from accounting.sie_export import sie_export, iter_sie_export, remove_dashes_from_date, \
 print_program_name, print_format, print_sietype, print_orgtype, print_org_id, \
 print_orgnum, print_industry_code, print_address, print_orgname, \
 print_taxation_year, \
@@ -283,3 +283,14 @@ class TestImported(BLMTests):
     def test_export(self, tmpdir):
         with codecs.open(str(tmpdir.join('export_output')), 'w', 'cp437') as fp:
             sie_export(fp, self.acc)
+
+    def test_iter_export_chunks(self, tmpdir):
+        with codecs.open(str(tmpdir.join('export_output')), 'w', 'cp437') as fp:
+            sie_export(fp, self.acc)
+        with codecs.open(str(tmpdir.join('export_output')), 'r', 'cp437') as fp:
+            expected = fp.read()
+
+        chunks = list(iter_sie_export(self.acc, chunksize=1))
+        assert u''.join(chunks) == expected
+        vers = [chunk for chunk in chunks if chunk.startswith(u'#VER')]
+        assert len(vers) == len(blm.accounting.Verification._query().run())
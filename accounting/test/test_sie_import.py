@@ -22,9 +22,15 @@ except ImportError:
 import glob, os, py, time
 from pytransact import queryops as q
 from accounting.sie_import import BaseParser, Parser, SIEImporter, \
-    UnsupportedSIEVersion, AppendingParser, DoneException
+    UnsupportedSIEVersion, AppendingParser, DoneException, \
+    Codepage437TranslatingParser, RecordTokenizer, records, ChecksumError
+from accounting.crc import Crc
 import blm
 
+# timing comparisons, run with SIE_BENCHMARK=1 py.test -s
+benchmark = py.test.mark.skipif(not os.environ.get('SIE_BENCHMARK'),
+                                reason='Set SIE_BENCHMARK to run.')
+
 
 class TestLowLevelParser(object):
     def setup(self):
@@ -172,6 +178,96 @@ class TestLowLevelParser(object):
         assert isinstance(params[2], Decimal)
         assert params[2] == Decimal('123.45')
 
+class TestRecordTokenizer(object):
+
+    here = os.path.dirname(__file__)
+
+    def read_record(self, line, encoding=None):
+        # the old, character by character, way
+        if encoding:
+            p = Codepage437TranslatingParser()
+        else:
+            p = BaseParser()
+        p.s = line
+        p.pos = 0
+        if p.consume_whitespace() == b'#':
+            label = p.consume_label()
+            return label, p.read_record(records[label][0])
+
+    def tokenize(self, line, encoding=None):
+        record = RecordTokenizer(encoding).tokenize(line, records)
+        if record is not None:
+            return record[0], record[1]
+
+    def test_tokenize(self):
+        for line in [
+                b'#KONTO 1910 "Kassa"\n',
+                b'  #KONTO\t1910\tKassa \n',
+                b'#VER A 1 20120101 "" "" ""\n',
+                b'#VER A 1 20120101\n',
+                b'#TRANS 1910 {1 "2\\"" } -100 20120101 "a\\\\"b" 1 x\n',
+                b'#TRANS 1910{1 a}}} 5\n',
+                b'#TRANS "1910" {} 5.5\n',
+                b'#IB -1 1910 1234.45 2.2\n',
+                b'{\n',
+                b'\n']:
+            assert self.tokenize(line) == self.read_record(line)
+            assert (self.tokenize(line, 'cp437') ==
+                    self.read_record(line, 'cp437'))
+
+        for line in [b'#TRANS "19x0" {} 1\n',
+                     b'#TRANS 1 {1} 2\n',
+                     b'#KONTO 1\x01 "x"\n']:
+            py.test.raises(ValueError, self.tokenize, line)
+
+        py.test.raises(DoneException, self.tokenize, b'#VER A 1 "oops\n')
+
+    def test_crcdata(self):
+        label, params, crcdata = RecordTokenizer().tokenize(
+            b'#TRANS 1910 {1 "2\\""} -100.00 "" "text \\"x\\""\n', records)
+        assert crcdata == [b'#TRANS', b'1910', b'1', b'2"', b'-100.00',
+                           b'', b'text "x"']
+
+    def test_crc(self):
+        crc = Crc()
+        crc.crc(b'1234')
+        crc.crc(b'56789')
+        assert crc.finalize() == 0xcbf43926  # the CRC-32 check value
+        crc.reset()
+        crc.crc(b'')
+        assert crc.finalize() == 0
+
+    def test_files(self):
+        for filename in glob.glob(os.path.join(self.here, 'sie', '*')):
+            with open(filename, 'rb') as fp:
+                lines = fp.readlines()
+            for line in lines[1:]:
+                try:
+                    expected = self.read_record(line, 'cp437')
+                except DoneException:
+                    continue
+                assert self.tokenize(line, 'cp437') == expected
+
+    @benchmark
+    def test_benchmark(self):
+        with open(os.path.join(self.here, 'sie', 'OVNINGSB4.SE'), 'rb') as fp:
+            lines = fp.readlines()[1:] * 5
+
+        def run(parse):
+            start = time.time()
+            for line in lines:
+                try:
+                    parse(line, 'cp437')
+                except DoneException:
+                    pass
+            return time.time() - start
+
+        old = run(self.read_record)
+        new = run(self.tokenize)
+        print('%d lines: %.0f lines/s (old %.0f lines/s)' % (
+            len(lines), len(lines) / new, len(lines) / old))
+
+
 import py
 from decimal import Decimal
 from datetime import date
@@ -546,6 +642,50 @@ class TestSIEImporter(BLMTests):
         importer.parse(StringIO(b'#FLAGGA 0\n\n'))
         assert importer.accounting.imported[0]
 
+    def test_balances_calculated_after_import(self):
+        org = blm.accounting.Org()
+        importer = SIEImporter(org=[org])
+        importer.parse(StringIO(b'''#FLAGGA 0
+#SIETYP 4
+#RAR 0 20120101 20121231
+#DIM 1 "Resultatenhet"
+#OBJEKT 1 "2" "bar"
+#KONTO 1910 "Kassa"
+#KONTO 6250 "Porto"
+#IB 0 1910 1000.00
+#UB 0 1910 200.00
+#VER A 1 20120124 "" 20120125
+{
+#TRANS 1910 {} -800.00
+#TRANS 6250 {1 2} 800.00
+}
+#VER A 2 20120224 "" 20120225
+{
+#TRANS 1910 {} -100.00
+#TRANS 6250 {1 2} 100.00
+}
+'''))
+        assert importer.rows == 19
+        account1910, = blm.accounting.Account._query(number='1910').run()
+        assert account1910.balance == [Decimal('100.00')]
+        assert account1910.period_turnover == {'201201': Decimal('-800.00'),
+                                               '201202': Decimal('-100.00')}
+        account6250, = blm.accounting.Account._query(number='6250').run()
+        assert account6250.balance == [Decimal('900.00')]
+        obb, = account6250.object_balance_budgets
+        assert obb.balance == [Decimal('900.00')]
+
+    def test_checksum_verified_first(self):
+        here = os.path.dirname(__file__)
+        with open(os.path.join(here, 'sie', 'SIE4.se'), 'rb') as fp:
+            data = fp.read()
+        data = data.replace(b'-1250.00', b'-1251.00', 1)
+        org = blm.accounting.Org()
+        importer = SIEImporter(org=[org])
+        py.test.raises(ChecksumError, importer.parse, StringIO(data))
+        assert blm.accounting.Accounting._query().run() == []
+        assert blm.accounting.Account._query().run() == []
+
 
 class TestAppendingParser(BLMTests):
 
@@ -139,3 +139,55 @@ signature
             From='from@test',
             To='to@test',
             Subject=u'sübjëct')
+
+    def test_environment_reused(self, tmpdir, monkeypatch):
+        template = tmpdir.join('thetemplate')
+        template.write('{{ val|money }}')
+        monkeypatch.setattr(config, 'template_dir', str(tmpdir))
+
+        env = templating.get_environment(str(tmpdir))
+        assert templating.get_environment(str(tmpdir)) is env
+        assert templating.get_environment(None) is not env
+
+        compiled = []
+        orig = env.compile
+        def compile(*args, **kw):
+            compiled.append(args)
+            return orig(*args, **kw)
+        monkeypatch.setattr(env, 'compile', compile)
+        monkeypatch.setattr(env, 'bytecode_cache', None)
+
+        assert templating.render_template('thetemplate', val=1) == '1,00'
+        assert templating.render_template('thetemplate', val=2) == '2,00'
+        assert len(compiled) == 1
+
+    def test_template_changed(self, tmpdir, monkeypatch):
+        import os
+        template = tmpdir.join('thetemplate')
+        template.write('foo')
+        monkeypatch.setattr(config, 'template_dir', str(tmpdir))
+        assert templating.render_template('thetemplate') == 'foo'
+        assert templating.render_template(str(template)) == 'foo'
+
+        template.write('bar')
+        mtime = os.path.getmtime(str(template)) + 10
+        os.utime(str(template), (mtime, mtime))
+        assert templating.render_template('thetemplate') == 'bar'
+        assert templating.render_template(str(template)) == 'bar'
+
+    def test_precompile(self, tmpdir, monkeypatch):
+        tmpdir.join('email', 'foo').write('foo', ensure=True)
+        tmpdir.join('email', 'bar').write('bar', ensure=True)
+        tmpdir.join('other').write('other')
+        monkeypatch.setattr(config, 'template_dir', str(tmpdir))
+
+        loaded = []
+        env = templating.get_environment(str(tmpdir))
+        orig = env.loader.get_source
+        def get_source(env, name):
+            loaded.append(name)
+            return orig(env, name)
+        monkeypatch.setattr(env.loader, 'get_source', get_source)
+
+        templating.precompile()
+        assert sorted(loaded) == ['email/bar', 'email/foo']
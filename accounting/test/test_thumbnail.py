@@ -0,0 +1,99 @@
+# Copyright 2019 Open End AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from PIL import Image
+from accounting import config, thumbnail
+
+
+def make_png(width, height):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class TestCache(object):
+
+    def setup_method(self, method):
+        self.cfg = config.save()
+        thumbnail.cache.clear()
+        self.calls = []
+
+    def teardown_method(self, method):
+        config.restore(self.cfg)
+        thumbnail.cache.clear()
+
+    def fake_thumbnail(self, data, content_type, width, height):
+        self.calls.append((data, width, height))
+        return b'thumb %dx%d' % (width, height), 'image/png'
+
+    def test_from_image(self):
+        thumb, content_type = thumbnail.thumbnail(make_png(200, 100),
+                                                  'image/png', 50, 50)
+        assert content_type == 'PNG'
+        assert Image.open(io.BytesIO(thumb)).size == (50, 25)
+
+    def test_cache_key(self):
+        foo, bar = thumbnail.digest(b'foo'), thumbnail.digest(b'bar')
+        key = thumbnail.cache_key(foo, 10, 20)
+        assert key == thumbnail.cache_key(thumbnail.digest(b'foo'), 10, 20)
+        assert key != thumbnail.cache_key(bar, 10, 20)
+        assert key != thumbnail.cache_key(foo, 20, 10)
+
+    def test_memory(self, monkeypatch):
+        config.config.set('accounting', 'thumbnail_cache_dir', '')
+        monkeypatch.setattr(thumbnail, 'thumbnail', self.fake_thumbnail)
+        monkeypatch.setattr(thumbnail, 'cache_size', 2)
+
+        result = thumbnail.cached_thumbnail(b'foo', 'image/png', 10, 10)
+        assert result == (b'thumb 10x10', 'image/png')
+        assert thumbnail.cached_thumbnail(b'foo', 'image/png', 10, 10) == result
+        assert self.calls == [(b'foo', 10, 10)]
+
+        thumbnail.cached_thumbnail(b'foo', 'image/png', 20, 20)
+        thumbnail.cached_thumbnail(b'bar', 'image/png', 10, 10)
+        assert len(thumbnail.cache) == 2
+        assert len(self.calls) == 3
+
+        # foo 10x10 was evicted
+        thumbnail.cached_thumbnail(b'foo', 'image/png', 10, 10)
+        assert len(self.calls) == 4
+
+    def test_disk(self, monkeypatch, tmpdir):
+        config.config.set('accounting', 'thumbnail_cache_dir', str(tmpdir))
+        monkeypatch.setattr(thumbnail, 'thumbnail', self.fake_thumbnail)
+
+        result = thumbnail.cached_thumbnail(b'foo', 'image/png', 10, 10)
+        key = thumbnail.cache_key(thumbnail.digest(b'foo'), 10, 10)
+        assert tmpdir.join(key[:2], key).check()
+
+        thumbnail.cache.clear()
+        assert thumbnail.cached_thumbnail(b'foo', 'image/png', 10, 10) == result
+        assert self.calls == [(b'foo', 10, 10)]
+
+    def test_lazy_data(self, monkeypatch):
+        config.config.set('accounting', 'thumbnail_cache_dir', '')
+        monkeypatch.setattr(thumbnail, 'thumbnail', self.fake_thumbnail)
+        reads = []
+        def read():
+            reads.append(1)
+            return b'foo'
+
+        key = thumbnail.cache_key(thumbnail.digest(b'foo'), 10, 10)
+        result = thumbnail.cached_thumbnail(read, 'image/png', 10, 10, key)
+        assert result == (b'thumb 10x10', 'image/png')
+        assert thumbnail.cached_thumbnail(read, 'image/png', 10, 10, key) == \
+            result
+        assert reads == [1]
+        assert self.calls == [(b'foo', 10, 10)]
@@ -21,9 +21,14 @@ if sys.version_info >= (3,0):
 else:
     PYT3 = False
     import cStringIO
+import hashlib
+import os
 import tempfile
+import threading
 import subprocess
+from collections import OrderedDict
 from PIL import Image
+import accounting.config
 
 
 def thumbnail(data, content_type, width, height):
@@ -55,3 +60,89 @@ def from_image(data, width, height):
         buf = cStringIO.StringIO()
     image.save(buf, format=image.format)
     return buf.getvalue(), image.format
+
+
+# Thumbnails are cached on the hash of the original data and the
+# requested size, in memory and, if accounting.thumbnail_cache_dir is
+# set, on disk.
+
+cache = OrderedDict()
+cache_size = 256
+cache_lock = threading.Lock()
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def cache_key(digest, width, height):
+    """Return the cache key for a thumbnail, also usable as an ETag."""
+    return '%s-%dx%d' % (digest, width, height)
+
+
+def cache_path(key):
+    config = accounting.config.config
+    if not (config.has_option('accounting', 'thumbnail_cache_dir') and
+            config.get('accounting', 'thumbnail_cache_dir')):
+        return None
+    return os.path.join(config.get('accounting', 'thumbnail_cache_dir'),
+                        key[:2], key)
+
+
+def read_cached(path):
+    try:
+        with open(path, 'rb') as f:
+            content_type = f.readline().decode('ascii').rstrip('\n')
+            return f.read(), content_type
+    except (IOError, OSError):
+        return None
+
+
+def write_cached(path, thumb, content_type):
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(content_type.encode('ascii') + b'\n')
+            f.write(thumb)
+        os.rename(f.name, path)
+    except (IOError, OSError):
+        pass  # the cache is only an optimization
+
+
+def cached_thumbnail(data, content_type, width, height, key=None):
+    """
+    Like thumbnail(), but cached. data may be a function returning
+    the data, to only read it when the thumbnail is not cached; key
+    must then be given.
+    """
+    if key is None:
+        key = cache_key(digest(data), width, height)
+
+    with cache_lock:
+        try:
+            result = cache.pop(key)
+        except KeyError:
+            result = None
+        else:
+            cache[key] = result
+            return result
+
+    path = cache_path(key)
+    if path:
+        result = read_cached(path)
+    if result is None:
+        if callable(data):
+            data = data()
+        result = thumbnail(data, content_type, width, height)
+        if result is None:
+            return None
+        if path:
+            write_cached(path, *result)
+
+    with cache_lock:
+        cache[key] = result
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+    return result
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Open End AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# (Re)build the transaction text index used for autocompletion, one
+# commit per Org.
+#
+# With --stale, only recount the texts that transactions have marked
+# as stale. This is meant to be run regularly, e.g. from cron.
+#
+# Texts are marked when a commit changes them, before the commit is
+# visible, so marks are only recounted and removed once every commit
+# that was started before them has finished.
+
+import sys, time
+from bson.objectid import ObjectId
+import accounting.config
+import accounting.db
+from pytransact import commit
+from pytransact import context
+from pytransact import mongo
+import blm.accounting
+log = accounting.config.getLogger('accounting.upgrade')
+
+# Unfinished commits older than this are assumed to be stuck rather
+# than running, and don't hold back the index.
+COMMIT_TIMEOUT = 3600
+
+
+def finished_before(database):
+    """
+    Return a time such that all commits that marked texts before it
+    have finished, successfully or not.
+    """
+    now = time.time()
+    before = now
+    for doc in mongo.find(database.commits,
+                          {'state': {'$nin': ['done', 'failed']}},
+                          projection=[]):
+        started = doc['_id'].generation_time.timestamp()
+        if started > now - COMMIT_TIMEOUT:
+            before = min(before, started)
+    # Allow for clock differences between the machines
+    return before - blm.accounting.TransactionText.STALE_AGE
+
+
+def index(database, orgid, method, args, before):
+    interested = 'index-texts-%s' % orgid
+    with commit.CommitContext(database) as ctx:
+        op = commit.CallToi(orgid, method, args)
+        ctx.runCommit([op], interested=interested)
+    result, error = commit.wait_for_commit(database, interested=interested)
+    if error:
+        log.error('Could not index %s: %s', orgid, error)
+        return False
+    # Marks made before 'before' belong to commits that had finished
+    # when the index was counted, see finished_before().
+    mongo.remove(database.staletexts, {'org': orgid,
+                                       'changed': {'$lt': before}})
+    return True
+
+
+def update_stale(database):
+    before = finished_before(database)
+    orgids = set(doc['org'] for doc in
+                 mongo.find(database.staletexts, {'changed': {'$lt': before}},
+                            projection=['org']))
+    for orgid in orgids:
+        if index(database, orgid, 'updateTransactionIndex',
+                 [[before]], before):
+            log.info('Updated %s', orgid)
+
+
+def main(orgids=None):
+    database = accounting.db.connect()
+
+    if not orgids:
+        with context.ReadonlyContext(database) as ctx:
+            orgids = [org.id[0] for org in
+                      blm.accounting.Org._query(_attrList=[]).run()]
+
+    for n, orgid in enumerate(orgids):
+        before = finished_before(database)
+        if index(database, orgid, 'rebuildTransactionIndex', [], before):
+            log.info('Indexed %s (%d of %d)', orgid, n + 1, len(orgids))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--stale']:
+        update_stale(accounting.db.connect())
+    else:
+        main([ObjectId(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Open End AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deliver mail queued in the outbox by accounting.mail.enqueue().
+"""
+
+import signal
+from accounting import db, mail
+
+
+def setup_term_handler():
+    def handler(signum, stack_frame):
+        raise SystemExit
+    return signal.signal(signal.SIGTERM, handler)
+
+
+def main():
+    database = db.connect()
+    setup_term_handler()
+    mail.Outbox(database).run()
+
+
+if __name__ == '__main__':
+    main()
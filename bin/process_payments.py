@@ -24,9 +24,22 @@ from bson.objectid import ObjectId
 import pymongo
 from pytransact.context import ReadonlyContext
 from pytransact.commit import CommitContext, CallToi, CreateToi, wait_for_commit
+from pytransact import iterate
 import accounting.db, accounting.config
 import members
 import blm.members
+log = accounting.config.getLogger('process_payments')
+
+CHUNKSIZE = 100  # method calls per commit
+
+
+class PaymentErrors(Exception):
+
+    def __init__(self, errors):
+        super(PaymentErrors, self).__init__(
+            '\n'.join('%s %s: %s' % (method, toid, error)
+                      for method, toid, error in errors))
+        self.errors = errors
 
 
 def archive_file(fname):
@@ -34,7 +47,71 @@ def archive_file(fname):
     shutil.move(fname, archive)
 
 
-def process_file(database, fname):
+def call_batched(database, method, toids, chunksize=CHUNKSIZE):
+    """
+    Call method on each of toids, with chunksize calls per commit.
+
+    All commits are submitted before waiting for any of them. The
+    calls of a failed commit are retried with one call per commit,
+    to find out which of them failed.
+
+    Since calls may be made more than once, method must be safe to
+    repeat, and any side effects it has outside of the commit, like
+    queueing mail, must be idempotent.
+
+    Returns a list of (method, toid, error) for the failed calls.
+    """
+    batch = ObjectId()
+    pending = []
+    for n, chunk in enumerate(iterate.chunks(toids, chunksize)):
+        interested = '%s-%s-%d' % (method, batch, n)
+        with CommitContext(database) as ctx:
+            ctx.runCommit([CallToi(toid, method, []) for toid in chunk],
+                          interested)
+        pending.append((chunk, interested))
+
+    errors = []
+    for chunk, interested in pending:
+        _, error = wait_for_commit(database, interested=interested)
+        if error is None:
+            continue
+        if len(chunk) == 1:
+            log.error('%s failed for %s: %s', method, chunk[0], error)
+            errors.append((method, chunk[0], error))
+        else:
+            errors.extend(call_batched(database, method, chunk, chunksize=1))
+    return errors
+
+
+def match_payments(database, paymentfile, payments, chunksize=CHUNKSIZE):
+    """
+    Match payments with purchases, by calling match on their payment
+    file with chunksize payments per commit, so that each commit looks
+    up the purchases of all its payments at once.
+
+    The payments of a failed commit are matched one by one, like
+    call_batched() does. Returns a list of (method, toid, error) for
+    the payments that failed.
+    """
+    batch = ObjectId()
+    pending = []
+    for n, chunk in enumerate(iterate.chunks(payments, chunksize)):
+        chunk = list(chunk)
+        interested = 'match-%s-%d' % (batch, n)
+        with CommitContext(database) as ctx:
+            ctx.runCommit([CallToi(paymentfile, 'match', [chunk])],
+                          interested)
+        pending.append((chunk, interested))
+
+    errors = []
+    for chunk, interested in pending:
+        _, error = wait_for_commit(database, interested=interested)
+        if error is not None:
+            errors.extend(call_batched(database, 'match', chunk, chunksize=1))
+    return errors
+
+
+def process_file(database, fname, chunksize=CHUNKSIZE):
     if PYT3:
         with open(fname, 'r', encoding='iso-8859-1') as f:
             data = f.read()
@@ -63,28 +140,16 @@ def process_file(database, fname):
             raise error
 
     with ReadonlyContext(database):
-        for paymentFile in blm.members.PGPaymentFile._query(id=toid).run():
-            for payment in paymentFile.payments:
-                paymentId = payment.id[0]
-                interested = 'match-payment-%s-%s' % (interested_id, paymentId)
-                with CommitContext(database) as ctx:
-                    op = CallToi(paymentId, 'match', [])
-                    ctx.runCommit([op], interested)
-                _, error = wait_for_commit(database, interested=interested)
-                if error:
-                    raise error
-
-    with ReadonlyContext(database):
-        for payment in blm.members.PGPayment._query(paymentFile=toid).run():
-            paymentId = payment.id[0]
-            interested = 'send-payment-confirmation-%s-%s' % (
-                paymentId, ObjectId())
-            with CommitContext(database) as ctx:
-                op = CallToi(paymentId, 'sendConfirmationEmail', [])
-                ctx.runCommit([op], interested)
-            _, error = wait_for_commit(database, interested=interested)
-            if error:
-                raise error
+        payments = [payment.id[0] for payment in
+                    blm.members.PGPayment._query(paymentFile=toid).run()]
+
+    errors = match_payments(database, toid, payments, chunksize)
+    failed = set(toid for _, toid, _ in errors)
+    payments = [payment for payment in payments if payment not in failed]
+    errors.extend(call_batched(database, 'sendConfirmationEmail', payments,
+                               chunksize))
+    if errors:
+        raise PaymentErrors(errors)
 
     archive_file(fname)
 
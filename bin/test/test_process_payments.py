@@ -19,6 +19,7 @@ else:
     PYT3 = True
 import datetime, os, shutil
 import pymongo
+from bson.objectid import ObjectId
 from pytransact.testsupport import DBTests, BLMTests
 from accounting import db, config, mail
 from .. import process_payments
@@ -74,8 +75,26 @@ class TestProcessPayments(BLMTests):
 
         # xxx test .match()
 
+    def test_call_batched(self):
+        org = blm.accounting.Org()
+        accounting = blm.accounting.Accounting(org=[org])
+        accounts = [blm.accounting.Account(accounting=[accounting],
+                                           number=[str(n)])
+                    for n in range(1000, 1005)]
+        self.commit()
+
+        toids = [account.id[0] for account in accounts]
+        missing = ObjectId()
+        toids.insert(3, missing)
+
+        errors = process_payments.call_batched(self.database, 'updateBalance',
+                                               toids, chunksize=2)
+        (method, toid, error), = errors
+        assert method == 'updateBalance'
+        assert toid == missing
+
     def test_multiple_partial_payments(self, monkeypatch, tmpdir):
-        monkeypatch.setattr(mail, 'sendmail', lambda *args, **kw: None)
+        monkeypatch.setattr(mail, 'enqueue', lambda *args, **kw: None)
         org = blm.accounting.Org(name=['ACME'],
                                  subscriptionLevel=['subscriber'])
         provider = blm.accounting.PlusgiroProvider(org=[org], pgnum=['42-2'])
@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import pytransact.mongo
 import pytransact.testsupport
+from pytransact.testsupport import BLMTests
+import blm.accounting
 from .. import upgrade
 
 def test_main(monkeypatch):
@@ -23,3 +26,30 @@ def test_main(monkeypatch):
 
     database, = calls
     assert database.name == pytransact.testsupport.dbname
+
+
+
+class TestSeedOcrCounters(BLMTests):
+
+    def test_seed(self):
+        year = time.strftime('%Y')
+        org = blm.accounting.Org(ocrCounter=[5])
+        other = blm.accounting.Org(ocrCounter=[7])
+        self.commit()
+        # other has not allocated any OCR numbers this year
+        pytransact.mongo.update(self.database.tois, {'_id': other.id[0]},
+                                {'$set': {'ocrYearReset': [
+                                    (int(year[-1]) + 1) % 10]}})
+        key = '%s-%s' % (org.id[0], year)
+
+        upgrade.seed_ocr_counters(self.database)
+        counters = list(pytransact.mongo.find(self.database.ocrcounters, {}))
+        assert counters == [{'_id': key, 'next': 5}]
+
+        # existing counters are kept
+        pytransact.mongo.update(self.database.ocrcounters, {'_id': key},
+                                {'$set': {'next': 9}})
+        upgrade.seed_ocr_counters(self.database)
+        counter = pytransact.mongo.find_one(self.database.ocrcounters,
+                                            {'_id': key})
+        assert counter['next'] == 9
@@ -19,6 +19,12 @@ else:
     PYT3 = True
 
 import os
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import pymongo
+from bson.objectid import ObjectId
 import pytransact.testsupport
 from pytransact.testsupport import BLMTests, Time
 from contextlib import contextmanager
@@ -151,6 +157,143 @@ class TestUser(BLMTests):
                 assert self.user.lastAccess == [time.now]
 
 
+class FakeUser(object):
+    def __init__(self):
+        self.toid = ObjectId()
+
+
+class FakeChangeStream(object):
+    def __init__(self):
+        self.changes = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __iter__(self):
+        while True:
+            change = self.changes.get()
+            if change is None:
+                raise pymongo.errors.OperationFailure('closed')
+            yield change
+
+
+class FakeDatabase(object):
+    name = 'test'
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def watch(self, pipeline, **kw):
+        # changes are not looked up, the documentKey is enough
+        assert 'full_document' not in kw
+        if self.stream is None:
+            raise pymongo.errors.OperationFailure('not a replica set')
+        return self.stream
+
+
+class TestUserCache(object):
+
+    def wait_for(self, predicate):
+        for i in range(500):
+            if predicate():
+                return
+            time.sleep(0.01)
+        raise AssertionError('timeout')
+
+    def test_cache(self, monkeypatch):
+        stream = FakeChangeStream()
+        cache = wsgi.UserCache(FakeDatabase(stream))
+        user1, user2 = FakeUser(), FakeUser()
+        found = []
+        def find(user):
+            def find():
+                found.append(user)
+                return user
+            return find
+
+        cache.lookup('foo', lambda: None)  # starts watching
+        self.wait_for(lambda: cache.watching)
+
+        assert cache.lookup('user1', find(user1)) is user1
+        assert cache.lookup('user1', find(user1)) is user1
+        assert cache.lookup('user2', find(user2)) is user2
+        assert found == [user1, user2]
+        assert (cache.hits, cache.misses) == (1, 3)
+
+        # not found is not cached
+        assert cache.lookup('foo', lambda: None) is None
+        assert cache.misses == 4
+
+        stream.changes.put({'documentKey': {'_id': user1.toid}})
+        self.wait_for(lambda: 'user1' not in cache.entries)
+        assert cache.lookup('user1', find(user1)) is user1
+        assert cache.lookup('user2', find(user2)) is user2
+        assert found == [user1, user2, user1]
+
+        # expiry
+        monkeypatch.setattr(wsgi.UserCache, 'TTL', -1)
+        cache.entries.clear()
+        cache.lookup('user1', find(user1))
+        cache.lookup('user1', find(user1))
+        assert found == [user1, user2, user1, user1, user1]
+
+        # a failing change stream disables the cache
+        stream.changes.put(None)
+        self.wait_for(lambda: not cache.available)
+        assert cache.entries == {}
+
+    def test_touch(self):
+        stream = FakeChangeStream()
+        cache = wsgi.UserCache(FakeDatabase(stream))
+        cache.lookup('foo', lambda: None)  # starts watching
+        self.wait_for(lambda: cache.watching)
+        user = wsgi.CachedUser('accounting.User', ObjectId(), 1)
+        cache.lookup('user', lambda: user)
+
+        cache.touch('user', 2)
+        assert cache.lookup('user', lambda: user).lastAccess == 2
+        cache.touch('other', 2)
+        assert 'other' not in cache.entries
+
+    def test_change_while_looking(self):
+        stream = FakeChangeStream()
+        cache = wsgi.UserCache(FakeDatabase(stream))
+        cache.lookup('foo', lambda: None)  # starts watching
+        self.wait_for(lambda: cache.watching)
+        user = FakeUser()
+
+        # changes to other tois do not keep the user from being cached
+        def find():
+            cache.evict(ObjectId())
+            return user
+        assert cache.lookup('user', find) is user
+        assert 'user' in cache.entries
+        assert cache.changed == {}
+
+        # but changes to the user itself do
+        cache.entries.clear()
+        def find():
+            cache.evict(user.toid)
+            return user
+        assert cache.lookup('user', find) is user
+        assert 'user' not in cache.entries
+        assert cache.changed == {}
+
+    def test_unavailable(self):
+        cache = wsgi.UserCache(FakeDatabase())
+        user = FakeUser()
+        assert cache.lookup('user', lambda: user) is user
+        self.wait_for(lambda: not cache.available)
+        found = []
+        for i in range(3):
+            assert cache.lookup('user', lambda: found.append(1) or user) is user
+        assert found == [1, 1, 1]
+        assert cache.hits == 0
+
+
 class TestLogin(object):
 
     def setup_method(self, method):
@@ -271,6 +414,80 @@ class TestInvoice(BLMTests):
         assert tickets[0].action == self.purchase.ticketsUrl[0]
 
 
+class TestImage(BLMTests):
+
+    def setup_method(self, method):
+        super(TestImage, self).setup_method(method)
+        from pytransact.object.model import BlobVal
+        self.data = bytes(bytearray(range(256))) * 1000
+        self.org = blm.accounting.Org(
+            image=[BlobVal(self.data, content_type='image/png')])
+        self.commit()
+        self.app = wsgi.app.test_client()
+        self.url = '/image/%s' % self.org.id[0]
+
+    def test_image(self, monkeypatch):
+        monkeypatch.setattr(wsgi, 'BLOB_CHUNK_SIZE', 1000)
+        response = self.app.get(self.url)
+        assert response.status_code == 200
+        assert response.content_type == 'image/png'
+        assert response.headers['Content-Length'] == str(len(self.data))
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.data == self.data
+
+    def test_range(self):
+        response = self.app.get(self.url, headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 10-19/256000'
+        assert response.data == self.data[10:20]
+
+        response = self.app.get(self.url, headers={'Range': 'bytes=-100'})
+        assert response.status_code == 206
+        assert response.data == self.data[-100:]
+
+        response = self.app.get(self.url, headers={'Range': 'bytes=300000-'})
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == 'bytes */256000'
+
+    def test_conditional(self):
+        etag = self.app.get(self.url).headers['ETag']
+
+        response = self.app.get(self.url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        response = self.app.get(self.url, headers={'If-None-Match': '"foo"'})
+        assert response.status_code == 200
+
+        response = self.app.get(self.url, headers={'Range': 'bytes=0-9',
+                                                   'If-Range': etag})
+        assert response.status_code == 206
+
+        response = self.app.get(self.url, headers={'Range': 'bytes=0-9',
+                                                   'If-Range': '"foo"'})
+        assert response.status_code == 200
+        assert response.data == self.data
+
+    def test_etag(self, monkeypatch):
+        etag = self.app.get(self.url).headers['ETag']
+
+        def iter_blob(*args, **kw):
+            raise AssertionError('blob read')
+        monkeypatch.setattr(wsgi, 'iter_blob', iter_blob)
+        response = self.app.get(self.url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        monkeypatch.undo()
+
+        from pytransact.object.model import BlobVal
+        org, = blm.accounting.Org._query(id=self.org.id).run()
+        org.image = [BlobVal(self.data[::-1], content_type='image/png')]
+        self.commit()
+        response = self.app.get(self.url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert response.data == self.data[::-1]
+
+
 class TestGetTickets(BLMTests):
 
     def set_cookie(self, key, value):
@@ -16,6 +16,7 @@
 
 import os
 import signal
+import sys
 import multiprocessing
 import accounting.config
 import accounting.db
@@ -84,7 +85,38 @@ def main(pipe):
             print 'DIFF: %s %r -> %r' % (account, old, new)
 
 
+def verify():
+    """Compare the incrementally maintained balances and monthly
+    turnovers with a full re-sum of each account's transactions, and
+    report any drift."""
+    database = accounting.db.connect()
+
+    with context.ReadonlyContext(database) as ctx:
+        print 'Fetching accounts and balances.'
+        accounts = blm.accounting.Account._query(_attrList=[
+            'opening_balance', 'opening_quantity',
+            'balance', 'balance_quantity',
+            'period_turnover', 'period_turnover_quantity']).run()
+        drifted = 0
+        for account in accounts:
+            amount, quantity = account.balanceDrift()
+            turnover = account.turnoverDrift()
+            if amount or quantity or turnover:
+                drifted += 1
+            if amount or quantity:
+                print 'DRIFT: %s amount %s quantity %s' % (
+                    account.id[0], amount, quantity)
+            for period, (amount, quantity) in sorted(turnover.items()):
+                print 'DRIFT: %s period %s amount %s quantity %s' % (
+                    account.id[0], period, amount, quantity)
+        print 'Checked %d accounts, %d drifted.' % (len(accounts), drifted)
+    return drifted
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--verify']:
+        sys.exit(1 if verify() else 0)
+
     parent_conn, child_conn = multiprocessing.Pipe()
 
     verify_proc = multiprocessing.Process(target=check, args=(child_conn,))
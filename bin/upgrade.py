@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys
+import sys, time
 import accounting.config
 from bson.objectid import ObjectId
 import pymongo
@@ -94,6 +94,51 @@ def ensure_indexes(database):
         index = '%s.id' % attr
         log.info('Ensuring index in tois: %s', index)
         database.tois.ensure_index(index)
+    log.info('Ensuring index in outbox: state, next_attempt')
+    database.outbox.ensure_index([('state', 1), ('next_attempt', 1)])
+    log.info('Ensuring index in staletexts: org, changed')
+    database.staletexts.ensure_index([('org', 1), ('changed', 1)])
+
+
+def update_period_turnover(database):
+    """
+    Sum the monthly turnover of accounts that don't have it yet, in
+    commits of 100 accounts.
+    """
+    toids = [doc['_id'] for doc in pytransact.mongo.find(
+        database.tois, {'_bases': 'accounting.Account',
+                        'period_turnover': {'$exists': False}},
+        projection=[])]
+    log.info('Updating period turnover of %d accounts.', len(toids))
+    for chunk in pytransact.iterate.chunks(toids, 100):
+        interested = 'upgrade-turnover-%s' % chunk[0]
+        with commit.CommitContext(database) as ctx:
+            ops = [commit.CallToi(toid, 'updateBalance', [])
+                   for toid in chunk]
+            ctx.runCommit(ops, interested=interested)
+        result, error = commit.wait_for_commit(database, interested=interested)
+        if error:
+            log.error('Could not update period turnover of %s: %s',
+                      interested, error)
+
+
+def seed_ocr_counters(database):
+    """
+    OCR counters are allocated by next_ocr_counter() from the
+    ocrcounters collection, one document per org and year, instead of
+    from Org.ocrCounter. Start this year's counters where
+    Org.ocrCounter left off. Counters that already exist are kept, so
+    this only has an effect the first time.
+    """
+    year = time.strftime('%Y')
+    for doc in pytransact.mongo.find(
+            database.tois, {'_bases': 'accounting.Org',
+                            'ocrYearReset': int(year[-1])},
+            projection=['ocrCounter']):
+        pytransact.mongo.update(
+            database.ocrcounters, {'_id': '%s-%s' % (doc['_id'], year)},
+            {'$setOnInsert': {'next': doc.get('ocrCounter', [1])[0]}},
+            upsert=True)
 
 
 def cleanup_commits(database):
@@ -114,6 +159,7 @@ def main():
         raise SystemExit()
 
     ensure_indexes(database)
+    seed_ocr_counters(database)
     cleanup_commits(database)
     pytransact.utils.update_bases(database, blm.accounting.User)
     pytransact.utils.update_bases(database, blm.members.PGPaymentFile)
@@ -130,6 +176,8 @@ def main():
     result, error = commit.wait_for_commit(database, interested=interested)
     assert not error, error
 
+    update_period_turnover(database)
+
     log.info('Done.')
 
 
@@ -14,10 +14,12 @@ else:
     from io import BytesIO
     PYT3 = True
 
-import io
-import codecs
+import collections
+import hashlib
 import os
 import re
+import tempfile
+import threading
 import time
 import urllib
 
@@ -47,7 +49,7 @@ except ImportError:
 import werkzeug.exceptions
 
 import pymongo
-from pytransact import blm
+from pytransact import blm, mongo
 from pytransact.context import ReadonlyContext
 from pytransact.commit import CommitContext, CallBlm, CallToi, ChangeToi
 from pytransact.commit import wait_for_commit
@@ -137,6 +139,143 @@ debug = __name__ == '__main__'
 
 USER_ACCESS_RESOLUTION = 12 * 60 * 60  # 12 hours
 
+USER_CLASSES = ['accounting.User', 'accounting.APIUser']
+
+# What is cached of a user: TOIs belong to the context they were
+# loaded in, so only their toc, id and last access time are kept.
+CachedUser = collections.namedtuple('CachedUser', 'toc toid lastAccess')
+
+
+class UserCache(object):
+    """
+    Per process cache of the users and API users that requests are
+    authenticated as, so that the common case needs no database
+    round trip.
+
+    Entries expire after TTL seconds, and are evicted when the user's
+    last access time or API key changes, or the TOI is deleted, which
+    is noticed by watching a MongoDB change stream in a background
+    thread. Change streams need a replica set; without one, or if the
+    stream fails, nothing is cached.
+    """
+
+    TTL = 5 * 60
+
+    _caches = {}
+    _lock = threading.Lock()
+
+    # Only changes to the attributes that are cached, or that users are
+    # looked up by, matter. Changes to other tois with such attributes
+    # cause harmless evictions, which is cheaper than looking up every
+    # changed toi to see its class.
+    pipeline = [
+        {'$match': {'ns.coll': 'tois',
+                    '$or': [{'operationType': 'delete'},
+                            {'operationType': 'replace',
+                             'fullDocument._bases': {'$in': USER_CLASSES}},
+                            {'operationType': 'update',
+                             '$or': [
+                                 {'updateDescription.updatedFields.lastAccess':
+                                  {'$exists': True}},
+                                 {'updateDescription.updatedFields.key':
+                                  {'$exists': True}}]}]}},
+        {'$project': {'documentKey': 1}},
+    ]
+
+    @classmethod
+    def get(cls, database):
+        with cls._lock:
+            try:
+                return cls._caches[database.name]
+            except KeyError:
+                cache = cls._caches[database.name] = cls(database)
+                return cache
+
+    def __init__(self, database):
+        self.database = database
+        self.entries = {}  # key -> (user, expires)
+        self.keys = {}  # toid -> set of keys
+        self.generation = 0  # bumped on every change
+        self.changed = {}  # toid -> generation, while looking up
+        self.looking = 0
+        self.available = True
+        self.watching = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def lookup(self, key, find):
+        """
+        Return the CachedUser for key, or else the result of find(),
+        which is cached unless it is None.
+        """
+        with self.lock:
+            if self.available and self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='user-cache')
+                self.thread.daemon = True
+                self.thread.start()
+            user, expires = self.entries.get(key, (None, 0))
+            if expires > time.time():
+                self.hits += 1
+                return user
+            self.misses += 1
+            self.looking += 1
+            generation = self.generation
+
+        user = None
+        try:
+            user = find()
+        finally:
+            with self.lock:
+                self.looking -= 1
+                # if the user changed while looking, it may be stale
+                if (user is not None and self.watching and
+                    self.changed.get(user.toid, 0) <= generation):
+                    self.entries[key] = user, time.time() + self.TTL
+                    self.keys.setdefault(user.toid, set()).add(key)
+                if not self.looking:
+                    self.changed.clear()
+        return user
+
+    def touch(self, key, lastAccess):
+        """
+        Note that the user cached for key has been given a new last
+        access time, so that it isn't committed again before the
+        change stream evicts the entry.
+        """
+        with self.lock:
+            user, expires = self.entries.get(key, (None, 0))
+            if user is not None:
+                user = user._replace(lastAccess=lastAccess)
+                self.entries[key] = user, expires
+
+    def evict(self, toid):
+        with self.lock:
+            self.generation += 1
+            if self.looking:
+                self.changed[toid] = self.generation
+            for key in self.keys.pop(toid, ()):
+                self.entries.pop(key, None)
+
+    def run(self):
+        try:
+            with self.database.watch(self.pipeline) as stream:
+                with self.lock:
+                    self.watching = True
+                for change in stream:
+                    self.evict(change['documentKey']['_id'])
+        except pymongo.errors.PyMongoError:
+            log.exception('Change stream failed, user cache disabled')
+        with self.lock:
+            self.available = self.watching = False
+            self.entries.clear()
+            self.keys.clear()
+
+
+def cached_user(user):
+    return CachedUser(user._fullname, user.id[0], user.lastAccess[0])
+
 
 @app.before_request
 def lookup_current_user():
@@ -148,30 +287,42 @@ def lookup_current_user():
     g.database = current_app.connection[current_app.dbname]
     auth = request.headers.get('Authorization')
     userid = session.get('userid')
+    cache = UserCache.get(g.database)
     with ReadonlyContext(g.database):
         if auth:
-            _, key = auth.split()
-            try:
-                g.user = blm.accounting.APIUser._query(
-                    key=key, _attrList={'lastAccess'}).run()[0]
-            except IndexError:
+            _, apikey = auth.split()
+            key = ('apikey', apikey)
+            def find():
+                for user in blm.accounting.APIUser._query(
+                        key=apikey, _attrList={'lastAccess'}).run():
+                    return cached_user(user)
+            cached = cache.lookup(key, find)
+            if cached is None:
                 raise werkzeug.exceptions.Forbidden()
         elif userid:
-            try:
-                g.user = blm.accounting.User._query(
-                    id=session['userid'], _attrList={'lastAccess'}
-                ).run()[0]
-            except IndexError:
+            key = ('user', userid)
+            def find():
+                for user in blm.accounting.User._query(
+                        id=userid, _attrList={'lastAccess'}).run():
+                    return cached_user(user)
+            cached = cache.lookup(key, find)
+            if cached is None:
                 del session['userid']
-            else:
+        else:
+            cached = None
+        if cached is not None:
+            toc = blm.getTocByFullname(cached.toc)
+            g.user = toc._create(cached.toid)
+            if userid and not auth:
                 invitation = session.pop('invitation', None)
                 if invitation:
                     result = acceptInvitation(g.user, invitation)
-        if g.user:
-            if g.user.lastAccess[0] + USER_ACCESS_RESOLUTION < time.time():
-                op = ChangeToi(g.user, {'lastAccess': [time.time()]})
+            if cached.lastAccess + USER_ACCESS_RESOLUTION < time.time():
+                now = time.time()
+                op = ChangeToi(g.user, {'lastAccess': [now]})
                 with CommitContext.clone() as ctx:
                     ctx.runCommit([op])  # not interested
+                cache.touch(key, now)
 
     return result
 
@@ -426,6 +577,78 @@ def imageUpload():
     return jsonify(**result)
 
 
+BLOB_CHUNK_SIZE = 64 * 1024
+
+
+def iter_blob(blob, start, end, chunk_size=BLOB_CHUNK_SIZE):
+    blob.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = blob.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def blob_etag(toid, attribute, index):
+    """
+    Return an ETag for a stored blob, without reading it.
+
+    Blobs are never changed in place, a changed attribute refers to a
+    newly stored blob, so the reference in the toi identifies the
+    contents.
+    """
+    toi, = mongo.find(g.database.tois, {'_id': toid},
+                      projection=[attribute])
+    ref = repr(toi[attribute][index])
+    return hashlib.sha1(ref.encode('utf-8')).hexdigest()
+
+
+def blob_response(blob, etag):
+    """
+    Stream blob in chunks, honouring conditional and (single) range
+    requests.
+    """
+    response = Response(content_type=blob.content_type,
+                        direct_passthrough=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    length = blob.length
+    start, end = 0, length
+    byterange = request.range
+    if_range = request.headers.get('If-Range')
+    if (byterange is not None and len(byterange.ranges) == 1 and
+        if_range in (None, '"%s"' % etag)):
+        bounds = byterange.range_for_length(length)
+        if bounds is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */%d' % length
+            return response
+        start, end = bounds
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, end - 1, length)
+
+    database = g.database
+
+    def generate():
+        # The response is consumed after the view has returned, so
+        # reading needs a context of its own.
+        with ReadonlyContext(database):
+            for chunk in iter_blob(blob, start, end):
+                yield chunk
+
+    response.response = generate()
+    response.headers['Content-Length'] = str(end - start)
+    return response
+
+
 @app.route('/image/<objectid:toid>')
 def image(toid):
     with ReadonlyContext(g.database):
@@ -434,9 +657,8 @@ def image(toid):
             raise werkzeug.exceptions.NotFound()
 
         try:
-            response = Response(response=toi[0].image[0].getvalue(),
-                                content_type=toi[0].image[0].content_type)
-            response.headers['Cache-Control'] = 'no-cache'
+            response = blob_response(toi[0].image[0],
+                                     blob_etag(toid, 'image', 0))
         except IndexError:
             raise werkzeug.exceptions.NotFound()
 
@@ -469,15 +691,22 @@ def image2(toid, attribute, index, width, height):
         if not isinstance(attr, BlobVal):
             raise werkzeug.exceptions.Forbidden()
 
-        content_type = attr.content_type
-        if width and height:
-            data, content_type = accounting.thumbnail.thumbnail(
-                attr.getvalue(), content_type, width, height)
-        else:
-            data = attr.getvalue()
+        etag = blob_etag(toid, attribute, index)
+        if not (width and height):
+            return blob_response(attr, etag)
 
-        response = Response(response=data,
-                            content_type=content_type)
+        key = accounting.thumbnail.cache_key(etag, width, height)
+        if request.if_none_match.contains(key):
+            response = Response(status=304)
+        else:
+            def read():
+                attr.seek(0)
+                return attr.read()
+            data, content_type = accounting.thumbnail.cached_thumbnail(
+                read, attr.content_type, width, height, key)
+            response = Response(response=data,
+                                content_type=content_type)
+        response.set_etag(key)
         response.headers['Cache-Control'] = 'no-cache'
         return response
 
@@ -489,7 +718,7 @@ def _thumbnail(width, height):
     data = file.read()
     data = data.decode('base64')
 
-    thumb, content_type = accounting.thumbnail.thumbnail(
+    thumb, content_type = accounting.thumbnail.cached_thumbnail(
         data, content_type, width, height)
     response = Response(response=thumb,
                         content_type=content_type)
@@ -499,13 +728,21 @@ def _thumbnail(width, height):
 @app.route('/export/<string:toid>')
 @requires_login()
 def export(toid):
-    fp = codecs.getwriter('cp437')(BytesIO(), 'backslashreplace')
     with ReadonlyContext(g.database, g.user):
         accyear, = blm.accounting.Accounting._query(id=toid).run()
         filename = u'%s - %s.sie' % (accyear.org[0].name[0], accyear.name[0])
-        accounting.sie_export.sie_export(fp, accyear)
 
-    response = Response(response=fp.getvalue(),
+    database, user = g.database, g.user
+
+    def generate():
+        # The response is consumed after the view has returned, so
+        # the export needs a context of its own.
+        with ReadonlyContext(database, user):
+            accyear, = blm.accounting.Accounting._query(id=toid).run()
+            for s in accounting.sie_export.iter_sie_export(accyear):
+                yield s.encode('cp437', 'backslashreplace')
+
+    response = Response(response=generate(),
                         content_type='text/plain; charset=cp437')
     if PYT3:
         response.headers['Content-Disposition'] = (
@@ -656,12 +893,19 @@ def getTickets(purchase, random=None):
     result, error = wait_for_commit(database, interested)
     if error:
         raise error
-    pdf = io.BytesIO()
+    # Large purchases make large PDFs, so spool them to disk and
+    # stream them from there.
+    pdf = tempfile.TemporaryFile()
     with ReadonlyContext(database) as ctx:
         tickets = blm.members.Ticket._query(id=result[0]).run()
-        members.ticket.generate(pdf, tickets)
+        members.ticket.generate(pdf, tickets, pool=members.ticket.get_pool())
+    length = pdf.tell()
 
-    return Response(response=pdf.getvalue(), mimetype='application/pdf')
+    response = Response(response=iter_blob(pdf, 0, length),
+                        mimetype='application/pdf', direct_passthrough=True)
+    response.headers['Content-Length'] = str(length)
+    response.call_on_close(pdf.close)
+    return response
 
 
 @app.route('/getTicket/<objectid:ticket>/<base64long:random>')
@@ -899,7 +1143,9 @@ def jslink():
     import pytransact.link
     import accounting.jslink
     factory = pytransact.link.LinkFactory()
-    jslink = accounting.jslink.JsLink(linkFactory=factory)
+    jslink = accounting.jslink.JsLink(
+        linkFactory=factory,
+        longPoll=config.config.getint('accounting', 'jslink_long_poll'))
     with CommitContext(g.database, g.user):
         result = jslink.render(request)
     return result
@@ -268,6 +268,61 @@ require(["jslink/JsLink"], function(JsLink) {
             return d
         },
 
+        test_setupPolling_rejected: function() {
+            var d = new Deferred()
+            var proto = JsLink.prototype
+            var calls = []
+
+            var fakeJsLink = {
+                clientId: "ID",
+                nPending: 0,
+                pollingInterval: 11,
+                pollingErrors: 0,
+                polling: false,
+                maxPollingBackoff: proto.maxPollingBackoff,
+
+                _wait: function(interval) {
+                    return Promise.resolve()
+                },
+
+                _do_poll: function() {
+                    calls.push('poll')
+                    return Promise.reject('connection lost')
+                },
+
+                restartPolling: function(timeout) {
+                    calls.push(['restartPolling', timeout])
+                }
+            }
+
+            proto.setupPolling.call(fakeJsLink)
+            aok(!fakeJsLink.polling)
+            setTimeout(function() {
+                try {
+                    // polling is not stuck, and is retried with backoff
+                    aisDeeply(calls, ['poll', ['restartPolling', 2]])
+                    ais(fakeJsLink.polling, false)
+                    ais(fakeJsLink.pollingErrors, 1)
+
+                    calls = []
+                    fakeJsLink.pollingErrors = 10
+                    proto.setupPolling.call(fakeJsLink)
+                    setTimeout(function() {
+                        try {
+                            aisDeeply(calls, ['poll', ['restartPolling', 60]])
+                            d.callback()
+                        } catch (err) {
+                            d.errback(err)
+                        }
+                    }, 0)
+                } catch (err) {
+                    d.errback(err)
+                }
+            }, 0)
+
+            return d
+        },
+
         // poll_errors: function(resource, expected) {
         //     var errors = []
         //     OpenEnd.Support.errorHandler = function(msg, errData) {
@@ -21,10 +21,12 @@ try:
 except ImportError:
     from io import StringIO
     from io import BytesIO
-import decimal, json, logging, os, re, string, sys
+import decimal, json, logging, os, re, string, sys, threading, time
+from multiprocessing.pool import ThreadPool
 from pytransact.context import ReadonlyContext
 from pytransact.commit import CommitContext, ChangeToi, CreateToi, CallBlm, \
     wait_for_commit
+from pytransact import mongo
 from pytransact import queryops as q
 from accounting import jsonserialization, templating
 import accounting.db, accounting.config, accounting.mail
@@ -42,6 +44,31 @@ PRICES = 200, 200, 400, 800#, 1600
 templates = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
                                          'templates'))
 
+class Checkpoint(object):
+    """
+    Keep track of which orgs have been billed, so that a crashed run
+    can be resumed. The file has one org id per line.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.done = set()
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.done.update(line.strip() for line in f)
+
+    def __contains__(self, toid):
+        return str(toid) in self.done
+
+    def add(self, toid):
+        with self.lock:
+            self.done.add(str(toid))
+            if self.filename:
+                with open(self.filename, 'a') as f:
+                    f.write('%s\n' % toid)
+
+
 class Billing(object):
 
     OE_ORGNUM = blm.accounting.Org._oeOrgNum
@@ -135,7 +162,58 @@ class Billing(object):
     ignored_providers = (blm.accounting.SimulatorProvider,
                          blm.accounting.ManualProvider)
 
-    def handle_org(self, orgid, year):
+    def chargeable_counts(self, year, orgids=None):
+        """
+        Count the chargeable payments and automated supplier invoices
+        of year per org, reading only the references needed rather
+        than loading the TOIs.
+
+        Returns {orgid: count}, with only orgs that have (non ignored)
+        payment providers as keys.
+        """
+        start, end = (s % year for s in ('%s-01-01', '%s-12-31'))
+        query = {} if orgids is None else {'org': orgids}
+        with ReadonlyContext(self.db):
+            providers = dict(
+                (toi.id[0], toi.org[0].id[0]) for toi in
+                blm.accounting.PaymentProvider._query(
+                    _attrList=['org'], **query).run()
+                if toi.org and not isinstance(toi, self.ignored_providers))
+
+        counts = dict.fromkeys(providers.values(), 0)
+        for doc in mongo.find(self.db.tois,
+                              {'_bases': 'members.Payment',
+                               'paymentProvider.id': {'$in': list(providers)},
+                               'transaction_date': {'$gte': start,
+                                                    '$lte': end}},
+                              projection=['paymentProvider']):
+            for ref in doc['paymentProvider']:
+                if ref['id'] in providers:
+                    counts[providers[ref['id']]] += 1
+
+        for doc in mongo.find(self.db.tois,
+                              {'_bases': 'accounting.SupplierInvoice',
+                               'org.id': {'$in': list(counts)},
+                               'automated': True,
+                               'accounted': True,
+                               'transaction_date': {'$gte': start,
+                                                    '$lte': end}},
+                              projection=['org']):
+            for ref in doc['org']:
+                if ref['id'] in counts:
+                    counts[ref['id']] += 1
+
+        return counts
+
+    def handle_org(self, orgid, year, chargeables=False):
+        """
+        Invoice org for year, unless already done. chargeables is the
+        org's entry from chargeable_counts(), None if it has no
+        payment providers, or False to look it up.
+        """
+        if chargeables is False:
+            chargeables = self.chargeable_counts(year, [orgid]).get(orgid)
+
         with CommitContext(self.db) as ctx:
             org, = blm.accounting.Org._query(id=orgid).run()
             subscriptionLevel = org.subscriptionLevel[:]
@@ -148,21 +226,9 @@ class Billing(object):
                 }
 
             openend, = blm.accounting.Org._query(orgnum=self.OE_ORGNUM).run()
-            providers = blm.accounting.PaymentProvider._query(org=org).run()
-            providers = [toi for toi in providers if not isinstance(toi, self.ignored_providers)]  #filter(lambda toi: not isinstance(toi, self.ignored_providers), providers)
-            start, end = (s % year for s in ('%s-01-01', '%s-12-31'))
-            payments = blm.members.Payment._query(
-                paymentProvider=providers,
-                transaction_date=q.Between(start, end)).run()
-            supplierinvoices = blm.accounting.SupplierInvoice._query(
-                org=org,
-                automated=True,
-                accounted=True,
-                transaction_date=q.Between(start, end)).run()
-            chargeables = len(payments) + len(supplierinvoices)
 
             toInvoice = [self.subscription]
-            if providers:
+            if chargeables is not None:
                 for limit, product in self.products:
                     toInvoice.append(product)
                     if chargeables <= limit:
@@ -273,8 +339,54 @@ class Billing(object):
             if error:
                 raise error
 
-    def process(self, year):
-        for orgid in self.iter_orgs():
-            self.handle_org(orgid, year)
-        for invoiceid in self.iter_invoices():
-            self.send_invoice(invoiceid)
+    def run_parallel(self, func, items, workers):
+        if workers <= 1:
+            for item in items:
+                func(item)
+            return
+        pool = ThreadPool(workers)
+        try:
+            for _ in pool.imap_unordered(func, items):
+                pass
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def process(self, year, workers=None, checkpoint=None):
+        config = accounting.config.config
+        if workers is None:
+            workers = config.getint('billing', 'workers')
+        if checkpoint is None and config.get('billing', 'checkpoint_dir'):
+            checkpoint = os.path.join(config.get('billing', 'checkpoint_dir'),
+                                      'billing-%s' % year)
+        checkpoint = Checkpoint(checkpoint)
+
+        if workers > 1:
+            # look these up before the workers race to do it
+            self.subscription, self.products
+
+        orgids = [orgid for orgid in self.iter_orgs()
+                  if orgid not in checkpoint]
+
+        counts = self.chargeable_counts(year)
+
+        def handle_org(orgid):
+            self.handle_org(orgid, year, counts.get(orgid))
+            checkpoint.add(orgid)
+
+        start = time.time()
+        self.run_parallel(handle_org, orgids, workers)
+        elapsed = max(time.time() - start, 1e-6)
+        log.info('Billed %d orgs in %.1f s (%.1f orgs/s)',
+                 len(orgids), elapsed, len(orgids) / elapsed)
+
+        invoiceids = list(self.iter_invoices())
+        start = time.time()
+        self.run_parallel(self.send_invoice, invoiceids, workers)
+        elapsed = max(time.time() - start, 1e-6)
+        log.info('Sent %d invoices in %.1f s (%.1f invoices/s)',
+                 len(invoiceids), elapsed, len(invoiceids) / elapsed)
@@ -604,8 +604,10 @@ class BasePurchase(TO):
         log.info('Sending confirmation email for %s to %s',
                  self.id[0], self.buyerEmail[0])
         orgid = str(self.org[0].id[0])
-        mail.sendmail(*mail.makemail(body, envfrom=orgid, **headers),
-                       identity=orgid)
+        mail.enqueue(*mail.makemail(body, envfrom=orgid, **headers),
+                     identity=orgid,
+                     key='%s-confirmation' % self.id[0],
+                     confirm=(self.id[0], 'confirmationEmailSent', True))
         self.confirmationEmailSent = [True]
 
     @method(None)
@@ -624,8 +626,13 @@ class BasePurchase(TO):
         log.info('Sending reminder email for %s to %s',
                  self.id[0], self.buyerEmail[0])
         orgid = str(self.org[0].id[0])
-        mail.sendmail(*mail.makemail(body, envfrom=orgid, **headers),
-                       identity=orgid)
+        # a rerun commit sends the same reminder, confirmed by its
+        # place in reminderEmailsSent rather than by its time
+        n = len(self.reminderEmailsSent)
+        mail.enqueue(*mail.makemail(body, envfrom=orgid, **headers),
+                     identity=orgid,
+                     key='%s-reminder-%d' % (self.id[0], n),
+                     confirm=(self.id[0], 'reminderEmailsSent.%d' % n, None))
         self.reminderEmailsSent.append(time.time())
 
     @method(Serializable())
@@ -729,13 +736,24 @@ class BasePurchase(TO):
 
     @method(ToiRef(ToiType('Ticket')))
     def maketickets(self):
+        items = [item for item in self.items
+                 if item.product and item.product[0].makeTicket[0] and
+                 item.paid[0]]
+        if not items:
+            return []
+
+        existing = collections.defaultdict(list)
+        query = Ticket._query(purchaseitem=items)
+        query.attrList = ['purchaseitem']
+        for ticket in query.run():
+            existing[ticket.purchaseitem[0]].append(ticket)
+
         result = []
-        for item in self.items:
-            if item.product and item.product[0].makeTicket[0] and item.paid[0]:
-                tickets = Ticket._query(purchaseitem=item).run()
-                result.extend(tickets)
-                for i in range(item.quantity[0]-len(tickets)):
-                    result.append(Ticket(purchaseitem=[item]))
+        for item in items:
+            tickets = existing[item]
+            result.extend(tickets)
+            for i in range(item.quantity[0]-len(tickets)):
+                result.append(Ticket(purchaseitem=[item]))
 
         return result
 
@@ -1050,6 +1068,24 @@ def purchase(data=Serializable(Quantity(1))):
              'invoiceUrl': purchase.invoiceUrl[0]}]
 
 
+_sysrandom = random.SystemRandom()
+_ticket_keys = {}
+
+def get_ticket_key():
+    """
+    Return the DSA key tickets are signed with.
+
+    Constructing the key is slow compared to signing, so it is only
+    done once per process (and value of accounting.ticket_key).
+    """
+    data = config.config.get('accounting', 'ticket_key')
+    try:
+        return _ticket_keys[data]
+    except KeyError:
+        key = _ticket_keys[data] = DSA.construct(json.loads(data))
+        return key
+
+
 class Ticket(TO):
     class purchaseitem(ToiRef(ToiType(PurchaseItem), Quantity(1))):
         pass
@@ -1074,7 +1110,7 @@ class Ticket(TO):
     class random(Int(post=Quantity(1))):
         def on_create(attr, val, self):
             if not val:
-                return [random.SystemRandom().getrandbits(32)]
+                return [_sysrandom.getrandbits(32)]
             else:
                 return [val[0] & 0xffffffff] # must fit in 32 bits
         on_update = on_create
@@ -1120,13 +1156,12 @@ class Ticket(TO):
             'random' : base64long.encode(self.random[0]),
             'product': self.purchaseitem[0].product[0].id[0]
             })
-        key = DSA.construct(json.loads(
-                config.config.get('accounting', 'ticket_key')))
+        key = get_ticket_key()
         if PYT3:
             h = SHA.new(qrcode.encode('ascii')).digest()
         else:
             h = SHA.new(qrcode).digest()
-        k = random.SystemRandom().randint(1, key.q-1)
+        k = _sysrandom.randint(1, key.q-1)
         sig = tuple(map(base64long.encode, key.sign(h,k)))
 
         self.qrcode = [qrcode + '%s/%s' % sig]
@@ -1161,9 +1196,40 @@ class GiroPaymentFile(TO):
         related = 'GiroPayment.paymentFile'
 
     @method(None)
-    def match(self):
-        for payment in self.payments:
-            payment.match()
+    def match(self, payments=ToiRef(ToiType('GiroPayment'))):
+        """Match the payments of the file with purchases, or only
+        those of payments, if given."""
+        if payments:
+            query = GiroPayment._query(paymentFile=self, id=payments)
+        else:
+            query = GiroPayment._query(paymentFile=self)
+        query.attrList = ['paymentProvider', 'refs', 'matchedPurchase',
+                          'payerAddress', 'payingAccountAddress']
+        payments = query.run()
+
+        # Look up the purchases of all payments in the file at once
+        orgs, refs = set(), set()
+        for payment in payments:
+            for provider in payment.paymentProvider:
+                orgs.update(provider.org)
+                refs.update(payment.refs)
+        purchases = collections.defaultdict(list)
+        if orgs and refs:
+            query = BasePurchase._query(org=list(orgs), ocr=q.In(refs))
+            query.attrList = ['org', 'ocr', 'buyerName']
+            for purchase in query.run():
+                purchases[purchase.org[0], purchase.ocr[0]].append(purchase)
+
+        for payment in payments:
+            found = None
+            if payment.paymentProvider:
+                found = []
+                for org in payment.paymentProvider[0].org:
+                    for ref in payment.refs:
+                        for purchase in purchases[org, ref]:
+                            if purchase not in found:
+                                found.append(purchase)
+            payment._match(found)
 
     @property
     def Parser(self):
@@ -1178,8 +1244,7 @@ class GiroPaymentFile(TO):
         parser = self.Parser()
 
         self.data[0].seek(0)
-        for line in self.data[0].readlines():
-            parser.parse(line)
+        parser.parse_data(self.data[0].read())
 
         records = parser.records
 
@@ -1188,6 +1253,22 @@ class GiroPaymentFile(TO):
 
         log.info('Processing %s', self.fileId[0])
 
+        # Check for duplicates of all transactions in the file at once
+        numbers = [transaction.transaction_number
+                   for account in records.giro_accounts
+                   for transaction in account.transactions
+                   if transaction.transaction_number]
+        seen = set()
+        if numbers:
+            query = self.Payment._query(
+                pgnum=q.In(set(account.account
+                               for account in records.giro_accounts)),
+                transactionNumber=q.In(set(numbers)))
+            query.attrList = ['pgnum', 'transactionNumber']
+            seen.update((payment.pgnum[0], payment.transactionNumber[0])
+                        for payment in query.run()
+                        if payment.transactionNumber)
+
         for account in records.giro_accounts:
             transaction_date = account.transaction_date.strftime('%Y-%m-%d')
             for transaction in account.transactions:
@@ -1195,12 +1276,13 @@ class GiroPaymentFile(TO):
                            'Bank Giro': ['bg']}.get(
                     getattr(transaction, 'payer_account_type', None), [])
 
-                if self.Payment._query(
-                        pgnum=account.account,
-                        transactionNumber=transaction.transaction_number).run():
+                key = account.account, transaction.transaction_number
+                if key in seen:
                     raise RuntimeError('Duplicate transaction: %s %s',
                                        account.account,
                                        transaction.transaction_number)
+                if transaction.transaction_number:
+                    seen.add(key)
 
                 payment = self.Payment(
                     paymentFile=[self],
@@ -1432,8 +1514,13 @@ class Payment(TO):
         log.info('Sending payment confirmation email for %s to %s',
                  self.id[0], purchase.buyerEmail[0])
         orgid = str(self.org[0].id[0])
-        mail.sendmail(*mail.makemail(body, envfrom=orgid, **headers),
-                       identity=orgid)
+        key = '%s-confirmation' % self.id[0]
+        if force:
+            key = '%s-%s' % (key, ObjectId())  # resends are new mails
+        mail.enqueue(*mail.makemail(body, envfrom=orgid, **headers),
+                     identity=orgid,
+                     key=key,
+                     confirm=(self.id[0], 'confirmationEmailSent', True))
         self.confirmationEmailSent = [True]
 
     def calc_buyerdescr(self):
@@ -1525,10 +1612,17 @@ class GiroPayment(Payment):
     def match(self):
         # xxx this query is naive as we're not certain only ocr
         # numbers are present in refs
+        purchases = None
         if self.paymentProvider:
             purchases = BasePurchase._query(
                 org=self.paymentProvider[0].org,
                 ocr=self.refs).run()
+        self._match(purchases)
+
+    def _match(self, purchases):
+        """Match with purchases, looked up from self.refs by the caller,
+        or None if there is no payment provider."""
+        if purchases is not None:
             assert len(purchases) <= 1
             if self.matchedPurchase and purchases != self.matchedPurchase:
                 raise RuntimeError # This shouldn't happen [TM]
@@ -18,6 +18,7 @@ import copy, decimal, email, py.test, time, json
 import stripe, stripe.resource
 from bson.objectid import ObjectId
 from pytransact.exceptions import ClientError, LocalisedError
+from pytransact import mongo
 from pytransact.testsupport import BLMTests, Time
 from accounting import config, mail, payson, seqr
 import members
@@ -534,10 +535,10 @@ class TestPurchase(BLMTests):
 
     def test_confirmation_email(self, monkeypatch):
         calls = []
-        def sendmail(*args, **kw):
+        def enqueue(*args, **kw):
             assert kw['identity'] == str(purchase.org[0].id[0])
             calls.append(args)
-        monkeypatch.setattr(mail, 'sendmail', sendmail)
+        monkeypatch.setattr(mail, 'enqueue', enqueue)
         config.config.set('accounting', 'baseurl', 'http://xyz/')
         config.config.set('accounting', 'smtp_domain', 'example.com')
         purchase = blm.members.Purchase(
@@ -567,10 +568,10 @@ class TestPurchase(BLMTests):
 
     def test_invoice_confirmation_email(self, monkeypatch):
         calls = []
-        def sendmail(*args, **kw):
+        def enqueue(*args, **kw):
             assert kw['identity'] == str(purchase.org[0].id[0])
             calls.append(args)
-        monkeypatch.setattr(mail, 'sendmail', sendmail)
+        monkeypatch.setattr(mail, 'enqueue', enqueue)
         config.config.set('accounting', 'baseurl', 'http://xyz/')
         config.config.set('accounting', 'smtp_domain', 'example.com')
         purchase = blm.members.Invoice(
@@ -600,10 +601,12 @@ class TestPurchase(BLMTests):
 
     def test_send_reminder_email(self, monkeypatch):
         calls = []
-        def sendmail(*args, **kw):
+        confirms = []
+        def enqueue(*args, **kw):
             assert kw['identity'] == str(purchase.org[0].id[0])
             calls.append(args)
-        monkeypatch.setattr(mail, 'sendmail', sendmail)
+            confirms.append((kw['key'], kw['confirm']))
+        monkeypatch.setattr(mail, 'enqueue', enqueue)
         config.config.set('accounting', 'baseurl', 'http://xyz/')
         config.config.set('accounting', 'smtp_domain', 'example.com')
         purchase = blm.members.Purchase(
@@ -636,6 +639,12 @@ class TestPurchase(BLMTests):
         purchase.sendReminderEmail()
         assert purchase.reminderEmailsSent == [now1, now2]
 
+        # confirmed by position, which is the same if the commit is rerun
+        toid = purchase.id[0]
+        assert confirms == [
+            ('%s-reminder-0' % toid, (toid, 'reminderEmailsSent.0', None)),
+            ('%s-reminder-1' % toid, (toid, 'reminderEmailsSent.1', None))]
+
     def test_validate_org(self):
         org2 = blm.accounting.Org()
         prod3 = blm.members.Product(org=[org2], name=['baz'])
@@ -712,6 +721,26 @@ class TestPurchase(BLMTests):
 
         assert set(tickets) == set(purchase.maketickets())
 
+    def test_maketickets_batch(self, monkeypatch):
+        free1 = blm.members.PurchaseItem(product=self.product4, quantity=[3])
+        free2 = blm.members.PurchaseItem(product=self.product4, quantity=[2])
+        purchase = blm.members.Purchase(items=[free1, free2])
+        existing = blm.members.Ticket(purchaseitem=[free2])
+
+        queries = []
+        _query = blm.members.Ticket._query
+        def query(**kw):
+            queries.append(kw)
+            return _query(**kw)
+        monkeypatch.setattr(blm.members.Ticket, '_query', staticmethod(query))
+
+        tickets = purchase.maketickets()
+        assert len(queries) == 1
+        assert len(tickets) == 5
+        assert [t.purchaseitem[0] for t in tickets] == [free1] * 3 + [free2] * 2
+        assert existing in tickets
+        assert len(set(t.qrcode[0] for t in tickets)) == 5
+
     def test_partial_payments(self):
         purchase = blm.members.Purchase(
             items=[blm.members.PurchaseItem(product=self.product1)])
@@ -1243,6 +1272,18 @@ class TestTicket(BLMTests):
         assert ticket.random[0] == int(barcode) & 0xffffffff
         assert int(str(ticket.id[0]),16) == int(barcode) >> 32
 
+    def test_ticket_key(self):
+        key = blm.members.get_ticket_key()
+        assert (key.y, key.g, key.p, key.q, key.x) == (
+            self.key.y, self.key.g, self.key.p, self.key.q, self.key.x)
+        assert blm.members.get_ticket_key() is key
+
+        other = DSA.generate(512)
+        config.config.set('accounting', 'ticket_key',
+                          json.dumps([other.y, other.g, other.p, other.q,
+                                      other.x]))
+        assert blm.members.get_ticket_key().y == other.y
+
     def test_ticket_random32(self):
         item = blm.members.PurchaseItem(product=[self.product])
 
@@ -2245,17 +2286,17 @@ class TestPaymentMails(BLMTests):
         assert self.purchase.paymentState == ['unpaid']
 
         self.mails = []
-        def sendmail(*args, **kw):
+        def enqueue(*args, **kw):
             self.mails.append((args, kw))
-        self._orig_sendmail = mail.sendmail
-        mail.sendmail = sendmail
+        self._orig_enqueue = mail.enqueue
+        mail.enqueue = enqueue
 
         config.config.set('accounting', 'baseurl', 'http://xyz/')
         config.config.set('accounting', 'smtp_domain', 'example.com')
 
     def teardown_method(self, method):
         super(TestPaymentMails, self).teardown_method(method)
-        mail.sendmail = self._orig_sendmail
+        mail.enqueue = self._orig_enqueue
         config.restore(self.config)
 
     def _check_payment_mail(self, type, payment):
@@ -2313,6 +2354,24 @@ class TestPaymentMails(BLMTests):
         payment.sendConfirmationEmail() # nop when confirmationEmailSent is True
         assert self.mails == []
 
+    def test_forced_resend(self):
+        mail.enqueue = self._orig_enqueue
+        payment = blm.members.Payment(
+            org=[self.org],
+            matchedPurchase=[self.purchase],
+            amount = ['100.00'])
+        payment.sendConfirmationEmail()
+        payment.sendConfirmationEmail()  # nop
+        payment.sendConfirmationEmail(force=[True])
+        self.commit()
+
+        messages = list(mongo.find(self.database.outbox, {}))
+        assert len(messages) == 2
+        outbox = mail.Outbox(self.database)
+        for message in messages:
+            assert message['state'] == 'pending'
+            assert outbox.confirmed(message)
+
     def test_match_with_purchase_partial_payment(self):
         payment = blm.members.Payment(
             org=[self.org],
@@ -238,3 +238,69 @@ class TestMatchPayments(BLMTests):
         purchase, = blm.members.Purchase._query().run()
         assert payment.matchedPurchase == [purchase]
         assert purchase.paymentState == ['paid']
+
+    def test_many(self):
+        for i in range(5):
+            blm.members.Purchase(
+                items=[blm.members.PurchaseItem(product=self.product1)])
+        self.commit()
+
+        purchases = blm.members.Purchase._query().run()
+        purchases.sort(key=lambda toi: toi.ocr[0])
+        # one unknown payment
+        unknown = Fake(ocr=['1234567890123'], total=[decimal.Decimal('1')],
+                       buyerName=[], buyerAddress=[])
+
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        out = StringIO()
+        paymentgen.generate_pg_file(self.pgp, purchases[:4] + [unknown],
+                                    timestamp, 1, 1, out=out)
+
+        pf = blm.members.PGPaymentFile(fileName=['foo.txt'], data=[out.getvalue()])
+        pf.process()
+        self.commit()
+
+        paymentFile, = blm.members.PGPaymentFile._query().run()
+        paymentFile.match()
+        self.commit()
+
+        payments = blm.members.PGPayment._query().run()
+        assert len(payments) == 5
+        matched = dict((payment.refs[0], payment.matchedPurchase)
+                       for payment in payments)
+        for purchase in purchases[:4]:
+            assert matched[purchase.ocr[0]] == [purchase]
+        assert matched['1234567890123'] == []
+
+        purchases = blm.members.Purchase._query().run()
+        purchases.sort(key=lambda toi: toi.ocr[0])
+        assert [p.paymentState[0] for p in purchases[:4]] == ['paid'] * 4
+        assert purchases[4].paymentState == ['unpaid']
+
+    def test_some(self):
+        for i in range(2):
+            blm.members.Purchase(
+                items=[blm.members.PurchaseItem(product=self.product1)])
+        self.commit()
+
+        purchases = blm.members.Purchase._query().run()
+        purchases.sort(key=lambda toi: toi.ocr[0])
+
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        out = StringIO()
+        paymentgen.generate_pg_file(self.pgp, purchases, timestamp, 1, 1,
+                                    out=out)
+
+        pf = blm.members.PGPaymentFile(fileName=['foo.txt'], data=[out.getvalue()])
+        pf.process()
+        self.commit()
+
+        paymentFile, = blm.members.PGPaymentFile._query().run()
+        first = blm.members.PGPayment._query(refs=purchases[0].ocr).run()
+        paymentFile.match(first)
+        self.commit()
+
+        matched = dict((payment.refs[0], payment.matchedPurchase)
+                       for payment in blm.members.PGPayment._query().run())
+        assert matched[purchases[0].ocr[0]] == [purchases[0]]
+        assert matched[purchases[1].ocr[0]] == []
@@ -14,8 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
+from datetime import date, datetime
 from decimal import Decimal
+import operator
 try:
     from exceptions import ValueError   #py2
 except ImportError:
@@ -256,67 +257,141 @@ class BGRecords(object):
         self.current_account.pg_account = pg_account
         self.giro_accounts.append(self.current_account)
 
+def _text(value):
+    return value.rstrip()
+
+if unicode is not str:  # py2, decode text fields only
+    def _text(value):
+        return value.rstrip().decode('iso8859-1')
+
+
+def _date(value):
+    "datetime.strptime(value, '%Y%m%d').date(), but faster"
+    if len(value) == 8 and value.isdigit():
+        return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    return datetime.strptime(value, '%Y%m%d').date()
+
+
+def _short_date(value):
+    "datetime.strptime(value, '%y%m%d').date(), but faster"
+    if len(value) == 6 and value.isdigit():
+        year = int(value[:2])
+        year += 2000 if year < 69 else 1900  # same pivot as strptime
+        return date(year, int(value[2:4]), int(value[4:]))
+    return datetime.strptime(value, '%y%m%d').date()
+
+
+def _short_date_or_zeros(value):
+    try:
+        return _short_date(value)
+    except ValueError:
+        if value == '000000':
+            return None
+        raise
+
+
+def _short_date_or_blank(value):
+    try:
+        return _short_date(value)
+    except ValueError:
+        if value.strip() == '':
+            return None
+        elif value == 'GENAST':
+            return value
+        raise
+
+
+converters = {
+    'T': _text,                                        # Text
+    'A': lambda value: value.lstrip('0'),              # Account
+    'I': int,                                          # Integer
+    'D': _date,                                        # Date YYYYMMDD
+    'd': _short_date,                                  # Date YYMMDD
+    'd0': _short_date_or_zeros,                        # YYMMDD or 000000
+    'd_': _short_date_or_blank,                        # YYMMDD, blank or GENAST
+    'C': lambda value: Decimal(value[:-4] + '.' + value[-4:]),  # Currency
+    'N': lambda value: Decimal(value[:-2] + '.' + value[-2:]),  # Amount
+    }
+
+
+def compile_fields(fieldlist):
+    """
+    Compile a record layout, as in the *_fielddefs tables, into a
+    function that decodes a line of text into a list of parameters.
+    """
+    slices, convert = [], []
+    for start, stop, param_type in fieldlist:
+        if param_type in ('_', '0'):  # Reserved field (blanks/zeros), skip
+            continue
+        try:
+            convert.append(converters[param_type])
+        except KeyError:
+            raise ValueError('Unknown fieldtype', param_type)
+        slices.append(slice(start - 1, stop))
+
+    if len(slices) == 1:
+        (field,), (func,) = slices, convert
+        return lambda line: [func(line[field])]
+    getfields = operator.itemgetter(*slices)
+    return lambda line: [func(value) for func, value in
+                         zip(convert, getfields(line))]
+
+
+_decoders = {}  # tuple(fieldlist) -> decode function
+
+
+def decoder(fieldlist):
+    """
+    Return the compiled decode function of a record layout, shared by
+    all parsers.
+    """
+    layout = tuple(fieldlist)
+    try:
+        return _decoders[layout]
+    except KeyError:
+        return _decoders.setdefault(layout, compile_fields(fieldlist))
+
+
 class Parser(object):
     def __init__(self):
         self.linecount = 0
 
+    @property
+    def decoders(self):
+        """{key: (decode, method)} of the records this parser has seen"""
+        try:
+            return self._decoders
+        except AttributeError:
+            self._decoders = {}
+            return self._decoders
+
     def parse(self, txt):
         if py3chr(txt[0]) in '\r\n':
             return
         self.linecount += 1
-        key = py3txt(txt[:2])
-        subfields, method = self.fielddefs[key]
-        params = self.parse_subfields(subfields, txt)
-        method(self, *params)
+        txt = py3txt(txt)
+        key = txt[:2]
+        try:
+            decode, method = self.decoders[key]
+        except KeyError:
+            subfields, method = self.fielddefs[key]
+            decode = decoder(subfields)
+            self.decoders[key] = decode, method
+        method(self, *decode(txt))
+
+    def parse_data(self, data):
+        """
+        Parse a whole file, given as bytes or an mmap.
+        """
+        start, end = 0, len(data)
+        while start < end:
+            stop = data.find(b'\n', start)
+            stop = end if stop == -1 else stop + 1
+            self.parse(data[start:stop])
+            start = stop
 
     def parse_subfields(self, fieldlist, txt):
-        params =[]
-        for start, stop, param_type in fieldlist:
-            subfield = py3txt(txt[start-1: stop])
-            if param_type == '_': # Reseved field (blanks), skip
-                continue
-            elif param_type == '0': # Reserved field (zeros), skip
-                continue
-            elif param_type == 'T': # Text
-                subfield = subfield.rstrip()
-                try:
-                    subfield = subfield.decode('iso8859-1')
-                except AttributeError:
-                    pass
-            elif param_type == 'A': # Account
-                subfield = subfield.lstrip('0')
-            elif param_type == 'I': # Integer
-                subfield = int(subfield)
-            elif param_type == 'D': # Date YYYYMMDD
-                subfield = datetime.strptime(subfield, '%Y%m%d').date()
-            elif param_type == 'd': # Date YYMMDD
-                subfield = datetime.strptime(subfield, '%y%m%d').date()
-            elif param_type == 'd0': # Date YYMMDD or 000000
-                try:
-                    subfield = datetime.strptime(subfield, '%y%m%d').date()
-                except ValueError:
-                    if subfield == '000000':
-                        subfield = None
-                    else:
-                        raise
-            elif param_type == 'd_': # Date YYMMDD or blank or GENAST
-                try:
-                    subfield = datetime.strptime(subfield, '%y%m%d').date()
-                except ValueError:
-                    if subfield.strip() == '':
-                        subfield = None
-                    elif subfield == 'GENAST':
-                        pass
-                    else:
-                        raise
-            elif param_type == 'C': # Currency
-                subfield = Decimal(subfield[:-4] + '.' + subfield[-4:])
-            elif param_type == 'N': # Amount in decimal
-                subfield = Decimal(subfield[:-2] + '.' + subfield[-2:])
-            else:
-                raise ValueError('Unknown fieldtype', param_type, ' for subfield ', subfield)
-            params.append(subfield)
-        return params
+        return decoder(fieldlist)(py3txt(txt))
 
 class PGParser(Parser):
     def __init__(self):
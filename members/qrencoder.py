@@ -33,6 +33,7 @@
 # DENSO WAVE INCORPORATED
 #   http://www.denso-wave.com/qrcode/faqpatent-e.html
 
+import binascii
 import re
 import itertools
 try:
@@ -394,13 +395,27 @@ class QRCode:
                 self.modules[row+r][col-1] = False
 
     def getBestMaskPattern(self):
+        # Build the matrix once, and score each mask on rows and
+        # columns packed into ints (see QRUtil.packRows).
+        size = self.moduleCount
+        self.makeImpl(True, 0)
+        data = [0] * size
+        for col, row in self.dataPosIterator():
+            data[row] |= 1 << col
+        dataCols = QRUtil.transposePacked(data, size)
+        maskRows, maskCols = QRUtil.getPackedMask(0, size)
+        rows = [r ^ (m & d) for r, m, d in
+                zip(QRUtil.packRows(self.modules), maskRows, data)]
+        cols = QRUtil.transposePacked(rows, size)
+
         minLostPoint = None
         pattern = 0
         for i in range(8):
-            self.makeImpl(True, i);
-            transposedmodules = list(zip(*self.modules))
-            lostPoint = QRUtil.getLostPoint(self.modules, transposedmodules,
-                                            minLostPoint)
+            maskRows, maskCols = QRUtil.getPackedMask(i, size)
+            lostPoint = QRUtil.getPackedLostPoint(
+                [r ^ (m & d) for r, m, d in zip(rows, maskRows, data)],
+                [c ^ (m & d) for c, m, d in zip(cols, maskCols, dataCols)],
+                size)
             if (i == 0 or minLostPoint > lostPoint):
                 minLostPoint = lostPoint
                 pattern = i
@@ -559,22 +574,14 @@ class QRCode:
     @staticmethod
     def createBytes(buffer, rsBlocks):
         offset = 0
-        totalCodeCount = 0
         dcdata = []
         ecdata = []
         for block in rsBlocks:
-            totalCodeCount += block.totalCount
             dcCount = block.dataCount
             ecCount = block.totalCount - dcCount
             dcdata.append(buffer.buffer[offset:offset+dcCount])
             offset += dcCount
-            rsPoly = QRUtil.getErrorCorrectPolynomial(ecCount)
-            rawPoly = QRPolynomial(dcdata[-1], rsPoly.getLength() - 1)
-            modPoly = rawPoly.mod(rsPoly)
-            rLen = rsPoly.getLength() - 1
-            mLen = modPoly.getLength()
-            ecdata.append([ (modPoly.get(i) if i >= 0 else 0)
-                          for i in range(mLen - rLen, mLen) ])
+            ecdata.append(QRUtil.getErrorCorrectBytes(dcdata[-1], ecCount))
 
         data = [ d for dd in itertools.chain(
                 zip_longest(*dcdata), zip_longest(*ecdata))
@@ -691,13 +698,60 @@ class QRUtil(object):
     def getMask(cls, maskPattern):
         return cls.maskPattern[maskPattern]
 
-    @staticmethod
-    def getErrorCorrectPolynomial(errorCorrectLength):
+    _errorCorrectPolynomials = {}
+
+    @classmethod
+    def getErrorCorrectPolynomial(cls, errorCorrectLength):
+        try:
+            return cls._errorCorrectPolynomials[errorCorrectLength]
+        except KeyError:
+            pass
         a = QRPolynomial([1], 0);
         for i in range(errorCorrectLength):
             a = a.multiply(QRPolynomial([1, QRMath.gexp(i)], 0) )
+        cls._errorCorrectPolynomials[errorCorrectLength] = a
         return a
 
+    _errorCorrectTables = {}
+
+    @classmethod
+    def getErrorCorrectTable(cls, errorCorrectLength):
+        """
+        Return the generator polynomial (without its leading term)
+        multiplied by each possible byte value, as ints with one
+        coefficient per byte.
+        """
+        try:
+            return cls._errorCorrectTables[errorCorrectLength]
+        except KeyError:
+            pass
+        generator = [LOG_TABLE[n] for n in
+                     cls.getErrorCorrectPolynomial(errorCorrectLength).num[1:]]
+        table = [0]
+        for factor in range(1, 256):
+            factor = LOG_TABLE[factor]
+            product = bytearray(EXP_TABLE[(factor + g) % 255]
+                                for g in generator)
+            table.append(int(binascii.hexlify(product), 16))
+        cls._errorCorrectTables[errorCorrectLength] = table
+        return table
+
+    @classmethod
+    def getErrorCorrectBytes(cls, data, errorCorrectLength):
+        """
+        Return the remainder of data divided by the generator
+        polynomial, computed as a shift register held in an int.
+        """
+        table = cls.getErrorCorrectTable(errorCorrectLength)
+        top = 8 * (errorCorrectLength - 1)
+        full = (1 << 8 * errorCorrectLength) - 1
+        remainder = 0
+        for byte in data:
+            remainder = (((remainder << 8) & full) ^
+                         table[byte ^ (remainder >> top)])
+        return list(bytearray(binascii.unhexlify(
+            '%0*x' % (2 * errorCorrectLength, remainder))))
+
     @classmethod
     def maskScoreRule1vert(cls, modules):
         score = 0
@@ -776,6 +830,96 @@ class QRUtil(object):
 
         return lostPoint
 
+    # Packed representation: each row (or column) of the matrix is an
+    # int with module j in bit j, so that the penalty rules can be
+    # computed with bit operations on whole lines at a time.
+
+    @staticmethod
+    def packRows(modules):
+        return [int(''.join(['1' if m else '0' for m in reversed(row)]), 2)
+                for row in modules]
+
+    @staticmethod
+    def transposePacked(lines, size):
+        bits = [format(line, '0%db' % size)[::-1] for line in lines]
+        return [int(''.join(reversed(col)), 2) for col in zip(*bits)]
+
+    @staticmethod
+    def bitCount(n):
+        return bin(n).count('1')
+
+    _packedMasks = {}
+
+    @classmethod
+    def getPackedMask(cls, maskPattern, size):
+        """Return (rows, columns) of the packed mask pattern"""
+        try:
+            return cls._packedMasks[maskPattern, size]
+        except KeyError:
+            pass
+        mask = cls.getMask(maskPattern)
+        # All mask patterns repeat every 12 rows
+        period = cls.packRows([[mask(i, j) for j in range(size)]
+                               for i in range(12)])
+        rows = [period[i % 12] for i in range(size)]
+        packed = rows, cls.transposePacked(rows, size)
+        cls._packedMasks[maskPattern, size] = packed
+        return packed
+
+    @classmethod
+    def packedScoreRule1(cls, lines, size):
+        """Same as maskScoreRule1vert, but along each packed line"""
+        full = (1 << (size - 1)) - 1
+        score = 0
+        for line in lines:
+            # bit j set if module j and j + 1 are the same
+            same = ~(line ^ (line >> 1)) & full
+            # bit j set if module j starts a run of at least five
+            run = same & (same >> 1) & (same >> 2) & (same >> 3)
+            score += cls.bitCount(run) + 2 * cls.bitCount(run & ~(run << 1))
+        return score
+
+    @classmethod
+    def packedScoreRule2(cls, rows, size):
+        full = (1 << (size - 1)) - 1
+        score = 0
+        for row, nextRow in zip(rows, rows[1:]):
+            vert = ~(row ^ nextRow)
+            blocks = vert & (vert >> 1) & ~(row ^ (row >> 1)) & full
+            score += 3 * cls.bitCount(blocks)
+        return score
+
+    @classmethod
+    def packedScoreRule3(
+        cls, lines, size,
+        pattern = [True, False, True, True, True, False, True,
+                   False, False, False, False]):
+        # The pattern can not overlap itself, so every match scores
+        full = (1 << (size - len(pattern))) - 1
+        score = 0
+        for line in lines:
+            inverted = ~line
+            found = full
+            for i, dark in enumerate(pattern):
+                found &= (line if dark else inverted) >> i
+            score += 40 * cls.bitCount(found)
+        return score
+
+    @classmethod
+    def packedScoreRule4(cls, rows, size):
+        count = sum(cls.bitCount(row) for row in rows)
+        return 10 * (abs(100 * count // size**2 - 50) // 5)
+
+    @classmethod
+    def getPackedLostPoint(cls, rows, cols, size):
+        # Rule 3 is only scored horizontally, as getLostPoint() never
+        # finds the pattern in its transposed modules (tuples, not lists)
+        return (cls.packedScoreRule4(rows, size) +
+                cls.packedScoreRule2(rows, size) +
+                cls.packedScoreRule3(rows, size) +
+                cls.packedScoreRule1(cols, size) +
+                cls.packedScoreRule1(rows, size))
+
 class QRMath:
     @staticmethod
     def glog(n):
@@ -21,6 +21,7 @@ import email
 from bson.objectid import ObjectId
 from pytransact.context import ReadonlyContext
 from pytransact.commit import CommitContext, wait_for_commit
+from pytransact import mongo
 from pytransact import queryops as q
 from pytransact import testsupport
 import members.billing
@@ -212,6 +213,45 @@ class TestBilling(testsupport.BLMTests):
         assert interval1_item.product == [interval1]
         assert dict(interval1_item.optionsWithValue)['Period'] == '2011'
 
+    def test_chargeable_counts(self):
+        org, provider, payments = self.mkTestData(payments=3)
+        self.mkPayment(
+            paymentProvider=provider,
+            transaction_date=['2011-01-01'],
+            amount=['100.00'])
+        org2 = blm.accounting.Org(subscriptionLevel=['subscriber'])
+        provider2 = blm.accounting.PaymentProvider(org=org2)
+        for day in '2010-06-01', '2010-12-31':
+            self.mkPayment(
+                paymentProvider=provider2,
+                transaction_date=[day],
+                amount=['100.00'])
+        blm.accounting.PaymentProvider(org=org2)  # no payments
+        simulated = blm.accounting.SimulatorProvider(org=org2)
+        self.mkPayment(
+            paymentProvider=simulated,
+            transaction_date=['2010-03-01'],
+            amount=['100.00'])
+        org3 = blm.accounting.Org(subscriptionLevel=['subscriber'])
+        org4 = blm.accounting.Org(subscriptionLevel=['subscriber'])
+        blm.accounting.PaymentProvider(org=org4)
+        self.commit()
+
+        billing = self.mkBilling()
+        assert billing.chargeable_counts('2010') == {
+            org.id[0]: 3, org2.id[0]: 2, org4.id[0]: 0}
+        assert billing.chargeable_counts('2011') == {
+            org.id[0]: 1, org2.id[0]: 0, org4.id[0]: 0}
+        assert billing.chargeable_counts('2010', [org2.id[0], org3.id[0]]) == {
+            org2.id[0]: 2}
+
+        # references to other providers are skipped
+        mongo.update(self.database.tois, {'_id': payments[0].id[0]},
+                     {'$push': {'paymentProvider': {'id': simulated.id[0]}}})
+        self.sync()
+        assert billing.chargeable_counts('2010') == {
+            org.id[0]: 3, org2.id[0]: 2, org4.id[0]: 0}
+
     def test_iter_invoices(self):
         openend = blm.accounting.Org(orgnum='556609-2473')
         otherorg = blm.accounting.Org(orgnum='111111-1111')
@@ -270,7 +310,7 @@ class TestBilling(testsupport.BLMTests):
             return iid1, iid2
 
         calls = []
-        def handle_org(orgid, year):
+        def handle_org(orgid, year, chargeables=None):
             assert year == '2010'
             calls.append(('org', orgid))
 
@@ -291,3 +331,57 @@ class TestBilling(testsupport.BLMTests):
             ('invoice', iid1),
             ('invoice', iid2)
             ]
+
+    def test_process_parallel(self):
+        orgids = [ObjectId() for i in range(20)]
+        iids = [ObjectId() for i in range(10)]
+
+        calls = []
+        def handle_org(orgid, year, chargeables=None):
+            assert year == '2010'
+            calls.append(('org', orgid))
+
+        def send_invoice(iid):
+            calls.append(('invoice', iid))
+
+        billing = self.mkBilling()
+        billing._subscription = 'subscription'
+        billing._products = []
+        billing.iter_orgs = lambda: iter(orgids)
+        billing.handle_org = handle_org
+        billing.iter_invoices = lambda: iter(iids)
+        billing.send_invoice = send_invoice
+
+        billing.process('2010', workers=4)
+
+        assert sorted(calls[:20]) == sorted(('org', oid) for oid in orgids)
+        assert sorted(calls[20:]) == sorted(('invoice', iid) for iid in iids)
+
+    def test_process_checkpoint(self, tmpdir):
+        orgids = [ObjectId() for i in range(5)]
+        checkpoint = str(tmpdir.join('checkpoint'))
+
+        handled = []
+        crash = [orgids[3]]
+        def handle_org(orgid, year, chargeables=None):
+            handled.append(orgid)
+            if orgid in crash:
+                crash.remove(orgid)
+                raise RuntimeError('crash')
+
+        billing = self.mkBilling()
+        billing.iter_orgs = lambda: iter(orgids)
+        billing.handle_org = handle_org
+        billing.iter_invoices = lambda: iter([])
+
+        py.test.raises(RuntimeError, billing.process, '2010', workers=1,
+                       checkpoint=checkpoint)
+        assert handled == orgids[:4]
+        assert set(members.billing.Checkpoint(checkpoint).done) == \
+            set(str(oid) for oid in orgids[:3])
+
+        del handled[:]
+        billing.process('2010', workers=1, checkpoint=checkpoint)
+        assert handled == orgids[3:]
+        assert set(members.billing.Checkpoint(checkpoint).done) == \
+            set(str(oid) for oid in orgids)
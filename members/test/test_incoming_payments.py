@@ -15,13 +15,18 @@
 # limitations under the License.
 
 import os
+import py
 from members.incoming_payments import PGParser, BGParser, LBRequestParser, LBParser, LBRejectedParser, LBStoppedPaymentsParser, LBReconciliationParser
 from accounting.bankgiro import decode_toid20
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal
 
 here = os.path.dirname(__file__)
 
+# parsing speed, run with PAYMENT_BENCHMARK=1 py.test -s
+benchmark = py.test.mark.skipif(not os.environ.get('PAYMENT_BENCHMARK'),
+                                reason='Set PAYMENT_BENCHMARK to run.')
+
 class TestParser(object):
     def setup(self):
         self.parser = PGParser()
@@ -274,3 +279,102 @@ class TestLBParser(object):
         sections = self.parser.sections
         for r in sections:
             pass
+
+
+class TestDecoder(object):
+
+    files = [
+        (PGParser, 'total_in_bas_exempelfil.txt'),
+        (BGParser, 'bginbetalningar_exempelfil_1.txt'),
+        (BGParser, 'BgMaxfil1.txt'),
+        (LBParser, 'LB-response-1.txt'),
+        (LBParser, 'leverantorsbetalning_exempelfil_betalningsspecifikation-med-lonedetaljer.txt'),
+        (LBRejectedParser, 'leverantorsbetalning_exempelfil_avvisade_sv.txt'),
+        (LBStoppedPaymentsParser, 'leverantorsbetalning_stoppade.txt'),
+        (LBReconciliationParser, 'leverantorsbetalning_exempelfil_betalningsbevakning_sv.txt'),
+        ]
+
+    def read(self, fname):
+        with open(os.path.join(here, fname), 'rb') as fp:
+            return fp.read()
+
+    def test_dates(self):
+        from members.incoming_payments import converters
+        for value in ['20111024', '19991231', '20000229']:
+            assert converters['D'](value) == \
+                datetime.strptime(value, '%Y%m%d').date()
+        for value in ['111024', '681231', '690101', '991231', '000101']:
+            assert converters['d'](value) == \
+                datetime.strptime(value, '%y%m%d').date()
+        for value in ['2011102X', '20111324', '2011 024']:
+            py.test.raises(ValueError, converters['D'], value)
+        for value in ['11102X', '111324', '000000', '      ']:
+            py.test.raises(ValueError, converters['d'], value)
+        assert converters['d0']('000000') is None
+        assert converters['d_']('      ') is None
+        assert converters['d_']('GENAST') == 'GENAST'
+        py.test.raises(ValueError, converters['d0'], '      ')
+        py.test.raises(ValueError, converters['d_'], '000000')
+
+    def test_compile_fields(self):
+        from members.incoming_payments import compile_fields
+        decode = compile_fields([(3, 4, '_'), (5, 10, 'A'), (11, 14, 'I'),
+                                 (15, 20, 'N'), (21, 26, 'T')])
+        assert decode('xx  0012340042012345ABC   \r\n') == [
+            '1234', 42, Decimal('123.45'), 'ABC']
+        decode = compile_fields([(3, 8, 'd0')])
+        assert decode('xx000000') == [None]
+        py.test.raises(ValueError, compile_fields, [(3, 4, '?')])
+
+    def test_parse_data(self):
+        import mmap
+        for Parser, fname in self.files:
+            data = self.read(fname)
+            bylines = Parser()
+            for line in data.splitlines(True):
+                bylines.parse(line)
+
+            whole = Parser()
+            whole.parse_data(data)
+            assert whole.linecount == bylines.linecount
+
+            with open(os.path.join(here, fname), 'rb') as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    frommap = Parser()
+                    frommap.parse_data(mapped)
+                finally:
+                    mapped.close()
+            assert frommap.linecount == bylines.linecount
+
+            if hasattr(bylines, 'sections'):
+                for parser in whole, frommap:
+                    assert [vars(r) for r in parser.sections] == \
+                        [vars(r) for r in bylines.sections]
+            else:
+                for parser in whole, frommap:
+                    assert len(parser.records.giro_accounts) == \
+                        len(bylines.records.giro_accounts)
+                    for acc, expect in zip(parser.records.giro_accounts,
+                                           bylines.records.giro_accounts):
+                        assert [vars(t) for t in acc.transactions] == \
+                            [vars(t) for t in expect.transactions]
+
+    @benchmark
+    def test_benchmark(self):
+        import time
+        for name, Parser, fnames in [
+                ('PG', PGParser, ['total_in_bas_exempelfil.txt']),
+                ('BG', BGParser, ['bginbetalningar_exempelfil_%d.txt' % n
+                                  for n in range(1, 6)]),
+                ('LB', LBParser, ['LB-response-1.txt',
+                                  'leverantorsbetalning_exempelfil_betalningsspecifikation-med-lonedetaljer.txt'])]:
+            data = [self.read(fname) for fname in fnames]
+            lines = 0
+            start = time.time()
+            while time.time() - start < 0.2:
+                for d in data:
+                    parser = Parser()
+                    parser.parse_data(d)
+                    lines += parser.linecount
+            print('%s: %d lines/s' % (name, lines / (time.time() - start)))
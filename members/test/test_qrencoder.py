@@ -18,12 +18,57 @@
 # Tests for QR-Encoder
 #
 
-import sys, os
+import itertools, sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 import py.test
 
 import qrencoder
+from qrencoder import zip_longest
+
+# timing comparisons, run with QR_BENCHMARK=1 py.test -s
+benchmark = py.test.mark.skipif(not os.environ.get('QR_BENCHMARK'),
+                                reason='Set QR_BENCHMARK to run.')
+
+
+def getBestMaskPatternSlow(qr):
+    """Unpacked QRCode.getBestMaskPattern(), building the full matrix
+    for each mask."""
+    minLostPoint = None
+    pattern = 0
+    for i in range(8):
+        qr.makeImpl(True, i)
+        transposedmodules = list(zip(*qr.modules))
+        lostPoint = qrencoder.QRUtil.getLostPoint(
+            qr.modules, transposedmodules, minLostPoint)
+        if (i == 0 or minLostPoint > lostPoint):
+            minLostPoint = lostPoint
+            pattern = i
+    return pattern
+
+
+def createBytesSlow(buffer, rsBlocks):
+    """Polynomial division version of QRCode.createBytes()."""
+    offset = 0
+    dcdata = []
+    ecdata = []
+    for block in rsBlocks:
+        dcCount = block.dataCount
+        ecCount = block.totalCount - dcCount
+        dcdata.append(buffer.buffer[offset:offset+dcCount])
+        offset += dcCount
+        rsPoly = qrencoder.QRUtil.getErrorCorrectPolynomial(ecCount)
+        rawPoly = qrencoder.QRPolynomial(dcdata[-1], rsPoly.getLength() - 1)
+        modPoly = rawPoly.mod(rsPoly)
+        rLen = rsPoly.getLength() - 1
+        mLen = modPoly.getLength()
+        ecdata.append([ (modPoly.get(i) if i >= 0 else 0)
+                      for i in range(mLen - rLen, mLen) ])
+
+    data = [ d for dd in itertools.chain(
+            zip_longest(*dcdata), zip_longest(*ecdata))
+             for d in dd if d is not None]
+    return data
 
 class TestMask(object):
 
@@ -300,6 +345,104 @@ class TestQRCode(object):
             qr.dataList = [qrdata]
             assert qr.calculate_version() == version
 
+    def test_packed_scores(self):
+        import random
+        rand = random.Random(17)
+        util = qrencoder.QRUtil
+        for size in 21, 22, 45, 177:
+            for density in 0.1, 0.5, 0.9:
+                modules = [[rand.random() < density for j in range(size)]
+                           for i in range(size)]
+                transposed = [list(col) for col in zip(*modules)]
+                rows = util.packRows(modules)
+                cols = util.transposePacked(rows, size)
+                assert cols == util.packRows(transposed)
+
+                assert util.packedScoreRule1(cols, size) == \
+                    util.maskScoreRule1vert(modules)
+                assert util.packedScoreRule1(rows, size) == \
+                    util.maskScoreRule1vert(transposed)
+                assert util.packedScoreRule2(rows, size) == \
+                    util.maskScoreRule2(modules)
+                assert util.packedScoreRule3(rows, size) == \
+                    util.maskScoreRule3hor(modules)
+                assert util.packedScoreRule3(cols, size) == \
+                    util.maskScoreRule3hor(transposed)
+                assert util.packedScoreRule4(rows, size) == \
+                    util.maskScoreRule4(modules)
+                assert util.getPackedLostPoint(rows, cols, size) == \
+                    util.getLostPoint(modules, list(zip(*modules)))
+
+    def test_packed_mask(self):
+        for pattern in range(8):
+            mask = qrencoder.QRUtil.getMask(pattern)
+            rows, cols = qrencoder.QRUtil.getPackedMask(pattern, 25)
+            for i in range(25):
+                for j in range(25):
+                    assert bool(rows[i] >> j & 1) == mask(i, j)
+                    assert bool(cols[j] >> i & 1) == mask(i, j)
+
+    def test_getBestMaskPattern(self):
+        for version in range(1, 41):
+            level = 'LMQH'[version % 4]
+            qr = qrencoder.QRCode(
+                version, getattr(qrencoder.QRErrorCorrectLevel, level))
+            qr.addData('QR%d' % version)
+            qr.moduleCount = version * 4 + 17
+            assert qr.getBestMaskPattern() == getBestMaskPatternSlow(qr)
+
+    def test_createBytes(self):
+        import random
+        rand = random.Random(17)
+        for version in range(1, 41):
+            for level in range(4):
+                rsBlocks = qrencoder.QRRSBlock.getRSBlocks(version, level)
+                buffer = qrencoder.QRBitBuffer()
+                buffer.buffer = [rand.randrange(256) for i in range(
+                    sum(block.dataCount for block in rsBlocks))]
+                buffer.buffer[:3] = [0, 0, 0]  # leading zero coefficients
+                assert qrencoder.QRCode.createBytes(buffer, rsBlocks) == \
+                    createBytesSlow(buffer, rsBlocks)
+
+    @benchmark
+    def test_benchmark_createBytes(self):
+        import time
+        blocks = [(qrencoder.QRRSBlock.getRSBlocks(version, level))
+                  for version in range(1, 41) for level in range(4)]
+        buffers = []
+        for rsBlocks in blocks:
+            buffer = qrencoder.QRBitBuffer()
+            buffer.buffer = [n % 256 for n in range(
+                sum(block.dataCount for block in rsBlocks))]
+            buffers.append(buffer)
+        for method in (createBytesSlow, qrencoder.QRCode.createBytes):
+            start = time.time()
+            for buffer, rsBlocks in zip(buffers, blocks):
+                method(buffer, rsBlocks)
+            print('%s: %.2f ms' % (method.__name__,
+                                   (time.time() - start) * 1000))
+
+    @benchmark
+    def test_benchmark(self):
+        import time
+        total = {}
+        for version in range(1, 41):
+            qr = qrencoder.QRCode(version, qrencoder.QRErrorCorrectLevel.M)
+            qr.addData(qrencoder.QR8bitByte(b'x' * 10 * version))
+            qr.moduleCount = version * 4 + 17
+            qr.makeImpl(True, 0)  # fill caches
+            times = []
+            for method in (getBestMaskPatternSlow,
+                           qrencoder.QRCode.getBestMaskPattern):
+                start = time.time()
+                method(qr)
+                times.append(time.time() - start)
+            for key, t in zip(['slow', 'packed'], times):
+                total[key] = total.get(key, 0) + t
+            print('version %2d: %7.2f ms %7.2f ms' % (
+                version, times[0] * 1000, times[1] * 1000))
+        print('total: %.2f s %.2f s' % (total['slow'], total['packed']))
+
 class FakeBuffer(object):
     def __init__(self):
         self.data = []
@@ -17,6 +17,7 @@
 from .. import ticket
 import py, os
 from reportlab.pdfgen import canvas
+from accounting import config
 
 class FakeToi(object):
     def __init__(self, **kw):
@@ -117,3 +118,111 @@ class TestPage(object):
         assert b'F. ' in text
         assert b'G. ' in text
         assert text.count(b'\x0c') == 2
+
+
+class TestCache(object):
+
+    def setup_method(self, method):
+        self.cfg = config.save()
+        config.config.set('accounting', 'ticket_cache_dir', '')
+        ticket.cache.clear()
+        self.rendered = []
+        self._render = ticket.render
+
+    def teardown_method(self, method):
+        config.restore(self.cfg)
+        ticket.cache.clear()
+
+    def render(self, data):
+        self.rendered.append(data['title'])
+        return self._render(data)
+
+    def test_ticket_data(self):
+        data = ticket.ticket_data(TestPage.testdata[1])
+        assert data == {
+            'title': u'Fusket i natten',
+            'options': [('Namn', 'Allan G. Octamac'),
+                        (u'Karaktär', u'Räksmörgås')],
+            'barcode': 'barcodedata',
+            'qrcode': 'qrcodedata',
+            'org': ticket.Org([], [], [])}
+        assert ticket.cache_key(data) == ticket.cache_key(
+            ticket.ticket_data(TestPage.testdata[1]))
+        assert ticket.cache_key(data) != ticket.cache_key(
+            ticket.ticket_data(TestPage.testdata[2]))
+
+    def test_memory(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(ticket, 'render', self.render)
+        monkeypatch.setattr(ticket, 'cache_size', 3)
+
+        first = tmpdir.join('first.pdf')
+        with first.open('wb') as fp:
+            ticket.generate(fp, TestPage.testdata[:3])
+        assert len(self.rendered) == 3
+
+        second = tmpdir.join('second.pdf')
+        with second.open('wb') as fp:
+            ticket.generate(fp, TestPage.testdata[:3])
+        assert len(self.rendered) == 3
+
+        os.system('pdftotext %s' % second)
+        text = tmpdir.join('second.txt').open('rb').read()
+        assert b'F. ' in text
+        assert b'G. ' in text
+
+        # the first ticket is evicted
+        with tmpdir.join('third.pdf').open('wb') as fp:
+            ticket.generate(fp, TestPage.testdata)
+        assert len(self.rendered) == 4
+        with tmpdir.join('fourth.pdf').open('wb') as fp:
+            ticket.generate(fp, TestPage.testdata[:1])
+        assert len(self.rendered) == 5
+
+    def test_disk(self, monkeypatch, tmpdir):
+        config.config.set('accounting', 'ticket_cache_dir', str(tmpdir))
+        monkeypatch.setattr(ticket, 'render', self.render)
+        data = ticket.ticket_data(TestPage.testdata[0])
+
+        pdf, = ticket.render_cached([data])
+        key = ticket.cache_key(data)
+        assert tmpdir.join(key[:2], key).read('rb') == pdf
+
+        ticket.cache.clear()
+        assert ticket.render_cached([data]) == [pdf]
+        assert len(self.rendered) == 1
+
+    def test_pool(self, monkeypatch):
+        monkeypatch.setattr(ticket, 'render', self.render)
+        calls = []
+        class Pool(object):
+            def map(self, func, items):
+                calls.append(len(items))
+                return list(map(func, items))
+
+        tickets = [ticket.ticket_data(t) for t in TestPage.testdata]
+        ticket.render_cached(tickets[:1])
+        pdfs = ticket.render_cached(tickets, pool=Pool())
+        assert calls == [3]
+        assert len(self.rendered) == 4
+        assert pdfs == ticket.render_cached(tickets, pool=Pool())
+        assert calls == [3]
+
+    def test_get_pool(self, monkeypatch):
+        pools = []
+        class Context(object):
+            def Pool(self, workers):
+                pools.append(workers)
+                return object()
+        monkeypatch.setattr(ticket, '_pool', None)
+        monkeypatch.setattr(ticket, '_mp_context', Context)
+        config.config.set('accounting', 'ticket_workers', '1')
+        assert ticket.get_pool() is None
+        config.config.set('accounting', 'ticket_workers', '2')
+        pool = ticket.get_pool()
+        assert ticket.get_pool() is pool
+        assert pools == [2]
+
+    def test_mp_context(self):
+        context = ticket._mp_context()
+        if hasattr(context, 'get_start_method'):
+            assert context.get_start_method() == 'spawn'
@@ -17,7 +17,14 @@
 # Render a ticket to PDF
 
 import os, sys
+import collections
 import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import tempfile
+import threading
 # Disable attribute assignment checks for 25% speed increase, AKA tell reportlab
 # that we are Python programmers.
 import reportlab.rl_config
@@ -44,6 +51,7 @@ from pdfrw import PdfReader
 from pdfrw.buildxobj import pagexobj
 from pdfrw.toreportlab import makerl
 
+import accounting.config
 from . import qrreportlab as qr
 try:
     unicode
@@ -64,6 +72,21 @@ def save_state(canvas):
     yield
     canvas.restoreState()
 
+TICKET_WIDTH = 210*mm
+TICKET_HEIGHT = 99*mm # 1/3 A4 aka A65
+TICKETS_PER_PAGE = 3
+
+_logo = None
+_logo_lock = threading.Lock()
+
+def get_logo():
+    global _logo
+    with _logo_lock:
+        if _logo is None:
+            _logo = pagexobj(PdfReader(os.path.join(os.path.dirname(__file__),
+                                                    'eutaxia-logo.pdf')).pages[0])
+        return _logo
+
 class Ticket(Flowable):
     _attrMap = AttrMap(
         BASE=Widget,
@@ -75,8 +98,8 @@ class Ticket(Flowable):
     def __init__(self, title, **kw):
         Flowable.__init__(self)
 
-        self.width = 210*mm
-        self.height = 99*mm # 1/3 A4 aka A65
+        self.width = TICKET_WIDTH
+        self.height = TICKET_HEIGHT
         self.title = title
 
         for k,v in kw.items():
@@ -132,10 +155,7 @@ class Ticket(Flowable):
             width = stringWidth(u'Tickets by ', 'Helvetica', 8)
 
             with save_state(c):
-                # XXX Ideally, only load the logo once
-                logo = PdfReader(os.path.join(os.path.dirname(__file__),
-                                              'eutaxia-logo.pdf')).pages[0]
-                logo = pagexobj(logo)
+                logo = get_logo()
                 rl_obj = makerl(c, logo)
                 scale = 9 / logo.BBox[3]
                 c.translate(width, -1.5)
@@ -153,12 +173,7 @@ class Ticket(Flowable):
                     p.close()
                     c.drawPath(p)
 
-                width += logo.BBox[2] * scale
-
             c.drawString(0, -10, u'http://www.eutaxia.se/')
-            width = max(width, stringWidth(u'http://www.eutaxia.se/', 'Helvetica', 8))
-
-            c.linkURL('http://www.eutaxia.se', (-1, -13, width, 10), relative=1)
 
         bar = code128.Code128(self.barcode, barWidth=0.3*mm, humanReadable=1)
         bar.drawOn(c,10*mm,10*mm)
@@ -169,8 +184,8 @@ class Ticket(Flowable):
                             barWidth = 30*mm, barHeight = 30*mm)
         qd.add(q)
         renderPDF.draw(qd, c, self.width - q.barWidth - 10*mm, 10*mm)
-        c.linkURL(self.qrcode, (self.width - q.barWidth - 10*mm, 10*mm,
-                                self.width - 10*mm, 40*mm), relative=1)
+
+        self.drawLinks()
 
         p = c.beginPath()
         c.setDash(1,2)
@@ -188,19 +203,45 @@ class Ticket(Flowable):
             p.close()
             c.drawPath(p)
 
+    def links(self):
+        """
+        Return the (url, rect) of the links on the ticket.
+
+        Links are annotations, which are lost when a rendered ticket
+        is reused as a form, so generate() adds them separately.
+        """
+        logo = get_logo()
+        width = (stringWidth(u'Tickets by ', 'Helvetica', 8) +
+                 logo.BBox[2] * 9 / logo.BBox[3])
+        width = max(width, stringWidth(u'http://www.eutaxia.se/', 'Helvetica', 8))
+        return [
+            ('http://www.eutaxia.se', (120*mm - 1, 15*mm - 13,
+                                       120*mm + width, 15*mm + 10)),
+            (self.qrcode, (self.width - 40*mm, 10*mm,
+                           self.width - 10*mm, 40*mm)),
+            ]
+
+    def drawLinks(self):
+        for url, rect in self.links():
+            self.canv.linkURL(url, rect, relative=1)
+
+
+def make_canvas(*args, **kw):
+    canv = canvas.Canvas(*args, **kw)
+    catalog = canv._doc.Catalog
+    try:
+        vp = catalog.ViewerPreferences
+    except AttributeError:
+        from reportlab.pdfbase.pdfdoc import PDFDictionary
+        vp = catalog.ViewerPreferences = PDFDictionary()
+
+    vp['Duplex'] = 'Simplex'
+    return canv
+
 
 class DocTemplate(BaseDocTemplate):
     def _canvasMaker(self, *args, **kw):
-        canv = canvas.Canvas(*args, **kw)
-        catalog = canv._doc.Catalog
-        try:
-            vp = catalog.ViewerPreferences
-        except AttributeError:
-            from reportlab.pdfbase.pdfdoc import PDFDictionary
-            vp = catalog.ViewerPreferences = PDFDictionary()
-
-        vp['Duplex'] = 'Simplex'
-        return canv
+        return make_canvas(*args, **kw)
 
     def build(self, flowables):
         self._calc()    #in case we changed margins sizes etc
@@ -210,16 +251,172 @@ class DocTemplate(BaseDocTemplate):
         self.addPageTemplates([PageTemplate(id='First',frames=frameT, pagesize=self.pagesize)])
         BaseDocTemplate.build(self,flowables, canvasmaker=self._canvasMaker)
 
-def generate(fp, data):
-    doc = DocTemplate(fp, pagesize=A4, leftMargin=0, rightMargin=0,
-                            topMargin=0, bottomMargin=0)
-    flow = []
-    for t in data:
-        flow.append(Ticket(title=t.name[0], options=t.options,
-                           barcode=str(t.barcode[0]), qrcode=t.qrcode[0],
-                           org=t.org[0]))
-    doc.build(flow)
+Org = collections.namedtuple('Org', 'name address phone')
+
+def ticket_data(t):
+    """Return what is printed on the Ticket TOI t, as Ticket kwargs."""
+    org = t.org[0]
+    return {'title': t.name[0],
+            'options': [tuple(option) for option in t.options],
+            'barcode': str(t.barcode[0]),
+            'qrcode': t.qrcode[0],
+            'org': Org(list(org.name), list(org.address), list(org.phone))}
+
+
+def render(ticket):
+    """Render ticket (see ticket_data()) to a one page PDF."""
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=(TICKET_WIDTH, TICKET_HEIGHT))
+    flowable = Ticket(**ticket)
+    flowable.drawLinks = lambda: None  # added by generate()
+    flowable.drawOn(c, 0, 0)
+    c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+# Rendered tickets are cached on everything printed on them (which
+# includes the ticket id and random), in memory and, if
+# accounting.ticket_cache_dir is set, on disk.
 
+cache = collections.OrderedDict()
+cache_size = 1024
+cache_lock = threading.Lock()
+
+
+def cache_key(ticket):
+    return hashlib.sha1(json.dumps(ticket, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def cache_path(key):
+    config = accounting.config.config
+    if not (config.has_option('accounting', 'ticket_cache_dir') and
+            config.get('accounting', 'ticket_cache_dir')):
+        return None
+    return os.path.join(config.get('accounting', 'ticket_cache_dir'),
+                        key[:2], key)
+
+
+def read_cached(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def write_cached(path, pdf):
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(pdf)
+        os.rename(f.name, path)
+    except (IOError, OSError):
+        pass  # the cache is only an optimization
+
+
+def remember(key, pdf):
+    with cache_lock:
+        cache[key] = pdf
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+
+def render_cached(tickets, pool=None):
+    """
+    Render tickets like render(), using the cache. Tickets that are
+    not cached are rendered by pool, if given.
+    """
+    keys = [cache_key(ticket) for ticket in tickets]
+    result = [None] * len(tickets)
+    missing = []
+    for i, key in enumerate(keys):
+        with cache_lock:
+            pdf = cache.pop(key, None)
+            if pdf is not None:
+                cache[key] = pdf
+        if pdf is None:
+            path = cache_path(key)
+            if path:
+                pdf = read_cached(path)
+                if pdf is not None:
+                    remember(key, pdf)
+        if pdf is None:
+            missing.append(i)
+        result[i] = pdf
+
+    if missing:
+        todo = [tickets[i] for i in missing]
+        if pool is not None and len(todo) > 1:
+            rendered = pool.map(render, todo)
+        else:
+            rendered = list(map(render, todo))
+        for i, pdf in zip(missing, rendered):
+            result[i] = pdf
+            remember(keys[i], pdf)
+            path = cache_path(keys[i])
+            if path:
+                write_cached(path, pdf)
+
+    return result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _mp_context():
+    # The pool is started from whichever request thread needs it
+    # first. A process forked while other threads hold locks (the
+    # logging module's, say) can deadlock on them, so spawn fresh
+    # interpreters where possible.
+    try:
+        return multiprocessing.get_context('spawn')
+    except AttributeError:  # Python 2 can only fork
+        return multiprocessing
+
+def get_pool():
+    """
+    Return the process pool for rendering tickets, or None if
+    accounting.ticket_workers is less than two.
+    """
+    global _pool
+    config = accounting.config.config
+    if not config.has_option('accounting', 'ticket_workers'):
+        return None
+    workers = config.getint('accounting', 'ticket_workers')
+    if workers < 2:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = _mp_context().Pool(workers)
+        return _pool
+
+
+def generate(fp, data, pool=None):
+    """
+    Write a PDF with the Ticket TOIs in data to fp, three tickets to
+    an A4 page.
+    """
+    tickets = [ticket_data(t) for t in data]
+    pages = render_cached(tickets, pool)
+
+    c = make_canvas(fp, pagesize=A4)
+    for i, (ticket, page) in enumerate(zip(tickets, pages)):
+        if i and not i % TICKETS_PER_PAGE:
+            c.showPage()
+        with save_state(c):
+            slot = i % TICKETS_PER_PAGE + 1
+            c.translate(0, A4[1] - slot * TICKET_HEIGHT)
+            form = pagexobj(PdfReader(fdata=page).pages[0])
+            c.doForm(makerl(c, form))
+            flowable = Ticket(**ticket)
+            flowable.canv = c
+            flowable.drawLinks()
+    c.showPage()
+    c.save()
 
 
 def test():